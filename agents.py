@@ -1,32 +1,160 @@
 # --- agents.py ---
 import os
+import io
 import json
+import wave
 import base64
 import uuid
 import asyncio
 import logging
+import functools
+import threading
+import httpx
 from google import genai
 from google.genai import types
 from fastapi import WebSocket
 from dotenv import load_dotenv
+import audio_framing
+import audio_pacer
+import response_cache
+import model_backend
 
 load_dotenv()
 # Configure logging
 logger = logging.getLogger("medforce-backend")
 
+# Optional lossless compression (FLAC) for inline audio uploads
+try:
+    import numpy as np
+    import soundfile as sf
+    FLAC_AVAILABLE = True
+except ImportError:
+    FLAC_AVAILABLE = False
+    logger.warning("SOUNDFILE : Not Available, audio uploads fall back to WAV")
+
 # --- Configuration ---
 VOICE_MODEL = "gemini-live-2.5-flash-preview-native-audio-09-2025"
 ADVISOR_MODEL = "gemini-2.5-flash" 
 DIAGNOSER_MODEL = "gemini-2.5-flash-lite" 
 RANKER_MODEL = "gemini-2.5-flash-lite" 
 
+# Long Live sessions: sliding-window compression keeps per-turn cost flat,
+# resumption handles let a session survive a server-initiated reconnect (GoAway)
+LIVE_COMPRESSION_TRIGGER_TOKENS = int(os.getenv("LIVE_COMPRESSION_TRIGGER_TOKENS", "24000"))
+LIVE_COMPRESSION_TARGET_TOKENS = int(os.getenv("LIVE_COMPRESSION_TARGET_TOKENS", "12000"))
+LIVE_SESSION_RESUMPTION = os.getenv("LIVE_SESSION_RESUMPTION", "true").lower() == "true"
+
+# --- Shared Client / Agent Registry ---
+CLIENT_MAX_CONNECTIONS = int(os.getenv("GENAI_MAX_CONNECTIONS", "64"))
+CLIENT_KEEPALIVE_CONNECTIONS = int(os.getenv("GENAI_KEEPALIVE_CONNECTIONS", "32"))
+CLIENT_KEEPALIVE_EXPIRY_SEC = 120.0
+
+_clients = {}      # event loop -> genai.Client
+_agents = {}       # (agent class, args) -> shared instance
+_registry_lock = threading.Lock()
+
+
+def _new_client():
+    return genai.Client(
+        vertexai=True, 
+        project=os.getenv("PROJECT_ID"), 
+        location=os.getenv("PROJECT_LOCATION", "us-central1"),
+        http_options=types.HttpOptions(async_client_args={
+            "limits": httpx.Limits(
+                max_connections=CLIENT_MAX_CONNECTIONS,
+                max_keepalive_connections=CLIENT_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=CLIENT_KEEPALIVE_EXPIRY_SEC,
+            )
+        })
+    )
+
+
+def get_client():
+    """
+    Shared, pooled genai.Client for the running event loop.
+    The async connection pool is bound to the loop that opened it, so the server loop and
+    each logic thread loop get their own client (see release_client).
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    with _registry_lock:
+        client = _clients.get(loop)
+        if client is None:
+            client = _clients[loop] = _new_client()
+        return client
+
+
+async def release_client():
+    """Closes the client of the running loop. Call before the loop shuts down."""
+    with _registry_lock:
+        client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        try:
+            await client.aio.aclose()
+        except Exception as e:
+            logger.warning(f"⚠️ [Agents] Closing client failed: {e}")
+
+
+def get_agent(cls, *args):
+    """Process-wide agent instance. Logic agents keep no per-session state, so they are shared."""
+    key = (cls, args)
+    with _registry_lock:
+        agent = _agents.get(key)
+    if agent is None:
+        agent = cls(*args)
+        with _registry_lock:
+            agent = _agents.setdefault(key, agent)
+    return agent
+
+
+@functools.lru_cache(maxsize=None)
+def load_prompt(filename, fallback=""):
+    """Reads system_prompts/<filename> once per process."""
+    try:
+        with open(os.path.join("system_prompts", filename), "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return fallback
+
+
 class BaseLogicAgent:
     def __init__(self):
-        self.client = genai.Client(
-            vertexai=True, 
-            project=os.getenv("PROJECT_ID"), 
-            location=os.getenv("PROJECT_LOCATION", "us-central1")
+        # Prebuilt GenerateContentConfig per temperature (schema and prompt are fixed per agent)
+        self._configs = {}
+
+    @property
+    def client(self):
+        return get_client()
+
+    def _config(self, temperature=0.0):
+        config = self._configs.get(temperature)
+        if config is None:
+            config = self._configs[temperature] = types.GenerateContentConfig(
+                response_mime_type="application/json", 
+                response_schema=self.response_schema, 
+                system_instruction=self.system_instruction, 
+                temperature=temperature
             )
+        return config
+
+    async def _generate(self, model, contents, temperature=0.0):
+        """
+        JSON generation with this agent's schema and system prompt.
+        Deterministic (temperature 0) calls go through the opt-in response cache.
+        """
+        cache = response_cache.get_cache() if temperature == 0 else None
+        if cache is not None:
+            key = cache.make_key(model, self.system_instruction, contents, self.response_schema)
+            text = cache.get(key)
+            if text is not None:
+                return response_cache.as_response(text)
+
+        response = await model_backend.get_backend().generate(self, model, contents, self._config(temperature))
+        if cache is not None and response.text:
+            cache.put(key, response.text, model=model)
+        return response
 
 
 class TextBridgeAgent:
@@ -34,14 +162,16 @@ class TextBridgeAgent:
         self.name = name
         self.system_instruction = system_instruction
         self.voice_name = voice_name
-        self.client = genai.Client(
-            vertexai=True, 
-            project=os.getenv("PROJECT_ID"), 
-            location=os.getenv("PROJECT_LOCATION", "us-central1")
-        )
         self.session = None
+        self.resume_handle = None     # Latest resumable handle sent by the server
+        self.go_away = False          # Server announced it will close this connection
 
-    def get_connection_context(self):
+    @property
+    def client(self):
+        return get_client()
+
+    def get_connection_context(self, handle=None):
+        """:param handle: Session resumption handle; continues that session's context on a new connection."""
         config = types.LiveConnectConfig(
             response_modalities=["AUDIO"], 
             system_instruction=types.Content(parts=[types.Part(text=self.system_instruction)]),
@@ -51,13 +181,27 @@ class TextBridgeAgent:
                 )
             ),
             output_audio_transcription=types.AudioTranscriptionConfig(),
+            context_window_compression=types.ContextWindowCompressionConfig(
+                trigger_tokens=LIVE_COMPRESSION_TRIGGER_TOKENS,
+                sliding_window=types.SlidingWindow(target_tokens=LIVE_COMPRESSION_TARGET_TOKENS),
+            ),
+            session_resumption=types.SessionResumptionConfig(handle=handle) if LIVE_SESSION_RESUMPTION else None,
         )
-        return self.client.aio.live.connect(model=VOICE_MODEL, config=config)
+        return model_backend.get_backend().live_connect(self, VOICE_MODEL, config)
 
     def set_session(self, session):
         self.session = session
+        self.go_away = False
 
-    async def speak_and_stream(self, text_input, websocket: WebSocket, highlighter=None, diagnosis_context=None):
+    async def speak_and_stream(self, text_input, websocket: WebSocket, highlighter=None, diagnosis_context=None, audio_sink=None, binary_audio=False, pacer=None):
+        """
+        :param audio_sink: Optional callable(pcm_bytes, speaker=...) receiving the raw 24 kHz PCM,
+                           e.g. TranscriberEngine.add_audio for server-side loopback.
+        :param binary_audio: Send audio as binary frames (see audio_framing) instead of base64 JSON.
+        :param pacer: Connection's AudioPacer. Output is queued on it and this returns as soon as the
+                      model finishes the turn, while the pacer keeps playing it out in real time.
+                      Without one, a temporary pacer is used and drained before returning.
+        """
         if not self.session: return None, []
         
         try:
@@ -65,25 +209,43 @@ class TextBridgeAgent:
         except Exception:
             return None, []
 
+        own_pacer = pacer is None
+        if own_pacer:
+            pacer = audio_pacer.AudioPacer(websocket).start()
+
         turn_id = str(uuid.uuid4())
         text_accumulator = []
+        seq = 0
         
         try:
             async for response in self.session.receive():
+                if (update := response.session_resumption_update) and update.resumable and update.new_handle:
+                    self.resume_handle = update.new_handle
+                if response.go_away and not self.go_away:
+                    self.go_away = True
+                    logger.info(f"🔄 [{self.name}] Live server GoAway (time left {response.go_away.time_left}), reconnecting after this turn.")
+
                 if data := response.data:
-                    b64_audio = base64.b64encode(data).decode('utf-8')
-                    await websocket.send_json({
-                        "type": "audio",
-                        "id": turn_id,
-                        "speaker": self.name,
-                        "data": b64_audio
-                    })
-                    await asyncio.sleep(0.2) 
+                    if audio_sink:
+                        audio_sink(data, speaker=self.name)
+                    if binary_audio:
+                        pacer.put_audio(audio_framing.encode_frame(
+                            data, turn_id, self.name, seq, flags=audio_framing.FLAG_FIRST if seq == 0 else 0
+                        ), len(data))
+                    else:
+                        b64_audio = base64.b64encode(data).decode('utf-8')
+                        pacer.put_audio({
+                            "type": "audio",
+                            "id": turn_id,
+                            "speaker": self.name,
+                            "data": b64_audio
+                        }, len(data))
+                    seq += 1
 
                 if response.server_content and response.server_content.output_transcription:
                     if text_chunk := response.server_content.output_transcription.text:
                         text_accumulator.append(text_chunk)
-                        await websocket.send_json({
+                        pacer.put({
                             "type": "text_delta",
                             "id": turn_id,
                             "speaker": self.name,
@@ -91,7 +253,10 @@ class TextBridgeAgent:
                         })
 
                 if response.server_content and response.server_content.turn_complete:
-                    await websocket.send_json({
+                    if binary_audio and seq:
+                        # The last audio chunk is only known now: close the turn with an empty final frame
+                        pacer.put(audio_framing.encode_frame(b"", turn_id, self.name, seq, flags=audio_framing.FLAG_FINAL))
+                    pacer.put({
                         "type": "turn_complete",
                         "id": turn_id,
                         "speaker": self.name
@@ -105,7 +270,7 @@ class TextBridgeAgent:
                                 highlights = await highlighter.highlight_text(full_text, diagnosis_context)
                             except: pass
 
-                        await websocket.send_json({
+                        pacer.put({
                             "type": "transcript",
                             "id": turn_id,
                             "speaker": self.name,
@@ -119,6 +284,9 @@ class TextBridgeAgent:
         except Exception as e:
             logger.error(f"Stream Error ({self.name}): {e}")
             return None, []
+        finally:
+            if own_pacer:
+                await pacer.close()
 
 class DiagnosisHepato(BaseLogicAgent):
     def __init__(self):
@@ -162,20 +330,15 @@ class DiagnosisHepato(BaseLogicAgent):
             }
             }
         
-        try:
-            with open("system_prompts/hepato_agent.md", "r", encoding="utf-8") as f: self.system_instruction = f.read()
-        except: self.system_instruction = "Return true if new info."
+        self.system_instruction = load_prompt("hepato_agent.md", "Return true if new info.")
 
     async def get_hepa_diagnosis(self, conversation_history, patient_info, existing_question):
         if not conversation_history: return False, "Empty"
         try:
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash-lite", 
+            response = await self._generate(
+                model="gemini-2.5-flash-lite",
                 contents=f"Patient Info:\n{patient_info}\n\nTranscript:\n{json.dumps(conversation_history)}\n\nExisting Question:{json.dumps(existing_question)}",
-                config=types.GenerateContentConfig(response_mime_type="application/json", 
-                response_schema=self.response_schema, 
-                system_instruction=self.system_instruction, 
-                temperature=0.0)
+                temperature=0.0
             )
             res = json.loads(response.text)
             return res
@@ -225,20 +388,15 @@ class DiagnosisGeneral(BaseLogicAgent):
             }
             }
         
-        try:
-            with open("system_prompts/general_agent.md", "r", encoding="utf-8") as f: self.system_instruction = f.read()
-        except: self.system_instruction = "Return true if new info."
+        self.system_instruction = load_prompt("general_agent.md", "Return true if new info.")
 
     async def get_gen_diagnosis(self, conversation_history, patient_info, existing_question):
         if not conversation_history: return False, "Empty"
         try:
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash-lite", 
+            response = await self._generate(
+                model="gemini-2.5-flash-lite",
                 contents=f"Patient Info:\n{patient_info}\n\nHistory:\n{json.dumps(conversation_history)}\n\nExisting Question:{json.dumps(existing_question)}",
-                config=types.GenerateContentConfig(response_mime_type="application/json", 
-                response_schema=self.response_schema, 
-                system_instruction=self.system_instruction, 
-                temperature=0.0)
+                temperature=0.0
             )
             res = json.loads(response.text)
             return res
@@ -293,11 +451,7 @@ class DiagnosisConsolidate(BaseLogicAgent):
                 "required": ["did", "headline", "diagnosis", "indicators_point", "reasoning", "followup_question"]
             }
         }
-        try:
-            with open("system_prompts/consolidated_agent.md", "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        except:
-            self.system_instruction = "You are a clinical consolidator. Evaluate symptoms against diagnosis criteria."
+        self.system_instruction = load_prompt("consolidated_agent.md", "You are a clinical consolidator. Evaluate symptoms against diagnosis criteria.")
 
     async def consolidate_diagnosis(self, diagnosis_pool, new_diagnosis_list):
         try:
@@ -307,15 +461,10 @@ class DiagnosisConsolidate(BaseLogicAgent):
                 f"NEW_CANDIDATES (Present symptoms to be checked):\n{json.dumps(new_diagnosis_list)}"
             )
 
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash-lite", 
+            response = await self._generate(
+                model="gemini-2.5-flash-lite",
                 contents=content,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json", 
-                    response_schema=self.response_schema, 
-                    system_instruction=self.system_instruction, 
-                    temperature=0.0
-                )
+                temperature=0.0
             )
             return json.loads(response.text)
         except Exception as e:
@@ -347,19 +496,14 @@ class QuestionCheck(BaseLogicAgent):
             }
             }
         
-        try:
-            with open("system_prompts/question_checker.md", "r", encoding="utf-8") as f: self.system_instruction = f.read()
-        except: self.system_instruction = "Return true if new info."
+        self.system_instruction = load_prompt("question_checker.md", "Return true if new info.")
 
     async def check_question(self, transcript, question_pool):
         try:
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash-lite", 
+            response = await self._generate(
+                model="gemini-2.5-flash-lite",
                 contents=f"Question Pool:\n{json.dumps(question_pool)}\nTranscript:\n{json.dumps(transcript)}",
-                config=types.GenerateContentConfig(response_mime_type="application/json", 
-                response_schema=self.response_schema, 
-                system_instruction=self.system_instruction, 
-                temperature=0.0)
+                temperature=0.0
             )
             res = json.loads(response.text)
             return res
@@ -392,19 +536,14 @@ class QuestionMerger(BaseLogicAgent):
             }
             }
         
-        try:
-            with open("system_prompts/question_merger.md", "r", encoding="utf-8") as f: self.system_instruction = f.read()
-        except: self.system_instruction = "Return true if new info."
+        self.system_instruction = load_prompt("question_merger.md", "Return true if new info.")
 
     async def process_question(self, transcript, diagnosis_pool, question_pool):
         try:
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash-lite", 
+            response = await self._generate(
+                model="gemini-2.5-flash-lite",
                 contents=f"Diagnosis Pool:\n{json.dumps(diagnosis_pool)}\nQuestion Pool:\n{json.dumps(question_pool)}\nTranscript:\n{json.dumps(transcript)}",
-                config=types.GenerateContentConfig(response_mime_type="application/json", 
-                response_schema=self.response_schema, 
-                system_instruction=self.system_instruction, 
-                temperature=0.0)
+                temperature=0.0
             )
             res = json.loads(response.text)
             return res
@@ -433,11 +572,7 @@ class InterviewSupervisor(BaseLogicAgent):
             "required": ["end", "state"]
         }
         
-        try:
-            with open("system_prompts/supervisor_agent.md", "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        except FileNotFoundError:
-            self.system_instruction = "Identify the interview state and determine if it is clinically complete."
+        self.system_instruction = load_prompt("supervisor_agent.md", "Identify the interview state and determine if it is clinically complete.")
 
     async def check_completion(self, transcript, diagnosis_hypotheses):
         try:
@@ -446,15 +581,10 @@ class InterviewSupervisor(BaseLogicAgent):
                 f"Ongoing Interview Transcript:\n{transcript}"
             )
 
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash-lite", 
+            response = await self._generate(
+                model="gemini-2.5-flash-lite",
                 contents=user_content,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json", 
-                    response_schema=self.response_schema, 
-                    system_instruction=self.system_instruction, 
-                    temperature=0.0
-                )
+                temperature=0.0
             )
             
             return json.loads(response.text) # Returns {"end": bool, "state": "..."}
@@ -561,11 +691,7 @@ class TranscribeStructureAgent():
             }
         }
         
-        try:
-            with open("system_prompts/transcribe_structure_agent.md", "r", encoding="utf-8") as f: 
-                self.system_instruction = f.read()
-        except Exception: 
-            self.system_instruction = "Parse medical transcription into Nurse/Patient roles with highlights."
+        self.system_instruction = load_prompt("transcribe_structure_agent.md", "Parse medical transcription into Nurse/Patient roles with highlights.")
 
     async def structure_transcription(self, existing_transcript: list, new_raw_text: str):
         try:
@@ -628,26 +754,17 @@ class QuestionEnrichmentAgent(BaseLogicAgent):
             }
         }
 
-        try:
-            with open("system_prompts/question_enrichment_agent.md", "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        except:
-            self.system_instruction = "Enrich medical questions with UI and clinical metadata."
+        self.system_instruction = load_prompt("question_enrichment_agent.md", "Enrich medical questions with UI and clinical metadata.")
 
     async def enrich_questions(self, questions_list: list):
         if not questions_list:
             return []
 
         try:
-            response = await self.client.aio.models.generate_content(
+            response = await self._generate(
                 model="gemini-2.5-flash-lite",
                 contents=f"Questions to process:\n{json.dumps(questions_list)}",
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    response_schema=self.response_schema,
-                    system_instruction=self.system_instruction,
-                    temperature=0.0
-                )
+                temperature=0.0
             )
             return json.loads(response.text)
         except Exception as e:
@@ -718,24 +835,15 @@ class ConsultationAnalyticAgent(BaseLogicAgent):
             "required": ["overall_score", "metrics", "key_strengths", "improvement_areas", "sentiment_trend"]
         }
 
-        try:
-            with open("system_prompts/analytic_agent.md", "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        except FileNotFoundError:
-            self.system_instruction = "Analyze the nurse-patient transcript and provide clinical communication coaching."
+        self.system_instruction = load_prompt("analytic_agent.md", "Analyze the nurse-patient transcript and provide clinical communication coaching.")
 
     async def analyze_consultation(self, structured_transcript: list):
         if not structured_transcript: return {}
         try:
-            response = await self.client.aio.models.generate_content(
+            response = await self._generate(
                 model="gemini-2.5-flash-lite",
                 contents=f"Transcript for Analysis:\n{json.dumps(structured_transcript)}",
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    response_schema=self.response_schema,
-                    system_instruction=self.system_instruction,
-                    temperature=0.0
-                )
+                temperature=0.0
             )
             return json.loads(response.text)
         except Exception as e:
@@ -781,11 +889,7 @@ class PatientEducationAgent(BaseLogicAgent):
             }
         }
 
-        try:
-            with open("system_prompts/patient_education_agent.md", "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        except FileNotFoundError:
-            self.system_instruction = "Generate defensive patient education and reassurance with legal reasoning."
+        self.system_instruction = load_prompt("patient_education_agent.md", "Generate defensive patient education and reassurance with legal reasoning.")
 
     async def generate_education(self, transcript: list, existing_education: list):
         if not transcript:
@@ -797,15 +901,10 @@ class PatientEducationAgent(BaseLogicAgent):
                 f"CURRENT TRANSCRIPT:\n{json.dumps(transcript)}"
             )
 
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash-lite", 
+            response = await self._generate(
+                model="gemini-2.5-flash-lite",
                 contents=user_content,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    response_schema=self.response_schema,
-                    system_instruction=self.system_instruction,
-                    temperature=0.0
-                )
+                temperature=0.0
             )
             return json.loads(response.text)
         except Exception as e:
@@ -857,11 +956,7 @@ class ClinicalChecklistAgent(BaseLogicAgent):
             }
         }
 
-        try:
-            with open("system_prompts/clinical_checklist_agent.md", "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        except FileNotFoundError:
-            self.system_instruction = "Audit the transcript for clinical-legal compliance and standard of care."
+        self.system_instruction = load_prompt("clinical_checklist_agent.md", "Audit the transcript for clinical-legal compliance and standard of care.")
 
     async def generate_checklist(self, transcript, diagnosis, question_list, analytics, education_list):
         if not transcript: return []
@@ -875,15 +970,10 @@ class ClinicalChecklistAgent(BaseLogicAgent):
                 f"TRANSCRIPT TO EVALUATE:\n{json.dumps(transcript)}"
             )
 
-            response = await self.client.aio.models.generate_content(
+            response = await self._generate(
                 model="gemini-2.5-flash-lite",
                 contents=user_content,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    response_schema=self.response_schema,
-                    system_instruction=self.system_instruction,
-                    temperature=0.0
-                )
+                temperature=0.0
             )
             return json.loads(response.text)
         except Exception as e:
@@ -925,12 +1015,7 @@ class QuestionRanker(BaseLogicAgent):
         }
         
         # Load the prompt
-        try:
-            with open("system_prompts/question_ranker.md", "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        except FileNotFoundError:
-            # Fallback prompt if file is missing
-            self.system_instruction = "Rank the questions based on the transcript context."
+        self.system_instruction = load_prompt("question_ranker.md", "Rank the questions based on the transcript context.")
 
     async def rank_questions(self, transcript: str, question_pool: list):
         """
@@ -944,15 +1029,10 @@ class QuestionRanker(BaseLogicAgent):
                 f"**Current Transcript:**\n{transcript}"
             )
 
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash-lite", 
+            response = await self._generate(
+                model="gemini-2.5-flash-lite",
                 contents=input_content,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json", 
-                    response_schema=self.response_schema, 
-                    system_instruction=self.system_instruction, 
-                    temperature=0.1  # Low temp for deterministic sorting
-                )
+                temperature=0.1  # Low temp for deterministic sorting
             )
             
             res = json.loads(response.text)
@@ -971,11 +1051,7 @@ class ComprehensiveReportAgent(BaseLogicAgent):
         super().__init__()
         
         # 1. Load System Prompt from file
-        try:
-            with open("system_prompts/comprehensive_report_agent.md", "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        except FileNotFoundError:
-            self.system_instruction = "Synthesize the provided clinical data and transcript into a structured medical report."
+        self.system_instruction = load_prompt("comprehensive_report_agent.md", "Synthesize the provided clinical data and transcript into a structured medical report.")
 
         # 2. Define Response Schema
         self.response_schema = {
@@ -1045,15 +1121,10 @@ class ComprehensiveReportAgent(BaseLogicAgent):
         )
 
         try:
-            response = await self.client.aio.models.generate_content(
+            response = await self._generate(
                 model="gemini-2.5-flash-lite",
                 contents=user_content,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    response_schema=self.response_schema,
-                    system_instruction=self.system_instruction,
-                    temperature=0.0
-                )
+                temperature=0.0
             )
             return json.loads(response.text)
             
@@ -1078,12 +1149,7 @@ class QuestionIntegrationGatekeeper(BaseLogicAgent):
         }
         
         # Load the prompt
-        try:
-            with open("system_prompts/integration_gatekeeper.md", "r", encoding="utf-8") as f:
-                self.system_instruction = f.read()
-        except FileNotFoundError:
-            # Fallback prompt
-            self.system_instruction = "Compare the new questions against the history. Return only the non-redundant ones as a JSON array of strings."
+        self.system_instruction = load_prompt("integration_gatekeeper.md", "Compare the new questions against the history. Return only the non-redundant ones as a JSON array of strings.")
 
     async def filter_new_questions(self, new_candidates: list[str], existing_history: list[str]):
         """
@@ -1111,15 +1177,10 @@ class QuestionIntegrationGatekeeper(BaseLogicAgent):
                 f"**New Candidate Questions:**\n{json.dumps(new_candidates, indent=2)}"
             )
 
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash-lite", 
+            response = await self._generate(
+                model="gemini-2.5-flash-lite",
                 contents=input_content,
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json", 
-                    response_schema=self.response_schema, 
-                    system_instruction=self.system_instruction, 
-                    temperature=0.0  # Zero temp for strict logical filtering
-                )
+                temperature=0.0  # Zero temp for strict logical filtering
             )
             
             # Parse the response
@@ -1146,8 +1207,9 @@ class ConsultationTranscriber(BaseLogicAgent):
     """
     Agent responsible for converting Full Audio -> Structured Diarized Text (JSON)
     """
-    def __init__(self):
+    def __init__(self, audio_format=None):
         super().__init__()
+        self.audio_format = audio_format      # None: TRANSCRIBE_AUDIO_FORMAT at call time (see encode_pcm)
         self.response_schema = {
             "type": "ARRAY",
             "items": {
@@ -1175,27 +1237,82 @@ class ConsultationTranscriber(BaseLogicAgent):
         4. Return the result strictly as a structured JSON list.
         """
 
-    async def transcribe_audio(self, audio_file_path):
+    @staticmethod
+    def encode_pcm(pcm, sample_rate=16000, channels=1, audio_format=None):
+        """
+        Builds an audio container in memory from 16-bit PCM.
+        :param pcm: bytes-like object, or an iterable of bytes-like chunks (e.g. an AudioSnapshot).
+        :param audio_format: "flac" (lossless, ~half the size) or "wav";
+                             None reads TRANSCRIBE_AUDIO_FORMAT (default "flac") on each call.
+        :return: (container_bytes, mime_type)
+        """
+        if audio_format is None:
+            audio_format = os.getenv("TRANSCRIBE_AUDIO_FORMAT", "flac")
+        chunks = [pcm] if isinstance(pcm, (bytes, bytearray, memoryview)) else list(pcm)
+
+        if audio_format == "flac" and FLAC_AVAILABLE:
+            samples = np.concatenate([np.frombuffer(c, dtype="<i2") for c in chunks]) if chunks else np.zeros(0, dtype="<i2")
+            buf = io.BytesIO()
+            sf.write(buf, samples.reshape(-1, channels), sample_rate, format="FLAC", subtype="PCM_16")
+            return buf.getvalue(), "audio/flac"
+
+        buf = io.BytesIO()
+        with wave.open(buf, "wb") as wf:
+            wf.setnchannels(channels)
+            wf.setsampwidth(2) # 2 bytes = 16 bit
+            wf.setframerate(sample_rate)
+            for c in chunks:
+                wf.writeframesraw(c)
+        return buf.getvalue(), "audio/wav"
+
+    async def transcribe_pcm(self, pcm, sample_rate=16000, channels=1, context=None, speaker_hints=None):
+        """Transcribes raw PCM frames without touching the disk (see encode_pcm)."""
+        audio_bytes, mime_type = self.encode_pcm(pcm, sample_rate, channels, self.audio_format)
+        return await self.transcribe_audio(audio_bytes, context=context, mime_type=mime_type, speaker_hints=speaker_hints)
+
+    async def transcribe_audio(self, audio, context=None, mime_type="audio/wav", speaker_hints=None):
+        """
+        :param audio: Path to an audio file, or the encoded container bytes.
+        :param context: Optional list of already transcribed turns preceding this audio.
+                        When given, the audio is treated as a continuation segment and the
+                        turns are only used for speaker continuity (they are not repeated).
+        :param speaker_hints: Optional known speaker timeline [(role, start_sec, end_sec)]
+                              relative to the start of this audio (e.g. server-side loopback).
+        """
         try:
             # FIX: Vertex AI cannot use client.files.upload.
-            # We must read the file bytes and send them INLINE.
-            
-            with open(audio_file_path, "rb") as f:
-                audio_bytes = f.read()
+            # We must send the audio bytes INLINE.
+            if isinstance(audio, (str, os.PathLike)):
+                with open(audio, "rb") as f:
+                    audio_bytes = f.read()
+            else:
+                audio_bytes = bytes(audio)
+
+            if context:
+                prompt = (
+                    f"Previous turns (already transcribed, for speaker continuity only - do NOT repeat them):\n"
+                    f"{json.dumps(context)}\n\n"
+                    "Transcribe this segment of the consultation. "
+                    "The first seconds may overlap with the end of the previous turns."
+                )
+            else:
+                prompt = "Transcribe the full consultation."
+
+            if speaker_hints:
+                timeline = "; ".join(f"{start:.1f}-{end:.1f}s {role}" for role, start, end in speaker_hints)
+                prompt += (
+                    f"\n\nKnown speaker timeline (seconds from the start of this audio): {timeline}. "
+                    "Use it to attribute each turn to the right speaker."
+                )
 
             # Generate content with Inline Audio
-            response = await self.client.aio.models.generate_content(
-                model="gemini-2.5-flash", 
+            response = await self._generate(
+                model="gemini-2.5-flash",
                 contents=[
-                    types.Part.from_bytes(data=audio_bytes, mime_type="audio/wav"),
-                    "Transcribe the full consultation."
+                    types.Part.from_bytes(data=audio_bytes, mime_type=mime_type),
+                    prompt
                 ],
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json", 
-                    response_schema=self.response_schema, 
-                    system_instruction=self.system_instruction, 
-                    temperature=0.0
-                )
+                temperature=0.0
             )
             
             res = json.loads(response.text)
@@ -0,0 +1,140 @@
+# --- audio_buffer.py ---
+import os
+import mmap
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger("medforce-backend")
+
+# 64 KiB is a multiple of mmap.ALLOCATIONGRANULARITY on Linux (4 KiB) and Windows (64 KiB),
+# so every chunk can be mapped on its own from the spill file.
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_RAM_BYTES = int(os.getenv("AUDIO_BUFFER_MAX_RAM_MB", "8")) * 1024 * 1024
+
+
+class AudioSnapshot:
+    """
+    Read-only, zero-copy view over a byte range of an AudioBuffer.
+    Holds one memoryview per underlying chunk (RAM or memory-mapped).
+    """
+    def __init__(self, views):
+        self.views = views
+        self.nbytes = sum(len(v) for v in views)
+
+    def __len__(self):
+        return self.nbytes
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def tobytes(self):
+        """Materializes the snapshot (copies). Only use when a contiguous buffer is required."""
+        return b"".join(self.views)
+
+
+class AudioBuffer:
+    """
+    Append-only PCM store made of fixed-size chunks.
+    - Snapshots are read-only memoryviews, nothing is copied while holding the lock.
+    - Once the in-RAM size exceeds 'max_ram_bytes', the oldest full chunks are
+      spilled to a temp file and served from memory-mapped pages instead.
+    """
+    def __init__(self, max_ram_bytes=DEFAULT_MAX_RAM_BYTES, chunk_size=CHUNK_SIZE, spill_dir=None):
+        if chunk_size % mmap.ALLOCATIONGRANULARITY:
+            raise ValueError(f"chunk_size must be a multiple of {mmap.ALLOCATIONGRANULARITY}")
+
+        self.max_ram_bytes = max_ram_bytes
+        self.chunk_size = chunk_size
+        self.spill_dir = spill_dir
+
+        self._chunks = []        # bytearray (RAM) or mmap (spilled), in order
+        self._ram_start = 0      # Index of the first chunk still held in RAM
+        self._length = 0
+        self._spill_file = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return self._length
+
+    @property
+    def ram_bytes(self):
+        with self._lock:
+            return (len(self._chunks) - self._ram_start) * self.chunk_size
+
+    @property
+    def spilled_bytes(self):
+        with self._lock:
+            return self._ram_start * self.chunk_size
+
+    def append(self, data):
+        data = memoryview(data).cast("B")
+        with self._lock:
+            pos = 0
+            while pos < len(data):
+                fill = self._length % self.chunk_size
+                if fill == 0:
+                    self._chunks.append(bytearray(self.chunk_size))
+
+                # Writing past the 'fill' mark never touches bytes exported by a snapshot,
+                # and the chunk is never resized, so open memoryviews stay valid.
+                n = min(self.chunk_size - fill, len(data) - pos)
+                self._chunks[-1][fill:fill + n] = data[pos:pos + n]
+                pos += n
+                self._length += n
+
+            self._spill_if_needed()
+
+    def snapshot(self, start=0, end=None):
+        """Returns an AudioSnapshot of [start:end], or None if the range is empty."""
+        with self._lock:
+            end = self._length if end is None else min(end, self._length)
+            if start >= end:
+                return None
+
+            views = []
+            first, last = start // self.chunk_size, (end - 1) // self.chunk_size
+            for idx in range(first, last + 1):
+                base = idx * self.chunk_size
+                lo = max(start - base, 0)
+                hi = min(end - base, self.chunk_size)
+                views.append(memoryview(self._chunks[idx])[lo:hi].toreadonly())
+            return AudioSnapshot(views)
+
+    def _spill_if_needed(self):
+        # Never spill the active (last) chunk, it is still being written.
+        while (len(self._chunks) - self._ram_start) * self.chunk_size > self.max_ram_bytes \
+                and self._ram_start < len(self._chunks) - 1:
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile(prefix="audio_spill_", dir=self.spill_dir)
+                logger.info(f"💽 [AudioBuffer] RAM ceiling reached ({self.max_ram_bytes} bytes), spilling to disk.")
+
+            idx = self._ram_start
+            offset = idx * self.chunk_size
+            self._spill_file.seek(offset)
+            self._spill_file.write(self._chunks[idx])
+            self._spill_file.flush()
+
+            # Snapshots taken earlier keep the old bytearray alive until they are released.
+            self._chunks[idx] = mmap.mmap(
+                self._spill_file.fileno(), self.chunk_size, offset=offset, access=mmap.ACCESS_READ
+            )
+            self._ram_start += 1
+
+    def close(self):
+        """Releases RAM chunks, mappings and the spill file."""
+        with self._lock:
+            for chunk in self._chunks:
+                if isinstance(chunk, mmap.mmap):
+                    try:
+                        chunk.close()
+                    except BufferError:
+                        # Still exported by a live snapshot; unmapped once it is released.
+                        pass
+            self._chunks = []
+            self._ram_start = 0
+            self._length = 0
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
@@ -0,0 +1,44 @@
+# --- audio_framing.py ---
+import struct
+import uuid
+
+# Binary websocket audio frame: fixed 32-byte little-endian header + raw payload.
+#   magic(4) version(1) format(1) speaker(1) flags(1) sample_rate(4) seq(4) turn_id(16)
+# Negotiated with {"audio": "binary"} in the start message; control events stay JSON text.
+MAGIC = b"MFAU"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBBII16s")
+HEADER_SIZE = HEADER.size
+
+FORMAT_PCM16_MONO = 1
+FORMAT_WAV = 3              # Chunk of a WAV file as stored (header included in the first chunk)
+
+OUTPUT_SAMPLE_RATE = 24000  # Live model output (and the scenario recordings)
+
+SPEAKERS = {"UNKNOWN": 0, "NURSE": 1, "PATIENT": 2, "SYSTEM": 3}
+SPEAKER_NAMES = {v: k for k, v in SPEAKERS.items()}
+
+FLAG_FIRST = 0x01           # First frame of a turn
+FLAG_FINAL = 0x02           # Last frame of a turn (may carry no payload when the end is only known afterwards)
+
+
+def speaker_code(speaker):
+    return SPEAKERS.get((speaker or "").upper(), 0)
+
+
+def encode_frame(payload, turn_id, speaker, seq, fmt=FORMAT_PCM16_MONO, sample_rate=OUTPUT_SAMPLE_RATE, flags=0):
+    """
+    :param turn_id: uuid.UUID or its string form.
+    :return: header + payload as one bytes object (ready for websocket.send_bytes).
+    """
+    if not isinstance(turn_id, uuid.UUID):
+        turn_id = uuid.UUID(str(turn_id))
+    header = HEADER.pack(MAGIC, VERSION, fmt, speaker_code(speaker), flags, sample_rate, seq & 0xFFFFFFFF, turn_id.bytes)
+    return header + bytes(payload)
+
+
+def negotiation_message(mode):
+    """Reply to the start message telling the client which audio framing is used."""
+    if mode == "binary":
+        return {"type": "audio_format", "mode": "binary", "version": VERSION, "header_bytes": HEADER_SIZE}
+    return {"type": "audio_format", "mode": "json"}
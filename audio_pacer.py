@@ -0,0 +1,103 @@
+# --- audio_pacer.py ---
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger("medforce-backend")
+
+PCM_BYTES_PER_SEC = 24000 * 2                                 # Live API output: 24 kHz, 16-bit mono
+PACER_LEAD_SEC = float(os.getenv("AUDIO_PACER_LEAD_SEC", "0.5"))  # Audio kept buffered ahead of client playback
+# How far generation may run ahead of what the client has heard before the next turn waits
+PACER_MAX_AHEAD_SEC = float(os.getenv("AUDIO_PACER_MAX_AHEAD_SEC", "8.0"))
+
+
+class AudioPacer:
+    """
+    Per-connection outbound scheduler.
+    The model receive loop only enqueues (never sleeps); a sender task releases messages
+    in order, pacing audio by its real PCM duration so the client holds at most
+    'lead_sec' of unplayed audio. Control messages queued behind audio keep their order.
+    """
+    def __init__(self, websocket, lead_sec=PACER_LEAD_SEC):
+        self.websocket = websocket
+        self.lead_sec = lead_sec
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._play_end = 0.0       # Monotonic time at which the client finishes what was sent
+        self._queued_sec = 0.0     # Audio queued but not sent yet
+        self._sent = asyncio.Event()
+        self.closed = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._sender(), name="audio-pacer")
+        return self
+
+    def put(self, message, duration=0.0):
+        """Queues a JSON dict or a binary frame; 'duration' is its playback length in seconds."""
+        if not self.closed:
+            self._queued_sec += duration
+            self._queue.put_nowait((message, duration))
+
+    def put_audio(self, message, pcm_len, bytes_per_sec=PCM_BYTES_PER_SEC):
+        self.put(message, pcm_len / bytes_per_sec)
+
+    @property
+    def ahead_sec(self):
+        """Seconds of audio generated but not yet played by the client (queued + in flight)."""
+        return self._queued_sec + max(0.0, self._play_end - time.monotonic())
+
+    async def wait_ahead(self, max_sec=PACER_MAX_AHEAD_SEC):
+        """Blocks a producer while more than 'max_sec' of audio is still unplayed."""
+        while not self.closed and self._task is not None and self.ahead_sec > max_sec:
+            self._sent.clear()
+            try:
+                await asyncio.wait_for(self._sent.wait(), timeout=self.ahead_sec - max_sec)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _sender(self):
+        while True:
+            message, duration = await self._queue.get()
+            try:
+                if message is None:
+                    return
+                if duration > 0:
+                    now = time.monotonic()
+                    if self._play_end < now:
+                        self._play_end = now   # Client ran dry (or first chunk): restart the clock
+                    delay = self._play_end - self.lead_sec - now
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    self._play_end += duration
+                    self._queued_sec -= duration
+
+                if isinstance(message, (bytes, bytearray)):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_json(message)
+            except Exception as e:
+                # Client is gone: stop sending, let producers finish without blocking
+                logger.warning(f"⚠️ [AudioPacer] Send failed, dropping queued output: {e}")
+                self.closed = True
+                return
+            finally:
+                self._queue.task_done()
+                self._sent.set()
+
+    async def drain(self):
+        """Waits until everything queued so far has been sent."""
+        if self._task is None or self.closed:
+            return
+        join = asyncio.ensure_future(self._queue.join())
+        await asyncio.wait({join, self._task}, return_when=asyncio.FIRST_COMPLETED)
+        join.cancel()
+
+    async def close(self):
+        """Sends what is queued, then stops the sender task."""
+        if self._task is None:
+            return
+        self.put(None)
+        self.closed = True
+        await asyncio.wait({self._task})
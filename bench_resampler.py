@@ -0,0 +1,70 @@
+# --- bench_resampler.py ---
+"""
+Micro-benchmark: resampler.StreamResampler vs audioop.ratecv on the live ingest chunk sizes.
+Usage: python bench_resampler.py [seconds_of_audio]
+"""
+import sys
+import time
+import numpy as np
+
+from resampler import StreamResampler, SIMULATION_RATE, FILE_RATE, TRANSCRIBER_RATE
+
+try:
+    import audioop
+    AUDIOOP_AVAILABLE = True
+except ImportError:
+    AUDIOOP_AVAILABLE = False  # Removed in Python 3.13
+
+
+REPEATS = 5   # Best of N, the per-chunk numbers are small enough for scheduler noise to matter
+
+
+def make_pcm(rate, channels, seconds):
+    t = np.arange(int(rate * seconds)) / rate
+    mono = 6000 * np.sin(2 * np.pi * 440 * t) + 2000 * np.sin(2 * np.pi * 3100 * t)
+    return np.repeat(mono.astype("<i2"), channels).tobytes()
+
+
+def run_numpy(pcm, chunk_bytes, in_rate, channels):
+    rs = StreamResampler(in_rate, TRANSCRIBER_RATE, in_channels=channels)
+    start = time.perf_counter()
+    for i in range(0, len(pcm), chunk_bytes):
+        rs.process(pcm[i:i + chunk_bytes])
+    return time.perf_counter() - start
+
+
+def run_audioop(pcm, chunk_bytes, in_rate, channels):
+    state = None
+    start = time.perf_counter()
+    for i in range(0, len(pcm), chunk_bytes):
+        data = pcm[i:i + chunk_bytes]
+        if channels > 1:
+            data = audioop.tomono(data, 2, 0.5, 0.5)
+        _, state = audioop.ratecv(data, 2, 1, in_rate, TRANSCRIBER_RATE, state)
+    return time.perf_counter() - start
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 60.0
+    cases = [
+        ("24k mono  (Live API chunk)", SIMULATION_RATE, 1, 1920),
+        ("24k mono  (websocket 8 KiB)", SIMULATION_RATE, 1, 8192),
+        ("44.1k st. (file 2000 B)", FILE_RATE, 2, 2000),
+        ("44.1k st. (file 16 KiB)", FILE_RATE, 2, 16384),
+    ]
+
+    print(f"Resampling {seconds:.0f}s of audio to {TRANSCRIBER_RATE} Hz mono\n")
+    print(f"{'case':30} {'impl':8} {'total ms':>10} {'us/chunk':>10} {'x realtime':>12}")
+    for name, rate, channels, chunk_bytes in cases:
+        pcm = make_pcm(rate, channels, seconds)
+        n_chunks = -(-len(pcm) // chunk_bytes)
+        impls = [("numpy", run_numpy)]
+        if AUDIOOP_AVAILABLE:
+            impls.append(("audioop", run_audioop))
+        for impl, fn in impls:
+            elapsed = min(fn(pcm, chunk_bytes, rate, channels) for _ in range(REPEATS))
+            print(f"{name:30} {impl:8} {elapsed * 1000:10.1f} {elapsed / n_chunks * 1e6:10.1f} {seconds / elapsed:12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,15 @@ import os
 from typing import List, Dict, Optional, Any
 
 class EducationPoolManager:
-    def __init__(self, storage_path: str = "education_pool.json"):
+    def __init__(self, storage_path: Optional[str] = "education_pool.json"):
+        # storage_path=None keeps the pool in memory only
         self.storage_path = storage_path
         self.pool: List[Dict[str, Any]] = []
         self._load_from_file()
 
     def _load_from_file(self):
         """Loads existing education points from the JSON file."""
-        if os.path.exists(self.storage_path):
+        if self.storage_path and os.path.exists(self.storage_path):
             try:
                 with open(self.storage_path, "r", encoding="utf-8") as f:
                     self.pool = json.load(f)
@@ -31,8 +32,9 @@ class EducationPoolManager:
         
         self.pool = list(dedup_dict.values())
 
-        with open(self.storage_path, "w", encoding="utf-8") as f:
-            json.dump(self.pool, f, indent=4)
+        if self.storage_path:
+            with open(self.storage_path, "w", encoding="utf-8") as f:
+                json.dump(self.pool, f, indent=4)
 
     def add_new_points(self, new_points: List[Dict[str, Any]]) -> None:
         """
@@ -0,0 +1,117 @@
+# --- engine_registry.py ---
+import os
+import time
+import secrets
+import logging
+import threading
+
+import session_store
+
+logger = logging.getLogger("medforce-backend")
+
+# How long a transcriber engine outlives its websocket, waiting for the client to reconnect
+RESUME_GRACE_SEC = float(os.getenv("ENGINE_RESUME_GRACE_SEC", "120"))
+
+
+class _Entry:
+    __slots__ = ("engine", "session", "owner", "detached_at", "timer")
+
+    def __init__(self, engine, session, owner):
+        self.engine = engine
+        self.session = session
+        self.owner = owner          # Task of the websocket handler the engine is attached to
+        self.detached_at = None
+        self.timer = None
+
+
+_entries = {}       # resume token -> _Entry
+_lock = threading.Lock()
+
+
+def register(engine, session, owner=None):
+    """Tracks a live engine; returns the resume token the client presents on reconnect."""
+    token = secrets.token_urlsafe(18)
+    with _lock:
+        _entries[token] = _Entry(engine, session, owner)
+    return token
+
+
+def detach(token, loop, owner=None, grace_sec=RESUME_GRACE_SEC):
+    """
+    Websocket dropped: keep the engine (and its session reference) alive for 'grace_sec'.
+    Returns False when the engine cannot be resumed (unknown token, consultation over),
+    in which case the caller stops it as before.
+    Returns True without doing anything when another connection took the engine over.
+    """
+    with _lock:
+        entry = _entries.get(token)
+        if entry is not None and owner is not None and entry.owner is not owner:
+            return True
+        if entry is None or not entry.engine.logic_thread.is_alive():
+            _entries.pop(token, None)
+            return False
+        entry.engine.detach()
+        entry.detached_at = time.time()
+        entry.timer = loop.call_later(grace_sec, _expire, token)
+    logger.info(f"⏸️ [EngineRegistry] Engine for session {entry.session.session_id} detached, resumable for {grace_sec:.0f}s.")
+    return True
+
+
+def reattach(token, owner=None):
+    """
+    Returns (engine, session) for the token's engine, or (None, None) if expired/unknown.
+    An engine still attached to another connection (one whose drop was not noticed yet)
+    is taken over: it stops sending there and that connection's handler task is cancelled.
+    """
+    with _lock:
+        entry = _entries.get(token)
+        if entry is None or not entry.engine.logic_thread.is_alive():
+            return None, None
+        previous, entry.owner = entry.owner, owner
+        if entry.detached_at is None:
+            away = None
+        else:
+            if entry.timer:
+                entry.timer.cancel()
+            away = time.time() - entry.detached_at
+            entry.detached_at = None
+            entry.timer = None
+
+    if away is None:
+        entry.engine.detach()
+        if previous is not None and previous is not owner and not previous.done():
+            previous.cancel()
+        logger.info(f"▶️ [EngineRegistry] Session {entry.session.session_id} taken over from a connection still attached.")
+    else:
+        logger.info(f"▶️ [EngineRegistry] Session {entry.session.session_id} resumed after {away:.1f}s.")
+    return entry.engine, entry.session
+
+
+def taken_over(token, owner):
+    """True when 'owner' registered or resumed the token's engine and another connection has it now."""
+    with _lock:
+        entry = _entries.get(token)
+        return entry is not None and entry.owner is not owner
+
+
+def active_for(session_id):
+    """Whether a running engine (attached or waiting for a resume) already serves 'session_id'."""
+    with _lock:
+        return any(e.session.session_id == session_id and e.engine.logic_thread.is_alive()
+                   for e in _entries.values())
+
+
+def forget(token):
+    with _lock:
+        _entries.pop(token, None)
+
+
+def _expire(token):
+    with _lock:
+        entry = _entries.get(token)
+        if entry is None or entry.detached_at is None:
+            return
+        del _entries[token]
+    logger.info(f"🧹 [EngineRegistry] Resume window over for session {entry.session.session_id}, stopping engine.")
+    entry.engine.stop()
+    session_store.release(entry.session)
@@ -1,8 +1,13 @@
 import os
 import json
 import logging
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
 from google.cloud import storage
-from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,18 +16,278 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("gcs-manager")
 
+# Patient profiles bucket used by the server endpoints and utils. Fixed, as before the shared layer:
+# the BUCKET_NAME env var only applies to GCSManager(bucket_name=None).
+BUCKET_NAME = "clinic_sim"
+PATIENT_PREFIX = "patient_profile"
+# HTTP connections kept open to storage.googleapis.com (sized for parallel admin/session traffic)
+GCS_POOL_SIZE = int(os.getenv("GCS_POOL_SIZE", "32"))
+GCS_MAX_RETRIES = int(os.getenv("GCS_MAX_RETRIES", "3"))
+# Read-through cache for small, rarely changing objects (patient profiles)
+GCS_CACHE_MB = float(os.getenv("GCS_CACHE_MB", "64"))
+GCS_CACHE_TTL_SEC = float(os.getenv("GCS_CACHE_TTL_SEC", "30"))   # Served without revalidation this long
+GCS_STREAM_CHUNK_BYTES = int(os.getenv("GCS_STREAM_CHUNK_BYTES", str(1024 * 1024)))
+# Blocking storage calls made from coroutines run in worker threads, at most this many at once
+GCS_ASYNC_CONCURRENCY = int(os.getenv("GCS_ASYNC_CONCURRENCY", "16"))
+
+# --- Shared Storage Layer ---
+# One lazily created client per process; its session gets a pooled adapter and
+# bucket handles are reused, so a request costs one HTTP round-trip, not client setup.
+_client = None
+_buckets = {}
+_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _lock:
+        if _client is None:
+            client = storage.Client(project=os.getenv("PROJECT_ID"))
+            adapter = HTTPAdapter(pool_connections=GCS_POOL_SIZE, pool_maxsize=GCS_POOL_SIZE, max_retries=GCS_MAX_RETRIES)
+            client._http.mount("https://", adapter)
+            _client = client
+        return _client
+
+
+def get_bucket(bucket_name=BUCKET_NAME):
+    client = get_client()
+    with _lock:
+        bucket = _buckets.get(bucket_name)
+        if bucket is None:
+            bucket = _buckets[bucket_name] = client.bucket(bucket_name)
+        return bucket
+
+
+def patient_path(pid, file_name=""):
+    return f"{PATIENT_PREFIX}/{pid}/{file_name}"
+
+
+def read_bytes(blob_name, bucket_name=BUCKET_NAME):
+    """Single GET. Returns None when the object does not exist."""
+    try:
+        return get_bucket(bucket_name).blob(blob_name).download_as_bytes()
+    except NotFound:
+        return None
+
+
+def read_text(blob_name, bucket_name=BUCKET_NAME):
+    data = read_bytes(blob_name, bucket_name)
+    return data.decode("utf-8") if data is not None else None
+
+
+class CachedBlob:
+    __slots__ = ("name", "data", "generation", "metageneration", "content_type", "updated", "validated_at")
+
+    def __init__(self, name, data, generation, metageneration, content_type, updated=None):
+        self.name = name
+        self.data = data
+        self.generation = generation
+        self.metageneration = metageneration
+        self.content_type = content_type
+        self.updated = updated
+        self.validated_at = time.monotonic()
+
+    @property
+    def etag(self):
+        return etag_for(self.generation, self.metageneration)
+
+
+class BlobCache:
+    """
+    LRU over object bytes with a byte budget. Entries younger than 'ttl' are served as is;
+    older ones are revalidated with a metadata GET (generation/metageneration) and only
+    downloaded again, pinned to that generation, when the object changed. A miss is a
+    single download; its generation comes from the response headers.
+    Writes through this module invalidate at once.
+    """
+    def __init__(self, max_bytes=int(GCS_CACHE_MB * 1024 * 1024), ttl=GCS_CACHE_TTL_SEC):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()    # (bucket, name) -> CachedBlob
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._invalidations = 0          # Bumped on invalidate, a download racing a write is not stored
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def get(self, blob_name, bucket_name=BUCKET_NAME):
+        """Returns a CachedBlob, or None when the object does not exist."""
+        key = (bucket_name, blob_name)
+        with self._lock:
+            epoch = self._invalidations
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if time.monotonic() - entry.validated_at < self.ttl:
+                    self.hits += 1
+                    return entry
+
+        if entry is None:
+            blob = get_bucket(bucket_name).blob(blob_name)
+        else:
+            blob = get_bucket(bucket_name).get_blob(blob_name)
+            if blob is None:
+                self.invalidate(blob_name, bucket_name)
+                return None
+            if str(blob.generation) == str(entry.generation) and str(blob.metageneration) == str(entry.metageneration):
+                entry.validated_at = time.monotonic()
+                entry.updated = blob.updated
+                self.revalidated += 1
+                return entry
+
+        try:
+            # Pinned to the generation just looked up; on a miss, generation and
+            # metageneration are filled in from the download's response headers
+            data = blob.download_as_bytes()
+        except NotFound:
+            self.invalidate(blob_name, bucket_name)
+            return None
+        self.misses += 1
+        entry = CachedBlob(blob_name, data, blob.generation, blob.metageneration, blob.content_type, blob.updated)
+        self._store(key, entry, epoch)
+        return entry
+
+    def _store(self, key, entry, epoch):
+        size = len(entry.data)
+        with self._lock:
+            if epoch != self._invalidations:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.data)
+            if size > self.max_bytes // 8:
+                return      # Large objects are not worth evicting the profiles for (nor is the stale version kept)
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.data)
+
+    def invalidate(self, blob_name, bucket_name=BUCKET_NAME):
+        with self._lock:
+            self._invalidations += 1
+            old = self._entries.pop((bucket_name, blob_name), None)
+            if old is not None:
+                self._bytes -= len(old.data)
+
+    def invalidate_prefix(self, prefix, bucket_name=BUCKET_NAME):
+        with self._lock:
+            self._invalidations += 1
+            for key in [k for k in self._entries if k[0] == bucket_name and k[1].startswith(prefix)]:
+                self._bytes -= len(self._entries.pop(key).data)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes,
+                    "hits": self.hits, "revalidated": self.revalidated, "misses": self.misses}
+
+
+cache = BlobCache()
+
+
+def etag_for(generation, metageneration):
+    """Strong validator of one object version (content and metadata)."""
+    return f'"{generation}-{metageneration}"'
+
+
+def stat(blob_name, bucket_name=BUCKET_NAME):
+    """Metadata GET (size, generation, updated, content type). None when missing."""
+    return get_bucket(bucket_name).get_blob(blob_name)
+
+
+def iter_range(blob, start, end, chunk_size=GCS_STREAM_CHUNK_BYTES):
+    """
+    Yields bytes [start, end] (inclusive) of 'blob' in ranged requests of at most 'chunk_size',
+    pinned to the blob's generation, so memory per download stays bounded by one chunk.
+    """
+    pinned = blob.bucket.blob(blob.name, generation=blob.generation)
+    position = start
+    while position <= end:
+        last = min(position + chunk_size - 1, end)
+        yield pinned.download_as_bytes(start=position, end=last, checksum=None)
+        position = last + 1
+
+
+def read_cached(blob_name, bucket_name=BUCKET_NAME):
+    """Cached read; returns a CachedBlob or None."""
+    return cache.get(blob_name, bucket_name)
+
+
+def write(blob_name, content, content_type="text/plain", bucket_name=BUCKET_NAME, only_if_new=False):
+    """
+    Uploads 'content'. With 'only_if_new', the upload is conditional (generation 0)
+    and returns False instead of overwriting an existing object.
+    """
+    blob = get_bucket(bucket_name).blob(blob_name)
+    try:
+        blob.upload_from_string(content, content_type=content_type, if_generation_match=0 if only_if_new else None)
+        return True
+    except PreconditionFailed:
+        return False
+    finally:
+        cache.invalidate(blob_name, bucket_name)
+
+
+def delete(blob_name, bucket_name=BUCKET_NAME):
+    """Single DELETE. Returns False when the object did not exist."""
+    try:
+        get_bucket(bucket_name).blob(blob_name).delete()
+        return True
+    except NotFound:
+        return False
+    finally:
+        cache.invalidate(blob_name, bucket_name)
+
+
+def delete_prefix(prefix, bucket_name=BUCKET_NAME):
+    """Deletes every object under 'prefix' (batched). Returns how many there were."""
+    blobs = list(get_bucket(bucket_name).list_blobs(prefix=prefix))
+    if blobs:
+        get_bucket(bucket_name).delete_blobs(blobs)
+    cache.invalidate_prefix(prefix, bucket_name)
+    return len(blobs)
+
+
+def list_blobs(prefix, delimiter=None, bucket_name=BUCKET_NAME):
+    return get_client().list_blobs(bucket_name, prefix=prefix, delimiter=delimiter)
+
+
+# --- Async Adapter ---
+_semaphores = {}     # event loop -> asyncio.Semaphore
+
+
+def _semaphore():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        sem = _semaphores.get(loop)
+        if sem is None:
+            sem = _semaphores[loop] = asyncio.Semaphore(GCS_ASYNC_CONCURRENCY)
+        return sem
+
+
+async def run_async(func, *args, **kwargs):
+    """Runs a blocking storage call off the event loop (bounded by GCS_ASYNC_CONCURRENCY)."""
+    async with _semaphore():
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+
+async def read_cached_async(blob_name, bucket_name=BUCKET_NAME):
+    return await run_async(read_cached, blob_name, bucket_name)
+
+
 class GCSManager:
     def __init__(self, bucket_name="clinic_sim"):
         """
-        Initializes the GCS Client.
+        Binds to the shared storage layer.
         If bucket_name is not passed, it looks for BUCKET_NAME in .env
         """
         self.project_id = os.getenv("PROJECT_ID")
-        self.bucket_name = bucket_name or os.getenv("BUCKET_NAME", "clinic_sim")
+        self.bucket_name = bucket_name or os.getenv("BUCKET_NAME", BUCKET_NAME)
         
         try:
-            self.storage_client = storage.Client(project=self.project_id)
-            self.bucket = self.storage_client.bucket(self.bucket_name)
+            self.storage_client = get_client()
+            self.bucket = get_bucket(self.bucket_name)
             logger.info(f"✅ Connected to GCS Bucket: {self.bucket_name}")
         except Exception as e:
             logger.error(f"❌ GCS Connection Failed: {e}")
@@ -34,14 +299,12 @@ class GCSManager:
         NOTE: This will CREATE a new file or OVERWRITE if it exists.
         """
         try:
-            blob = self.bucket.blob(blob_name)
-            
             # Handle JSON specifically
             if isinstance(content, dict) or isinstance(content, list):
                 content = json.dumps(content, indent=4)
                 content_type = "application/json"
             
-            blob.upload_from_string(content, content_type=content_type)
+            write(blob_name, content, content_type=content_type, bucket_name=self.bucket_name)
             logger.info(f"💾 Saved: gs://{self.bucket_name}/{blob_name}")
             return True
         except Exception as e:
@@ -53,12 +316,11 @@ class GCSManager:
         Reads a JSON file from the bucket and returns a Python Dictionary.
         """
         try:
-            blob = self.bucket.blob(blob_name)
-            content = blob.download_as_text()
+            content = read_text(blob_name, self.bucket_name)
+            if content is None:
+                logger.warning(f"⚠️ File not found: {blob_name}")
+                return None
             return json.loads(content)
-        except NotFound:
-            logger.warning(f"⚠️ File not found: {blob_name}")
-            return None
         except json.JSONDecodeError:
             logger.error(f"❌ Error decoding JSON in: {blob_name}")
             return None
@@ -71,18 +333,17 @@ class GCSManager:
         Reads a standard text/markdown file.
         """
         try:
-            blob = self.bucket.blob(blob_name)
-            return blob.download_as_text()
-        except NotFound:
-            logger.warning(f"⚠️ File not found: {blob_name}")
-            return None
+            content = read_text(blob_name, self.bucket_name)
+            if content is None:
+                logger.warning(f"⚠️ File not found: {blob_name}")
+            return content
         except Exception as e:
             logger.error(f"❌ Read Error: {e}")
             return None
 
     def list_files(self, prefix=None):
         """Lists files, optionally filtered by a folder prefix."""
-        blobs = self.storage_client.list_blobs(self.bucket_name, prefix=prefix)
+        blobs = list_blobs(prefix, bucket_name=self.bucket_name)
         return [blob.name for blob in blobs]
 
 # ==========================================
@@ -0,0 +1,202 @@
+# --- http_cache.py ---
+import os
+import gzip
+import json
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi.responses import Response
+
+logger = logging.getLogger("medforce-backend")
+
+# Optional brotli ("br") encoding, gzip is always available
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+    logger.warning("BROTLI : Not Available, responses fall back to gzip")
+
+COMPRESS_MIN_BYTES = int(os.getenv("HTTP_COMPRESS_MIN_BYTES", "1024"))   # Smaller bodies are sent as is
+GZIP_LEVEL = int(os.getenv("HTTP_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("HTTP_BROTLI_QUALITY", "5"))
+STATIC_CACHE_CONTROL = "no-cache"       # Always revalidate, but a matching ETag costs a 304 only
+
+
+def _accepted(headers):
+    """Accept-Encoding -> {coding: q}, refused codings (q=0) included."""
+    codings = {}
+    for part in (headers.get("accept-encoding") or "").split(","):
+        name, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            codings[name.lower()] = q
+    return codings
+
+
+def choose_encoding(headers):
+    """
+    Best content coding the client accepts: 'br', 'gzip' or None.
+    '*' covers codings not listed by name; one listed with q=0 stays refused.
+    """
+    accepted = _accepted(headers)
+
+    def ok(coding):
+        return accepted.get(coding, accepted.get("*", 0.0)) > 0
+
+    if BROTLI_AVAILABLE and ok("br"):
+        return "br"
+    if ok("gzip"):
+        return "gzip"
+    return None
+
+
+def compress(body, encoding, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+    if encoding == "br":
+        return brotli.compress(body, quality=brotli_quality)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+    return body
+
+
+def _strip_etag(tag):
+    tag = tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    tag = tag.strip('"')
+    # Encoded variants share the validator of their identity body
+    for suffix in ("-br", "-gzip"):
+        if tag.endswith(suffix):
+            return tag[:-len(suffix)]
+    return tag
+
+
+def not_modified(headers, etag=None, last_modified=None):
+    """
+    True when the client's copy is current. If-None-Match wins over If-Modified-Since (RFC 9110);
+    ETags compare weakly, so compressed variants match their base.
+    """
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag is None:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        wanted = _strip_etag(etag)
+        return any(_strip_etag(tag) == wanted for tag in if_none_match.split(","))
+
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def validators(etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers["ETag"] = etag
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+    return headers
+
+
+def not_modified_response(etag=None, last_modified=None, extra_headers=None):
+    return Response(status_code=304, headers={**validators(etag, last_modified), **(extra_headers or {})})
+
+
+def response_encoding(request_headers, size):
+    """Coding negotiated_response() picks for a body of 'size' bytes (None = identity)."""
+    return choose_encoding(request_headers) if size >= COMPRESS_MIN_BYTES else None
+
+
+def variant_etag(etag, encoding):
+    """ETag of the encoded variant: a strong tag gets the coding appended ('"x"' -> '"x-gzip"')."""
+    if not etag or not encoding or etag.startswith("W/"):
+        return etag
+    return etag[:-1] + f'-{encoding}"'
+
+
+def negotiated_response(request_headers, body, media_type, headers=None, status_code=200):
+    """
+    Response with 'body' (bytes) compressed when it is large enough and the client accepts it.
+    A strong ETag in 'headers' gets the coding appended so variants stay distinguishable
+    (a 304 for the same request uses variant_etag(etag, response_encoding(...)) likewise).
+    """
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    encoding = response_encoding(request_headers, len(body))
+    if encoding:
+        body = compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+        if "ETag" in headers:
+            headers["ETag"] = variant_etag(headers["ETag"], encoding)
+    return Response(content=body, media_type=media_type, headers=headers, status_code=status_code)
+
+
+def json_response(request_headers, content, status_code=200):
+    """JSONResponse equivalent going through negotiated_response."""
+    body = json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return negotiated_response(request_headers, body, "application/json", status_code=status_code)
+
+
+class StaticAsset:
+    """
+    A file kept in memory with precomputed gzip/brotli variants and a content ETag.
+    The file's mtime is checked per request, so edits are picked up without a restart.
+    """
+    def __init__(self, path, media_type):
+        self.path = path
+        self.media_type = media_type
+        self._mtime = None
+        self._variants = {}       # encoding (None = identity) -> bytes
+        self.etag = None
+        self.last_modified = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime_ns     # Raises FileNotFoundError when missing
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            with open(self.path, "rb") as f:
+                body = f.read()
+            variants = {None: body, "gzip": compress(body, "gzip", gzip_level=9)}
+            if BROTLI_AVAILABLE:
+                variants["br"] = compress(body, "br", brotli_quality=11)
+            self._variants = variants
+            self.etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+            self.last_modified = datetime.fromtimestamp(mtime // 1_000_000_000, tz=timezone.utc)
+            self._mtime = mtime
+            logger.info(f"📄 [HttpCache] Loaded {self.path} ({len(body)} B, gzip {len(variants['gzip'])} B"
+                        f"{', br ' + str(len(variants['br'])) + ' B' if 'br' in variants else ''}).")
+
+    def response(self, request_headers):
+        self._load()
+        headers = {"Cache-Control": STATIC_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+        encoding = choose_encoding(request_headers)
+        if encoding not in self._variants:
+            encoding = None
+        # The 304 repeats the validator of the variant this request would get
+        etag = variant_etag(self.etag, encoding)
+        if not_modified(request_headers, self.etag, self.last_modified):
+            return not_modified_response(etag, self.last_modified, headers)
+
+        body = self._variants[encoding]
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        headers.update(validators(etag, self.last_modified))
+        return Response(content=body, media_type=self.media_type, headers=headers)
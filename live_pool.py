@@ -0,0 +1,239 @@
+# --- live_pool.py ---
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger("medforce-backend")
+
+POOL_SIZE = int(os.getenv("LIVE_POOL_SIZE", "1"))                       # Spare sessions kept per key
+POOL_MAX_AGE_SEC = float(os.getenv("LIVE_POOL_MAX_AGE_SEC", "300"))      # Idle sessions older than this are reopened
+POOL_KEY_TTL_SEC = float(os.getenv("LIVE_POOL_KEY_TTL_SEC", "120"))      # Keep refilling a persona this long after its last session closed
+POOL_MAX_KEYS = int(os.getenv("LIVE_POOL_MAX_KEYS", "16"))
+POOL_CHECK_SEC = float(os.getenv("LIVE_POOL_CHECK_SEC", "15"))
+
+
+class PooledSession:
+    """
+    One Live connection, held open by its own task (the connect context manager
+    is entered and exited there) until close() is called.
+    While idle, a watcher reads the connection: a GoAway, a close or a receive error
+    marks it dead and releases it, so a dropped spare is never handed out.
+    """
+    def __init__(self, key, agent):
+        self.key = key
+        self.created = time.monotonic()
+        self.session = None
+        self.dead = False
+        self._on_close = None
+        self._watcher = None
+        self._ready = asyncio.get_running_loop().create_future()
+        self._release = asyncio.Event()
+        self._task = asyncio.create_task(self._hold(agent), name=f"live-{agent.name}")
+
+    async def _hold(self, agent):
+        try:
+            async with agent.get_connection_context() as session:
+                self.session = session
+                self._ready.set_result(session)
+                self._watcher = asyncio.create_task(self._watch(session), name=f"live-watch-{agent.name}")
+                await self._release.wait()
+        except Exception as e:
+            self.dead = True
+            if not self._ready.done():
+                self._ready.set_exception(e)
+            else:
+                logger.warning(f"⚠️ [LivePool] Session {self.key[0]}/{self.key[1]} dropped: {e}")
+        finally:
+            if self._watcher:
+                self._watcher.cancel()
+
+    async def _watch(self, session):
+        """Idle health check; cancelled by checkout() before the session is handed out."""
+        try:
+            while True:
+                received = False
+                async for message in session.receive():
+                    received = True
+                    if getattr(message, "go_away", None) is not None:
+                        raise ConnectionError("server sent GoAway")
+                if not received:
+                    await asyncio.sleep(1.0)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.dead = True
+            logger.info(f"🔌 [LivePool] Idle session {self.key[0]}/{self.key[1]} closed ({e}), dropping it.")
+            self._release.set()
+
+    @property
+    def alive(self):
+        return not self.dead and not self._task.done()
+
+    def expired(self, max_age):
+        return time.monotonic() - self.created > max_age
+
+    async def wait_ready(self):
+        return await asyncio.shield(self._ready)
+
+    async def checkout(self):
+        """Stops the idle watcher so the caller owns the receive side. Returns False if the session died."""
+        await self.wait_ready()
+        if self._watcher:
+            self._watcher.cancel()
+            await asyncio.wait({self._watcher})
+            self._watcher = None
+        return self.alive
+
+    async def close(self):
+        self._release.set()
+        await asyncio.wait({self._task})
+        if self._ready.done() and not self._ready.cancelled():
+            self._ready.exception()     # Retrieved so a failed open is not reported as unhandled
+        if self._on_close:
+            on_close, self._on_close = self._on_close, None
+            on_close(self)
+
+
+class LiveSessionPool:
+    """
+    Warm Live sessions keyed by (speaker, voice, persona). acquire() hands out a ready
+    session (or the one still opening) and refills in the background; a session
+    is single-use since it accumulates conversation context.
+    """
+    def __init__(self, size=POOL_SIZE, max_age=POOL_MAX_AGE_SEC, key_ttl=POOL_KEY_TTL_SEC, max_keys=POOL_MAX_KEYS):
+        self.size = size
+        self.max_age = max_age
+        self.key_ttl = key_ttl
+        self.max_keys = max_keys
+        self._idle = {}                  # key -> [PooledSession] (opening or ready)
+        self._templates = OrderedDict()  # key -> (agent, last_used), LRU order
+        self._in_use = {}                # key -> sessions handed out and not closed yet
+        self._reaper = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(agent):
+        persona = hashlib.sha1(agent.system_instruction.encode("utf-8")).hexdigest()[:16]
+        return (agent.name, agent.voice_name, persona)
+
+    def _touch(self, key, agent):
+        self._templates[key] = (agent, time.monotonic())
+        self._templates.move_to_end(key)
+        while len(self._templates) > self.max_keys:
+            old_key, _ = self._templates.popitem(last=False)
+            self._discard(old_key)
+
+    def _discard(self, key):
+        for entry in self._idle.pop(key, []):
+            asyncio.create_task(entry.close())
+
+    def _fill(self, key):
+        agent, _ = self._templates[key]
+        idle = self._idle.setdefault(key, [])
+        while len(idle) < self.size:
+            idle.append(PooledSession(key, agent))
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_loop(), name="live-pool-reaper")
+
+    def _returned(self, entry):
+        """A handed-out session was closed: its key counts as used until now."""
+        self._in_use[entry.key] = self._in_use.get(entry.key, 1) - 1
+        if entry.key in self._templates:
+            agent, _ = self._templates[entry.key]
+            self._templates[entry.key] = (agent, time.monotonic())
+
+    def warm(self, agent):
+        """Registers a persona and starts opening its spare sessions."""
+        key = self.key_for(agent)
+        self._touch(key, agent)
+        self._fill(key)
+
+    async def acquire(self, agent):
+        """Returns a connected PooledSession for 'agent'; the caller close()s it when done."""
+        key = self.key_for(agent)
+        self._touch(key, agent)
+        idle = self._idle.setdefault(key, [])
+        missed = not any(e.alive and e.session is not None for e in idle)
+        if missed:
+            self.misses += 1
+            self._fill(key)     # The spare being opened now is the caller's session
+
+        while idle:
+            entry = idle.pop(0)
+            if entry.alive and not entry.expired(self.max_age):
+                try:
+                    if await entry.checkout():
+                        if not missed:
+                            self.hits += 1
+                        return self._hand_out(entry)
+                except Exception as e:
+                    logger.warning(f"⚠️ [LivePool] Warm session for {agent.name} failed: {e}")
+            asyncio.create_task(entry.close())
+
+        # Every spare failed: open one directly so the error reaches the caller
+        entry = PooledSession(key, agent)
+        try:
+            await entry.checkout()
+        except Exception:
+            await entry.close()
+            raise
+        return self._hand_out(entry)
+
+    def _hand_out(self, entry):
+        entry._on_close = self._returned
+        self._in_use[entry.key] = self._in_use.get(entry.key, 0) + 1
+        self._fill(entry.key)
+        return entry
+
+    async def acquire_all(self, *agents):
+        """Opens sessions for several agents concurrently; all or nothing."""
+        results = await asyncio.gather(*(self.acquire(a) for a in agents), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            await asyncio.gather(*(r.close() for r in results if isinstance(r, PooledSession)))
+            raise errors[0]
+        return results
+
+    async def _reap_loop(self):
+        while self._templates:
+            await asyncio.sleep(POOL_CHECK_SEC)
+            now = time.monotonic()
+            for key, (agent, last_used) in list(self._templates.items()):
+                if not self._in_use.get(key) and now - last_used > self.key_ttl:
+                    del self._templates[key]
+                    self._discard(key)
+                    continue
+                idle = self._idle.get(key, [])
+                for entry in [e for e in idle if not e.alive or e.expired(self.max_age)]:
+                    idle.remove(entry)
+                    asyncio.create_task(entry.close())
+                self._fill(key)
+
+    def stats(self):
+        ready = sum(1 for idle in self._idle.values() for e in idle if e.session is not None and e.alive)
+        in_use = sum(self._in_use.values())
+        return {"keys": len(self._templates), "ready": ready, "in_use": in_use, "hits": self.hits, "misses": self.misses}
+
+    async def close(self):
+        if self._reaper:
+            self._reaper.cancel()
+        entries = [e for idle in self._idle.values() for e in idle]
+        self._idle.clear()
+        self._templates.clear()
+        await asyncio.gather(*(e.close() for e in entries))
+        logger.info(f"🔌 [LivePool] Closed. {self.stats()}")
+
+
+_pool = None
+
+
+def get_pool():
+    """Process-wide pool, bound to the server's event loop."""
+    global _pool
+    if _pool is None:
+        _pool = LiveSessionPool()
+    return _pool
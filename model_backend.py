@@ -0,0 +1,377 @@
+# --- model_backend.py ---
+import os
+import glob
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import wave
+import contextlib
+import threading
+from google.genai import types
+
+import resampler
+import response_cache
+
+logger = logging.getLogger("medforce-backend")
+
+# MODEL_BACKEND = "live" (Vertex AI) | "record" (live + write fixtures) | "replay" (offline)
+BACKEND_MODE = os.getenv("MODEL_BACKEND", "live").lower()
+FIXTURE_DIR = os.getenv("MODEL_FIXTURE_DIR", "model_fixtures")
+SCENARIO_DIR = os.getenv("MODEL_SCENARIO_DIR", "scenario_dumps")
+
+# Replay latency: "recorded" | "fixed:<sec>" | "uniform:<lo>:<hi>" | "lognormal:<median>:<sigma>"
+REPLAY_LATENCY = os.getenv("MODEL_REPLAY_LATENCY", "recorded")
+REPLAY_LATENCY_SCALE = float(os.getenv("MODEL_REPLAY_LATENCY_SCALE", "1.0"))
+REPLAY_SEED = os.getenv("MODEL_REPLAY_SEED")
+DEFAULT_LATENCY = "lognormal:0.8:0.4"        # Used by "recorded" when a fixture has no timing
+
+LIVE_RATE = 24000                            # Live API audio output (16-bit mono)
+LIVE_CHUNK_SEC = 0.2
+LIVE_SEC_PER_WORD = 0.4
+
+# STT_BACKEND = "google" (streaming STT) | "replay" (final turns from scenario_dumps/transcript.json)
+STT_BACKEND = os.getenv("STT_BACKEND", "replay" if BACKEND_MODE == "replay" else "google").lower()
+STT_REPLAY_SPEED = float(os.getenv("STT_REPLAY_SPEED", "1.0"))   # >1 replays the dialogue faster than spoken
+STT_REPLAY_RATE = 16000
+
+# Agent class -> scenario_dumps files that can stand in for its response
+SCENARIO_SEEDS = {
+    "DiagnosisConsolidate": "diagnosis/*.json",
+    "QuestionEnrichmentAgent": "questions/*.json",
+    "ConsultationAnalyticAgent": "analytics/*.json",
+    "PatientEducationAgent": "education/*.json",
+    "ClinicalChecklistAgent": "checklist.json",
+    "ComprehensiveReportAgent": "report.json",
+    "ConsultationTranscriber": "transcript.json",
+}
+
+
+_SCHEMA_TYPES = {"OBJECT": dict, "ARRAY": list}
+
+
+def matches_schema(value, schema):
+    """Top-level type check of a seed against a response schema (OBJECT/ARRAY)."""
+    expected = _SCHEMA_TYPES.get(((schema or {}).get("type") or "").upper())
+    return expected is None or isinstance(value, expected)
+
+
+class LatencyModel:
+    """Samples synthetic response latencies (seconds) from a spec string."""
+    def __init__(self, spec=REPLAY_LATENCY, scale=REPLAY_LATENCY_SCALE, seed=REPLAY_SEED):
+        self.spec = spec
+        self.scale = scale
+        self.rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _sample_spec(self, spec):
+        kind, _, args = spec.partition(":")
+        params = [float(a) for a in args.split(":") if a]
+        if kind == "fixed":
+            return params[0]
+        if kind == "uniform":
+            return self.rng.uniform(params[0], params[1])
+        if kind == "lognormal":
+            return self.rng.lognormvariate(math.log(params[0]), params[1])
+        raise ValueError(f"Unknown latency spec: {spec}")
+
+    def sample(self, recorded=None):
+        with self._lock:
+            if self.spec == "recorded":
+                value = recorded if recorded is not None else self._sample_spec(DEFAULT_LATENCY)
+            else:
+                value = self._sample_spec(self.spec)
+        return max(0.0, value * self.scale)
+
+
+def synthesize(schema, name="value"):
+    """Minimal instance of a response schema (one item per array)."""
+    kind = (schema or {}).get("type", "STRING").upper()
+    if kind == "OBJECT":
+        return {k: synthesize(v, k) for k, v in schema.get("properties", {}).items()}
+    if kind == "ARRAY":
+        return [synthesize(schema.get("items", {}), name)]
+    if "enum" in schema:
+        return schema["enum"][0]
+    if kind == "BOOLEAN":
+        return False
+    if kind in ("INTEGER", "NUMBER"):
+        return 0
+    return f"<{name}>"
+
+
+def _turn_messages(text, audio_bytes):
+    """LiveServerMessages for one spoken turn: audio chunks, the transcription, then turn_complete."""
+    chunk = int(LIVE_RATE * LIVE_CHUNK_SEC) * 2
+    for i in range(0, audio_bytes, chunk):
+        yield types.LiveServerMessage(server_content=types.LiveServerContent(model_turn=types.Content(
+            parts=[types.Part(inline_data=types.Blob(data=bytes(min(chunk, audio_bytes - i)), mime_type=f"audio/pcm;rate={LIVE_RATE}"))]
+        )))
+    yield types.LiveServerMessage(server_content=types.LiveServerContent(output_transcription=types.Transcription(text=text)))
+    yield types.LiveServerMessage(server_content=types.LiveServerContent(turn_complete=True))
+
+
+class LiveBackend:
+    """Straight to Vertex AI."""
+    async def generate(self, agent, model, contents, config):
+        return await agent.client.aio.models.generate_content(model=model, contents=contents, config=config)
+
+    def live_connect(self, agent, model, config):
+        return agent.client.aio.live.connect(model=model, config=config)
+
+
+class RecordingLiveSession:
+    """Proxies a Live session and appends every completed turn to <fixture_dir>/live/<speaker>.jsonl."""
+    def __init__(self, session, path):
+        self.session = session
+        self.path = path
+        self._input = None
+        self._sent_at = None
+
+    async def send(self, *args, **kwargs):
+        self._input = kwargs.get("input", args[0] if args else None)
+        self._sent_at = time.perf_counter()
+        return await self.session.send(*args, **kwargs)
+
+    async def receive(self):
+        text, audio_bytes, first_byte = [], 0, None
+        async for response in self.session.receive():
+            if response.data:
+                audio_bytes += len(response.data)
+                if first_byte is None:
+                    first_byte = time.perf_counter() - (self._sent_at or time.perf_counter())
+            if response.server_content and response.server_content.output_transcription:
+                text.append(response.server_content.output_transcription.text or "")
+            if response.server_content and response.server_content.turn_complete:
+                entry = {"input": self._input if isinstance(self._input, str) else None,
+                         "text": "".join(text).strip(), "audio_bytes": audio_bytes, "latency": first_byte}
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+                text, audio_bytes, first_byte = [], 0, None
+            yield response
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+class RecordBackend(LiveBackend):
+    """Live calls, with every response written as a replay fixture."""
+    def __init__(self, fixture_dir=FIXTURE_DIR):
+        self.fixture_dir = fixture_dir
+
+    async def generate(self, agent, model, contents, config):
+        start = time.perf_counter()
+        response = await super().generate(agent, model, contents, config)
+        latency = time.perf_counter() - start
+
+        folder = os.path.join(self.fixture_dir, type(agent).__name__)
+        os.makedirs(folder, exist_ok=True)
+        key = response_cache.ResponseCache.make_key(model, config.system_instruction, contents, config.response_schema)
+        with open(os.path.join(folder, f"{key}.json"), "w", encoding="utf-8") as f:
+            json.dump({"model": model, "text": response.text, "latency": latency}, f, indent=2)
+        return response
+
+    @contextlib.asynccontextmanager
+    async def live_connect(self, agent, model, config):
+        folder = os.path.join(self.fixture_dir, "live")
+        os.makedirs(folder, exist_ok=True)
+        async with super().live_connect(agent, model, config) as session:
+            yield RecordingLiveSession(session, os.path.join(folder, f"{agent.name}.jsonl"))
+
+
+class FakeLiveSession:
+    """Offline stand-in for a Live session: replays recorded turns with silent audio."""
+    def __init__(self, backend, speaker):
+        self.backend = backend
+        self.speaker = speaker
+        self._queue = asyncio.Queue()
+
+    async def send(self, input=None, end_of_turn=True, **kwargs):
+        if end_of_turn:
+            await self._queue.put(input)
+
+    async def receive(self):
+        text_input = await self._queue.get()
+        entry = self.backend.next_live_turn(self.speaker, text_input)
+        await asyncio.sleep(self.backend.latency.sample(entry.get("latency")))
+        audio_bytes = entry.get("audio_bytes") or int(len(entry["text"].split()) * LIVE_SEC_PER_WORD * LIVE_RATE) * 2
+        for message in _turn_messages(entry["text"], audio_bytes):
+            yield message
+
+    async def close(self):
+        pass
+
+
+class ReplayBackend:
+    """
+    Offline responses. Lookup order for an agent call:
+    exact fixture (same key) -> any fixture of that agent (round-robin) -> scenario_dumps seed -> schema synthesis.
+    """
+    def __init__(self, fixture_dir=FIXTURE_DIR, scenario_dir=SCENARIO_DIR, latency=None):
+        self.fixture_dir = fixture_dir
+        self.scenario_dir = scenario_dir
+        self.latency = latency or LatencyModel()
+        self._pools = {}          # agent name -> list of fallback entries
+        self._cursors = {}        # agent / speaker -> round-robin position
+        self._live_turns = {}     # speaker -> (by_input, in_order)
+        self._spoken = []         # Turns emitted by a ReplayTranscriptSource, not transcribed yet
+        self._lock = threading.Lock()
+
+    def _fallback_pool(self, agent):
+        agent_name = type(agent).__name__
+        pool = self._pools.get(agent_name)
+        if pool is None:
+            pool = []
+            for path in sorted(glob.glob(os.path.join(self.fixture_dir, agent_name, "*.json"))):
+                with open(path, "r", encoding="utf-8") as f:
+                    pool.append(json.load(f))
+            if not pool and agent_name in SCENARIO_SEEDS:
+                for path in sorted(glob.glob(os.path.join(self.scenario_dir, SCENARIO_SEEDS[agent_name]))):
+                    with open(path, "r", encoding="utf-8") as f:
+                        text = f.read()
+                    # Dumps that are not shaped like the agent's response (e.g. a list where
+                    # the schema is an object) would hand the caller the wrong type
+                    if matches_schema(json.loads(text), agent.response_schema):
+                        pool.append({"text": text})
+                    else:
+                        logger.warning(f"⚠️ [ModelBackend] Seed {path} does not match the {agent_name} schema, skipped.")
+            self._pools[agent_name] = pool
+        return pool
+
+    def _next(self, name, pool):
+        pos = self._cursors.get(name, 0)
+        self._cursors[name] = pos + 1
+        return pool[pos % len(pool)]
+
+    def _lookup(self, agent, model, contents, config):
+        agent_name = type(agent).__name__
+        key = response_cache.ResponseCache.make_key(model, config.system_instruction, contents, config.response_schema)
+        try:
+            with open(os.path.join(self.fixture_dir, agent_name, f"{key}.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except OSError:
+            pass
+
+        with self._lock:
+            if agent_name == "ConsultationTranscriber" and self._spoken:
+                # Replayed dialogue: "transcribe" the turns spoken since the last call
+                spoken, self._spoken = self._spoken, []
+                return {"text": json.dumps(spoken)}
+            pool = self._fallback_pool(agent)
+            if pool:
+                return self._next(agent_name, pool)
+        return {"text": json.dumps(synthesize(agent.response_schema))}
+
+    def note_spoken_turn(self, role, message):
+        with self._lock:
+            self._spoken.append({"role": role, "message": message})
+
+    async def generate(self, agent, model, contents, config):
+        entry = self._lookup(agent, model, contents, config)
+        await asyncio.sleep(self.latency.sample(entry.get("latency")))
+        return response_cache.as_response(entry["text"])
+
+    def next_live_turn(self, speaker, text_input):
+        with self._lock:
+            turns = self._live_turns.get(speaker)
+            if turns is None:
+                turns = self._load_live_turns(speaker)
+                self._live_turns[speaker] = turns
+            by_input, in_order = turns
+            if isinstance(text_input, str) and text_input in by_input:
+                return by_input[text_input]
+            if in_order:
+                return self._next(f"live:{speaker}", in_order)
+        return {"text": "Okay."}
+
+    def _load_live_turns(self, speaker):
+        in_order = []
+        path = os.path.join(self.fixture_dir, "live", f"{speaker}.jsonl")
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                in_order = [json.loads(line) for line in f if line.strip()]
+        else:
+            # Seed from the scripted scenario: NURSE/PATIENT map onto the transcript roles
+            try:
+                with open(os.path.join(self.scenario_dir, "transcript.json"), "r", encoding="utf-8") as f:
+                    script = json.load(f)
+                in_order = [{"text": t["message"]} for t in script if t.get("role", "").upper() == speaker.upper()]
+            except (OSError, ValueError):
+                pass
+        by_input = {t["input"]: t for t in in_order if t.get("input")}
+        return by_input, in_order
+
+    @contextlib.asynccontextmanager
+    async def live_connect(self, agent, model, config):
+        yield FakeLiveSession(self, agent.name)
+
+
+class ReplayTranscriptSource:
+    """
+    Offline stand-in for the Google STT trigger: plays the scripted dialogue of
+    scenario_dumps/transcript.json into a TranscriberEngine, one final sentence per turn.
+    Each turn's audio (its WAV from the dump, else silence sized to the text) goes into the
+    engine's buffer, and the replay backend hands the turn text to ConsultationTranscriber.
+    """
+    def __init__(self, scenario_dir=SCENARIO_DIR, speed=STT_REPLAY_SPEED):
+        self.scenario_dir = scenario_dir
+        self.speed = speed
+        with open(os.path.join(scenario_dir, "transcript.json"), "r", encoding="utf-8") as f:
+            self.turns = [t for t in json.load(f) if t.get("message")]
+
+    def _turn_audio(self, turn):
+        """(pcm, sample_rate, channels, duration) of a turn."""
+        path = turn.get("audio_path")
+        if path and os.path.exists(path):
+            with wave.open(path, "rb") as wf:
+                pcm = resampler.to_int16(wf.readframes(wf.getnframes()), wf.getsampwidth())
+                return pcm, wf.getframerate(), wf.getnchannels(), wf.getnframes() / wf.getframerate()
+        duration = len(turn["message"].split()) * LIVE_SEC_PER_WORD
+        return bytes(int(duration * STT_REPLAY_RATE) * 2), STT_REPLAY_RATE, 1, duration
+
+    def run(self, engine):
+        """Blocking, runs in the engine's STT thread (like stt_loop)."""
+        engine.logic_thread.ready_event.wait()
+        backend = get_backend()
+        logger.info(f"🎞️ [ReplaySTT] Replaying {len(self.turns)} scripted turns (speed x{self.speed:g}).")
+        for turn in self.turns:
+            if not engine.running:
+                return
+            pcm, rate, channels, duration = self._turn_audio(turn)
+            time.sleep(duration / self.speed)
+            while engine.detached and engine.running:
+                time.sleep(0.5)
+
+            engine.add_audio(pcm, speaker=turn.get("role"), sample_rate=rate, channels=channels)
+            # Nothing reads the streaming-STT queue in replay
+            while not engine.audio_queue.empty():
+                engine.audio_queue.get_nowait()
+
+            if isinstance(backend, ReplayBackend):
+                backend.note_spoken_turn(turn.get("role", "Patient").capitalize(), turn["message"])
+            engine.transcript_memory.append(turn["message"])
+            print(f"\n✅ [FINAL SENTENCE]: {turn['message']}")
+            engine.logic_thread.notify_final_transcript()
+        logger.info("🎞️ [ReplaySTT] Script finished.")
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Process-wide backend selected by MODEL_BACKEND."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if BACKEND_MODE == "replay":
+                _backend = ReplayBackend()
+            elif BACKEND_MODE == "record":
+                _backend = RecordBackend()
+            else:
+                _backend = LiveBackend()
+            if BACKEND_MODE != "live":
+                logger.info(f"🎞️ [ModelBackend] {BACKEND_MODE} mode, fixtures in '{FIXTURE_DIR}'.")
+        return _backend
@@ -0,0 +1,96 @@
+# --- offline_consultation.py ---
+"""
+Runs one full consultation through the transcriber engine without any network:
+replayed model responses, the scripted dialogue of scenario_dumps/transcript.json as
+STT finals, and the local sample patient (scenario_dumps/patients).
+Covers run_initial_analysis, every _check_logic cycle and _final_wrap.
+
+Usage: python offline_consultation.py [patient_id] [replay_speed]
+       (MODEL_REPLAY_LATENCY / MODEL_REPLAY_SEED etc. apply as usual)
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+
+# Prompts, scenario dumps and sample patients are resolved relative to the repo
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+# Offline defaults, before the engine modules read their configuration
+os.environ.setdefault("MODEL_BACKEND", "replay")
+os.environ.setdefault("STT_BACKEND", "replay")
+os.environ.setdefault("PROJECT_ID", "offline")
+if len(sys.argv) > 2:
+    os.environ["STT_REPLAY_SPEED"] = sys.argv[2]
+else:
+    os.environ.setdefault("STT_REPLAY_SPEED", "4")
+
+import session_store
+from utils import fetch_gcs_text_async
+from transcriber_engine_new import TranscriberEngine
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+logger = logging.getLogger("medforce-backend")
+
+FINISH_TIMEOUT_SEC = 120.0      # After the script ends, wait this long for the report
+
+
+class RecordingWebSocket:
+    """Collects what the engine would send to the browser."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.messages = []        # (seconds since start, payload)
+        self.report = asyncio.Event()
+
+    async def send_json(self, payload):
+        self.messages.append((time.perf_counter() - self.start, payload))
+        if payload.get("type") == "report":
+            self.report.set()
+
+
+async def main(patient_id):
+    websocket = RecordingWebSocket()
+    session = session_store.acquire(f"offline-{patient_id}")
+    patient_info = await fetch_gcs_text_async(patient_id, "patient_info.md")
+
+    engine = TranscriberEngine(
+        patient_id=patient_id,
+        patient_info=patient_info,
+        websocket=websocket,
+        loop=asyncio.get_running_loop(),
+        session=session,
+    )
+    stt = threading.Thread(target=engine.stt_loop, daemon=True, name=f"STT_{patient_id}")
+    stt.start()
+
+    # Script played out: end the consultation unless the supervisor already did
+    while stt.is_alive():
+        await asyncio.sleep(0.2)
+    if not websocket.report.is_set():
+        engine.finish_consultation()
+    try:
+        await asyncio.wait_for(websocket.report.wait(), timeout=FINISH_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        logger.error("❌ [Offline] No report received.")
+    await asyncio.sleep(0.2)    # Let the outbound queue flush
+    engine.stop()
+    session_store.release(session)
+
+    counts = Counter(payload.get("type") for _, payload in websocket.messages)
+    first = {}
+    for at, payload in websocket.messages:
+        first.setdefault(payload.get("type"), at)
+    print("\n📊 Offline consultation summary")
+    print(f"   analysis cycles : {engine.logic_thread.check_count}")
+    print(f"   transcript turns: {len(engine.logic_thread.transcript_structure)}")
+    print(f"   wall time       : {time.perf_counter() - websocket.start:.1f}s")
+    for kind, count in sorted(counts.items(), key=lambda kv: first[kv[0]]):
+        print(f"   {kind:<12} {count:4d} messages, first at {first[kind]:6.2f}s")
+    return 0 if websocket.report.is_set() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(sys.argv[1] if len(sys.argv) > 1 else "P0001")))
@@ -0,0 +1,147 @@
+# --- outbound.py ---
+import os
+import copy
+import time
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+
+logger = logging.getLogger("medforce-backend")
+
+OUTBOUND_MAX_DEPTH = int(os.getenv("OUTBOUND_MAX_DEPTH", "64"))
+# Snapshot messages: a newer one replaces any still-queued one of the same type (latest wins)
+COALESCE_TYPES = frozenset(
+    t.strip() for t in os.getenv(
+        "OUTBOUND_COALESCE_TYPES", "questions,diagnosis,education,analytics,status,chat,checklist,report"
+    ).split(",") if t.strip()
+)
+
+
+class OutboundQueue:
+    """
+    Bounded per-connection send queue for UI pushes, fed from any thread.
+    Payloads are copied in put(), so the producer may keep mutating its structures.
+    Snapshot types are coalesced in place (the queued slot keeps its position and takes
+    the newest payload); other messages are queued in order. When the queue is full the
+    oldest non-snapshot message is dropped, so a slow client costs at most 'max_depth'
+    payloads and still gets the latest state.
+    """
+    def __init__(self, websocket, loop, max_depth=OUTBOUND_MAX_DEPTH, coalesce_types=COALESCE_TYPES, transform=None):
+        self.websocket = websocket
+        self.loop = loop
+        self.max_depth = max_depth
+        self.coalesce_types = coalesce_types
+        # Optional callable(payload) -> payload | None applied right before sending (None skips it)
+        self.transform = transform
+        self._pending = OrderedDict()     # slot key -> (payload, enqueued_at)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self.closed = False
+
+        # Metrics
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+        loop.call_soon_threadsafe(self._start)
+
+    def _start(self):
+        self._wakeup = asyncio.Event()
+        self._task = self.loop.create_task(self._sender())
+        if self._pending:
+            self._wakeup.set()
+
+    def put(self, payload):
+        """Thread-safe, never blocks. Sends a snapshot of 'payload' as it is now."""
+        if self.closed or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._enqueue, copy.deepcopy(payload), time.monotonic())
+
+    def _enqueue(self, payload, enqueued_at):
+        if self.closed:
+            return
+        kind = payload.get("type") if isinstance(payload, dict) else None
+        if kind in self.coalesce_types:
+            key = ("type", kind)
+            if key in self._pending:
+                self._pending[key] = (payload, self._pending[key][1])
+                self.coalesced += 1
+                return
+        else:
+            key = ("seq", next(self._seq))
+
+        self._pending[key] = (payload, enqueued_at)
+        while len(self._pending) > self.max_depth:
+            oldest = next((k for k in self._pending if k[0] == "seq"), None)
+            if oldest is None:
+                self._pending.popitem(last=False)
+            else:
+                del self._pending[oldest]
+            self.dropped += 1
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _sender(self):
+        while not self.closed:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            _, (payload, enqueued_at) = self._pending.popitem(last=False)
+            kind = payload.get("type") if isinstance(payload, dict) else None
+            try:
+                if self.transform:
+                    payload = self.transform(payload)
+            except Exception as e:
+                logger.error(f"UI Push Error: transforming '{kind}' failed, skipped: {e}")
+                continue
+            if payload is None:
+                continue
+            try:
+                await self.websocket.send_json(payload)
+            except (TypeError, ValueError) as e:
+                # Not serializable: this message is lost, the connection is fine
+                logger.error(f"UI Push Error: '{kind}' not sent: {e}")
+                continue
+            except Exception as e:
+                # Transport failure (disconnect, close already sent): stop sending
+                logger.error(f"UI Push Error: {e}")
+                self.closed = True
+                self._pending.clear()
+                return
+
+            lag = time.monotonic() - enqueued_at
+            self.sent += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "depth": self.depth,
+            "lag_avg_ms": round(1000 * self.lag_total / self.sent, 1) if self.sent else 0.0,
+            "lag_max_ms": round(1000 * self.lag_max, 1),
+        }
+
+    def close(self):
+        """Thread-safe; stops the sender, queued messages are discarded."""
+        def _close():
+            self.closed = True
+            self._pending.clear()
+            if self._wakeup:
+                self._wakeup.set()
+            logger.info(f"📤 [Outbound] Closed. {self.stats()}")
+
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(_close)
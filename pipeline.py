@@ -0,0 +1,116 @@
+# --- pipeline.py ---
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger("medforce-backend")
+
+
+class Stage:
+    def __init__(self, name, func, deps=(), essential=True):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        # Non-essential stages are dropped when the graph is superseded by a newer run
+        self.essential = essential
+
+
+class StageGraph:
+    """
+    Small declarative DAG of async stages.
+    Each stage starts as soon as all of its dependencies have finished and receives
+    their results as keyword arguments (named after the dependency).
+
+        graph = StageGraph("cycle")
+        graph.add("hepa", lambda: agent.get_hepa_diagnosis(...))
+        graph.add("consolidate", consolidate, deps=("hepa", "gen"))   # consolidate(hepa=..., gen=...)
+        results = await graph.run()
+
+    supersede() cancels running non-essential stages and skips the pending ones
+    (plus anything depending on a skipped stage). Finished results are kept.
+    """
+    def __init__(self, name="pipeline"):
+        self.name = name
+        self.stages = {}
+        self.results = {}
+        self.timings = {}     # name -> (start offset, duration) in seconds
+        self.skipped = []
+        self.superseded = False
+        self._running = {}
+
+    def add(self, name, func, deps=(), essential=True):
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' already defined")
+        missing = [d for d in deps if d not in self.stages]
+        if missing:
+            # Dependencies must be declared first, which also rules out cycles.
+            raise ValueError(f"Stage '{name}' depends on unknown stage(s): {missing}")
+        self.stages[name] = Stage(name, func, deps, essential)
+        return self
+
+    def supersede(self):
+        """Latest-wins: cancels the running non-essential stages. Returns their names."""
+        self.superseded = True
+        cancelled = []
+        for task, name in self._running.items():
+            if not self.stages[name].essential and not task.done():
+                task.cancel()
+                cancelled.append(name)
+        return cancelled
+
+    async def _run_stage(self, stage, t0):
+        start = time.perf_counter()
+        try:
+            return await stage.func(**{d: self.results[d] for d in stage.deps})
+        finally:
+            end = time.perf_counter()
+            self.timings[stage.name] = (start - t0, end - start)
+
+    async def run(self):
+        """
+        Runs the graph. The first failing stage cancels the others and re-raises.
+        Stages cancelled or skipped through supersede() are listed in 'skipped'.
+        """
+        t0 = time.perf_counter()
+        pending = dict(self.stages)
+        running = self._running
+
+        try:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if any(d in self.skipped for d in stage.deps) or (self.superseded and not stage.essential):
+                        self.skipped.append(name)
+                        del pending[name]
+                    elif all(d in self.results for d in stage.deps):
+                        running[asyncio.create_task(self._run_stage(stage, t0), name=f"{self.name}:{name}")] = name
+                        del pending[name]
+
+                if not running:
+                    continue
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    if task.cancelled():
+                        self.skipped.append(name)
+                    else:
+                        self.results[name] = task.result()
+        finally:
+            for task in running:
+                task.cancel()
+            running.clear()
+
+        return self.results
+
+    def wall_time(self):
+        """Total wall time of the graph (end of the last stage)."""
+        return max((start + dur for start, dur in self.timings.values()), default=0.0)
+
+    def log_timings(self):
+        lines = [
+            f"   {name:<12} {start:6.2f}s -> {start + dur:6.2f}s ({dur:.2f}s)"
+            for name, (start, dur) in sorted(self.timings.items(), key=lambda kv: kv[1][0])
+        ]
+        if self.skipped:
+            lines.append(f"   skipped (superseded): {', '.join(self.skipped)}")
+        logger.info(f"⏱️ [{self.name}] Stage timings (wall {self.wall_time():.2f}s):\n" + "\n".join(lines))
@@ -3,12 +3,17 @@ from typing import List, Dict, Optional, Any
 import json
 
 class QuestionPoolManager:
-    def __init__(self, initial_questions: List[Dict[str, Any]]):
+    def __init__(self, initial_questions: List[Dict[str, Any]], storage_path: Optional[str] = "question_pool.json"):
+        """
+        :param storage_path: JSON file the pool is persisted to (and loaded from when
+                             'initial_questions' is empty). None keeps the pool in memory only.
+        """
         self.questions = initial_questions
+        self.storage_path = storage_path
 
-        if initial_questions == []:
+        if initial_questions == [] and storage_path:
             try:
-                with open("question_pool.json", "r") as file:
+                with open(storage_path, "r") as file:
                     self.questions = json.load(file)
             except (FileNotFoundError, json.JSONDecodeError):
                 self.questions = []
@@ -19,7 +24,7 @@ class QuestionPoolManager:
     def _save_to_file(self):
         """
         Deduplicates questions by QID (keeping the latest version) 
-        and writes the cleaned list to question_pool.json.
+        and writes the cleaned list to the storage path (if any).
         """
         # 1. Deduplicate: Using a dictionary comprehension where QID is the key.
         # Since dictionaries preserve insertion order in modern Python, 
@@ -31,8 +36,9 @@ class QuestionPoolManager:
         self.questions = list(dedup_dict.values())
 
         # 3. Save to disk
-        with open("question_pool.json", "w", encoding="utf-8") as file:
-            json.dump(self.questions, file, indent=4)
+        if self.storage_path:
+            with open(self.storage_path, "w", encoding="utf-8") as file:
+                json.dump(self.questions, file, indent=4)
     
     def delete_by_content(self, content: str) -> bool:
         """
@@ -61,7 +67,9 @@ class QuestionPoolManager:
         return False
 
     def update_pool(self):
-        with open("question_pool.json", "r") as file:
+        if not self.storage_path:
+            return
+        with open(self.storage_path, "r") as file:
             self.questions = json.load(file)
 
     def add_from_strings(self, questions: List[str]) -> None:
@@ -155,15 +163,20 @@ class QuestionPoolManager:
         if not candidates:
             return None
 
+        # Questions added since the last ranking have no rank yet, they come last
+        def rank_of(q):
+            rank = q.get("rank")
+            return rank if rank is not None else float("inf")
+
         # Option 1: If a target rank is specified, find the first match
         if target_rank is not None:
             for q in candidates:
-                if q["rank"] == target_rank:
+                if q.get("rank") == target_rank:
                     return q
-            return min(candidates, key=lambda x: x["rank"])
+            return min(candidates, key=rank_of)
 
         # Option 2: Default behavior - return the one with the lowest rank number
-        return min(candidates, key=lambda x: x["rank"])
+        return min(candidates, key=rank_of)
 
     def get_questions_basic(self):
         return [
@@ -217,5 +230,5 @@ class QuestionPoolManager:
                 # explicitly overwritten in the enriched_item.
                 pool_map[qid].update(enriched_item)
 
-        # Persist the enriched data to question_pool.json
+        # Persist the enriched data to the storage path
         self._save_to_file()
\ No newline at end of file
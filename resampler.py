@@ -0,0 +1,120 @@
+# --- resampler.py ---
+import math
+import numpy as np
+
+# Shared rates of the audio ingest paths
+SIMULATION_RATE = 24000   # Gemini Live output (mono)
+FILE_RATE = 44100         # Scenario WAV files (stereo)
+TRANSCRIBER_RATE = 16000  # Google STT / ConsultationTranscriber (mono)
+
+
+
+def design_filter(up, down, half_width=10, beta=5.0):
+    """
+    Kaiser-windowed sinc low-pass for rational resampling by up/down
+    (same design as scipy.signal.resample_poly). Cutoff sits at the lower Nyquist.
+    """
+    max_rate = max(up, down)
+    cutoff = 1.0 / max_rate
+    half_len = half_width * max_rate
+    n = np.arange(-half_len, half_len + 1)
+    h = np.sinc(cutoff * n) * np.kaiser(2 * half_len + 1, beta)
+    return h * (up / h.sum())
+
+
+def to_int16(data, sampwidth):
+    """
+    Converts little-endian PCM of 'sampwidth' bytes per sample (WAV conventions: 8-bit is
+    unsigned, wider is signed) to int16 bytes by keeping the most significant 16 bits.
+    """
+    if sampwidth == 2:
+        return data
+    if sampwidth == 1:
+        x = np.frombuffer(data, dtype=np.uint8).astype(np.int16)
+        return ((x - 128) << 8).astype("<i2").tobytes()
+    if sampwidth in (3, 4):
+        frames = np.frombuffer(data, dtype=np.uint8, count=len(data) - len(data) % sampwidth).reshape(-1, sampwidth)
+        return np.ascontiguousarray(frames[:, -2:]).tobytes()    # Top two bytes are the int16 sample
+    raise ValueError(f"Unsupported sample width: {sampwidth} bytes")
+
+
+class StreamResampler:
+    """
+    Stateful, vectorized polyphase resampler for 16-bit PCM chunks.
+    - Keeps filter history and output phase across calls, so chunk boundaries are seamless.
+    - Interleaved multi-channel input is down-mixed to mono.
+    - Partial frames at the end of a chunk are carried over to the next call.
+    Per-chunk work is one matrix product plus a few ufuncs: at Live chunk sizes
+    (a few hundred samples) NumPy call overhead, not arithmetic, is the cost.
+    """
+    def __init__(self, in_rate, out_rate, in_channels=1):
+        g = math.gcd(in_rate, out_rate)
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.in_channels = in_channels
+        self.up = out_rate // g
+        self.down = in_rate // g
+
+        h = design_filter(self.up, self.down)
+        self.taps_per_phase = K = -(-len(h) // self.up)
+        h = np.concatenate([h, np.zeros(K * self.up - len(h))])
+        # polyphase[p, k] = h[p + (K - 1 - k) * up], taps reversed so that each output is a
+        # dot product with a forward window buf[base - K + 1 : base + 1].
+        # The 1/channels down-mix gain is folded in, so channels are only summed.
+        self.polyphase = np.ascontiguousarray(
+            h.reshape(K, self.up).T[:, ::-1] / in_channels, dtype=np.float32
+        )
+
+        # A cycle of 'up' outputs advances the input by exactly 'down' samples, and output j of a
+        # cycle always uses the same filter phase at the same offset. Only whole cycles are
+        # emitted (at most 'down' - 1 input samples wait for the next chunk), so one
+        # (span x up) block turns every chunk into a single (cycles x span) @ (span x up) product.
+        offsets = [(j * self.down) // self.up for j in range(self.up)]
+        self._block = np.zeros((offsets[-1] + K, self.up), dtype=np.float32)
+        for j, offset in enumerate(offsets):
+            self._block[offset:offset + K, j] = self.polyphase[(j * self.down) % self.up]
+        self.reset()
+
+    def reset(self):
+        # Input from the start of the next (not yet emitted) cycle's span; starts as the
+        # zero padding in front of the first sample
+        self._history = np.zeros(self.taps_per_phase - 1, dtype=np.float32)
+        self._pending = b""
+
+    def process(self, data):
+        """Resamples a chunk of int16 little-endian PCM. Returns mono int16 bytes."""
+        frame_size = 2 * self.in_channels
+        if self._pending:
+            data = self._pending + bytes(data)
+        usable = len(data) - len(data) % frame_size
+        self._pending = bytes(data[usable:])
+        if not usable:
+            return b""
+
+        x = np.frombuffer(data, dtype="<i2", count=usable // 2)
+        channels = self.in_channels
+        up, down = self.up, self.down
+        n_hist = len(self._history)
+        buf = np.empty(n_hist + len(x) // channels, dtype=np.float32)
+        buf[:n_hist] = self._history
+        if channels > 1:
+            # Down-mix straight into the buffer (strided adds beat a reshaped sum/mean)
+            mono = buf[n_hist:]
+            np.add(x[0::channels], x[1::channels], out=mono)
+            for c in range(2, channels):
+                mono += x[c::channels]
+        else:
+            buf[n_hist:] = x
+
+        span = len(self._block)
+        cycles = max(0, (len(buf) - span) // down + 1)
+        out = np.empty((cycles, up), dtype=np.float32)
+        if cycles:
+            # Row c is the input span of cycle c: buf[c * down:][:span]
+            spans = np.ndarray((cycles, span), dtype=np.float32, buffer=buf, strides=(4 * down, 4))
+            np.dot(spans, self._block, out=out)
+        self._history = buf[cycles * down:]
+
+        np.minimum(out, 32767, out=out)     # Plain ufuncs: np.clip's wrapper costs more than the clip
+        np.maximum(out, -32768, out=out)
+        return np.rint(out).astype("<i2").tobytes()
@@ -0,0 +1,184 @@
+# --- response_cache.py ---
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from google.genai import types
+
+logger = logging.getLogger("medforce-backend")
+
+# Opt-in: RESPONSE_CACHE = "off" | "memory" | "disk" (disk also keeps the in-memory LRU)
+CACHE_MODE = os.getenv("RESPONSE_CACHE", "off").lower()
+CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", ".response_cache")
+MEMORY_ENTRIES = int(os.getenv("RESPONSE_CACHE_MEMORY_ENTRIES", "512"))
+DISK_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_DISK_MB", "256")) * 1024 * 1024
+
+
+def _hash_update(h, obj):
+    """Feeds generate_content 'contents' (str, bytes, Part or lists of them) into a hash."""
+    if isinstance(obj, str):
+        h.update(b"s"); h.update(obj.encode("utf-8"))
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        h.update(b"b"); h.update(obj)
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[")
+        for item in obj:
+            _hash_update(h, item)
+        h.update(b"]")
+    elif isinstance(obj, types.Part) and obj.inline_data is not None:
+        h.update(b"p"); h.update((obj.inline_data.mime_type or "").encode()); h.update(obj.inline_data.data or b"")
+    elif hasattr(obj, "model_dump_json"):
+        h.update(b"m"); h.update(obj.model_dump_json(exclude_none=True).encode("utf-8"))
+    else:
+        h.update(b"j"); h.update(json.dumps(obj, sort_keys=True, default=str).encode("utf-8"))
+
+
+def _digest(obj):
+    h = hashlib.sha256()
+    _hash_update(h, obj)
+    return h.hexdigest()
+
+
+def as_response(text):
+    """Wraps cached text in a GenerateContentResponse so callers can keep using '.text'."""
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]))]
+    )
+
+
+class ResponseCache:
+    """
+    Memoizes deterministic (temperature 0) structured generations.
+    - Key: model + hashes of system instruction, contents and response schema.
+    - In-memory LRU of 'memory_entries' items, optionally backed by a directory of
+      JSON files evicted oldest-access-first once it grows past 'disk_max_bytes'.
+    """
+    def __init__(self, memory_entries=MEMORY_ENTRIES, disk_dir=None, disk_max_bytes=DISK_MAX_BYTES):
+        self.memory_entries = memory_entries
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(e.stat().st_size for e in os.scandir(disk_dir) if e.name.endswith(".json"))
+
+    @staticmethod
+    def make_key(model, system_instruction, contents, response_schema):
+        return _digest([model, _digest(system_instruction or ""), _digest(contents), _digest(response_schema or {})])
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def get(self, key):
+        """Returns the cached response text, or None."""
+        with self._lock:
+            text = self._memory.get(key)
+            if text is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return text
+
+        if self.disk_dir:
+            try:
+                with open(self._path(key), "r", encoding="utf-8") as f:
+                    text = json.load(f)["text"]
+                os.utime(self._path(key))   # Access time drives eviction
+            except (OSError, ValueError, KeyError):
+                text = None
+            if text is not None:
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._remember(key, text)
+                return text
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, text, model=None):
+        with self._lock:
+            self._remember(key, text)
+
+        if self.disk_dir:
+            path = self._path(key)
+            data = json.dumps({"model": model, "text": text})
+            try:
+                tmp = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(data)
+                old_size = os.path.getsize(path) if os.path.exists(path) else 0
+                os.replace(tmp, path)
+                with self._lock:
+                    self._disk_bytes += len(data.encode("utf-8")) - old_size
+                    over = self._disk_bytes > self.disk_max_bytes
+                if over:
+                    self._evict_disk()
+            except OSError as e:
+                logger.warning(f"⚠️ [ResponseCache] Disk write failed: {e}")
+
+    def _remember(self, key, text):
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        # Drop least recently used files down to 90% of the budget
+        entries = sorted(
+            (e for e in os.scandir(self.disk_dir) if e.name.endswith(".json")),
+            key=lambda e: e.stat().st_mtime
+        )
+        total = sum(e.stat().st_size for e in entries)
+        target = int(self.disk_max_bytes * 0.9)
+        removed = 0
+        for e in entries:
+            if total <= target:
+                break
+            try:
+                size = e.stat().st_size
+                os.remove(e.path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+        logger.info(f"🧹 [ResponseCache] Evicted {removed} file(s), disk usage {total} bytes.")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_bytes,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Process-wide cache according to RESPONSE_CACHE, or None when disabled."""
+    global _cache
+    if CACHE_MODE not in ("memory", "disk"):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(disk_dir=CACHE_DIR if CACHE_MODE == "disk" else None)
+            logger.info(f"🗃️ [ResponseCache] Enabled ({CACHE_MODE}).")
+        return _cache
@@ -3,19 +3,26 @@ import os
 import json
 import logging
 import traceback
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response, HTMLResponse
+from fastapi.responses import JSONResponse, Response, HTMLResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from google.cloud import storage
 from dotenv import load_dotenv
 import asyncio
 import threading
 from transcriber_engine_new import TranscriberEngine
-from utils import fetch_gcs_text_internal # Assuming this helper exists
+from utils import fetch_gcs_text_async
 # --- Local Modules ---
-from simulation import SimulationManager
+from simulation import SimulationManager, prewarm_live_sessions
 import simulation_scenario
+import session_store
+import audio_framing
+import live_pool
+import state_sync
+import engine_registry
+import gcs_manager
+import http_cache
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -35,6 +42,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Open spare Live sessions at startup so the first simulation does not pay the connect time
+LIVE_POOL_PREWARM = os.getenv("LIVE_POOL_PREWARM", "true").lower() == "true"
+
+@app.on_event("startup")
+async def warm_live_pool():
+    if LIVE_POOL_PREWARM:
+        try:
+            await prewarm_live_sessions()
+        except Exception as e:
+            logger.warning(f"⚠️ [LivePool] Prewarm failed: {e}")
+
+@app.on_event("shutdown")
+async def close_live_pool():
+    await live_pool.get_pool().close()
+
 # --- Pydantic Models ---
 
 class PatientFileRequest(BaseModel):
@@ -50,6 +72,26 @@ class AdminFileSaveRequest(BaseModel):
 class AdminPatientRequest(BaseModel):
     pid: str
 
+# --- Helpers ---
+
+async def start_loopback_engine(websocket: WebSocket, patient_id: str, session, loop, sync_mode=None):
+    """
+    Server-side loopback: a TranscriberEngine fed directly with the simulation's PCM
+    (see 'audio_sink'), pushing its updates to the same socket. The browser only listens.
+    """
+    patient_info = await fetch_gcs_text_async(patient_id, "patient_info.md")
+    engine = TranscriberEngine(
+        patient_id=patient_id,
+        patient_info=patient_info,
+        websocket=websocket,
+        loop=loop,
+        session=session,
+        sync_mode=sync_mode or state_sync.SYNC_FULL
+    )
+    threading.Thread(target=engine.stt_loop, daemon=True, name=f"STT_{patient_id}").start()
+    logger.info(f"🔁 Loopback transcriber attached for {patient_id} (session {session.session_id})")
+    return engine
+
 # --- Endpoints ---
 
 @app.websocket("/ws/simulation/audio")
@@ -60,6 +102,8 @@ async def websocket_simulation_audio_endpoint(websocket: WebSocket):
     await websocket.accept()
     
     manager = None 
+    engine = None
+    session = None
     try:
         # Wait for the initial configuration message
         data = await websocket.receive_json()
@@ -72,8 +116,25 @@ async def websocket_simulation_audio_endpoint(websocket: WebSocket):
             script_file = data.get("script_file", "scenario_script.json")
             
             logger.info(f"🎧 Starting Audio Simulation for {patient_id} using {script_file}")
+
+            # Optional: {"loopback": true} transcribes the scripted audio server-side
+            if data.get("loopback"):
+                try:
+                    session = session_store.acquire(data.get("session_id"))
+                except ValueError as e:
+                    await websocket.send_json({"type": "error", "message": str(e)})
+                    return
+                engine = await start_loopback_engine(websocket, patient_id, session, asyncio.get_running_loop(), data.get("sync"))
+            
+            # Optional: {"audio": "binary"} switches audio chunks to binary frames
+            audio_mode = "binary" if data.get("audio") == "binary" else "json"
+            await websocket.send_json(audio_framing.negotiation_message(audio_mode))
             
-            manager = simulation_scenario.SimulationAudioManager(websocket, patient_id, script_file="scenario_dumps/transcript.json")
+            manager = simulation_scenario.SimulationAudioManager(
+                websocket, patient_id, script_file="scenario_dumps/transcript.json",
+                audio_sink=engine.add_audio if engine else None,
+                binary_audio=audio_mode == "binary"
+            )
             await manager.run()
             
     except WebSocketDisconnect:
@@ -85,6 +146,11 @@ async def websocket_simulation_audio_endpoint(websocket: WebSocket):
         logger.error(f"Audio Simulation WebSocket Error: {e}")
         if manager:
             manager.stop()
+    finally:
+        if engine:
+            engine.stop()
+        if session:
+            session_store.release(session)
 
 @app.websocket("/ws/transcriber")
 async def websocket_transcriber_endpoint(websocket: WebSocket):
@@ -93,23 +159,18 @@ async def websocket_transcriber_endpoint(websocket: WebSocket):
     - Receives configuration (JSON) to start.
     - Receives raw audio (Bytes) to process.
     - Pushes AI updates (JSON) back to the frontend.
+    State lives in the session store (keyed by the start message's 'session_id'),
+    so one process can serve several consultations at once.
+    A dropped socket leaves the engine running for a grace period; a start message with
+    the returned 'resume_token' (and the client's state 'versions') reattaches to it.
     """
-    with open("questions.json", "r") as file:
-        # Load the contents into a Python dictionary or list
-        questions = json.load(file)
-    with open("question_pool.json", "w") as file:
-        # 'indent=4' makes the file human-readable
-        json.dump(questions, file, indent=4)
-
-    with open("education_pool.json", "w") as file:
-        # 'indent=4' makes the file human-readable
-        json.dump([], file, indent=4)
-
-
     await websocket.accept()
     
     main_loop = asyncio.get_running_loop()
+    owner = asyncio.current_task()      # Cancelled if a resuming connection takes the engine over
     engine = None
+    session = None
+    resume_token = None
 
     logger.info("🔌 Frontend connected to /ws/transcriber")
 
@@ -134,15 +195,53 @@ async def websocket_transcriber_endpoint(websocket: WebSocket):
                     # CASE B: Start Signal
                     elif data.get("type") == "start":
                         patient_id = data.get("patient_id", "P0001")
-                        logger.info(f"🚀 Starting Transcriber Engine for {patient_id}")
+
+                        resumed = False
+                        if engine is None and data.get("resume_token"):
+                            engine, resumed_session = engine_registry.reattach(data["resume_token"], owner)
+                            if engine:
+                                # The registry's session reference moves back to this socket
+                                if session is not None:
+                                    session_store.release(session)
+                                session = resumed_session
+                                resume_token = data["resume_token"]
+                                engine.attach(websocket, data.get("versions"))
+                                resumed = True
+
+                        if resumed:
+                            await websocket.send_json({
+                                "type": "system",
+                                "message": f"Transcriber resumed for {patient_id}",
+                                "session_id": session.session_id,
+                                "resume_token": resume_token,
+                                "resumed": True
+                            })
+                            continue
+
+                        if session is None:
+                            try:
+                                session = session_store.acquire(data.get("session_id"))
+                            except ValueError as e:
+                                await websocket.send_json({"type": "error", "message": str(e)})
+                                continue
+                        if engine_registry.active_for(session.session_id):
+                            # One engine per session; the running one is reached with its resume_token
+                            await websocket.send_json({"type": "error", "message": f"Session {session.session_id} already has a running transcriber"})
+                            session_store.release(session)
+                            session = None
+                            continue
+                        logger.info(f"🚀 Starting Transcriber Engine for {patient_id} (session {session.session_id})")
                         
-                        patient_info = fetch_gcs_text_internal(patient_id, "patient_info.md")
+                        patient_info = await fetch_gcs_text_async(patient_id, "patient_info.md")
                         
                         engine = TranscriberEngine(
                             patient_id=patient_id,
                             patient_info=patient_info,
                             websocket=websocket,
-                            loop=main_loop
+                            loop=main_loop,
+                            session=session,
+                            # Full snapshots unless the client applies patches ({"sync": "patch"})
+                            sync_mode=data.get("sync") or state_sync.SYNC_FULL
                         )
                         
                         stt_thread = threading.Thread(
@@ -152,11 +251,21 @@ async def websocket_transcriber_endpoint(websocket: WebSocket):
                         )
                         stt_thread.start()
                         
+                        resume_token = engine_registry.register(engine, session, owner)
+                        
                         await websocket.send_json({
                             "type": "system", 
-                            "message": f"Transcriber initialized for {patient_id}"
+                            "message": f"Transcriber initialized for {patient_id}",
+                            "session_id": session.session_id,
+                            "resume_token": resume_token,
+                            "resumed": False
                         })
 
+                    # CASE C: Client missed a state version {"type": "resync"}
+                    elif data.get("type") == "resync":
+                        if engine:
+                            engine.resync()
+
                 except json.JSONDecodeError:
                     logger.error("Received invalid JSON from frontend")
 
@@ -167,13 +276,28 @@ async def websocket_transcriber_endpoint(websocket: WebSocket):
 
     except WebSocketDisconnect:
         logger.info("👋 Frontend disconnected from /ws/transcriber")
+    except asyncio.CancelledError:
+        if not (resume_token and engine_registry.taken_over(resume_token, owner)):
+            raise
+        logger.info("👋 /ws/transcriber connection replaced by a resumed one")
+        try:
+            await websocket.close(code=4001)
+        except Exception:
+            pass
     except Exception as e:
         logger.error(f"❌ Transcriber WebSocket Error: {e}")
         traceback.print_exc()
     finally:
         if engine:
-            logger.info("🧹 Stopping Transcriber Engine...")
-            engine.stop()
+            if resume_token and engine.running and engine_registry.detach(resume_token, main_loop, owner):
+                session = None      # Reference now held by the registry until resume or expiry
+            else:
+                if resume_token:
+                    engine_registry.forget(resume_token)
+                logger.info("🧹 Stopping Transcriber Engine...")
+                engine.stop()
+        if session:
+            session_store.release(session)
 
 
 @app.websocket("/ws/simulation")
@@ -181,14 +305,32 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     
     manager = None 
+    engine = None
+    session = None
     try:
         data = await websocket.receive_json()
 
         if isinstance(data, dict) and data.get("type") == "start":
             patient_id = data.get("patient_id", "P0001")
             gender = data.get("gender", "Male")
+            try:
+                session = session_store.acquire(data.get("session_id"))
+            except ValueError as e:
+                await websocket.send_json({"type": "error", "message": str(e)})
+                return
+
+            # Optional: {"loopback": true} feeds the generated speech straight into a
+            # server-side TranscriberEngine instead of round-tripping through /ws/transcriber
+            if data.get("loopback"):
+                engine = await start_loopback_engine(websocket, patient_id, session, asyncio.get_running_loop(), data.get("sync"))
             
-            manager = SimulationManager(websocket, patient_id, gender)
+            # Optional: {"audio": "binary"} switches audio chunks to binary frames
+            audio_mode = "binary" if data.get("audio") == "binary" else "json"
+            await websocket.send_json(audio_framing.negotiation_message(audio_mode))
+            
+            manager = await SimulationManager.create(websocket, patient_id, gender, session=session,
+                                        audio_sink=engine.add_audio if engine else None,
+                                        binary_audio=audio_mode == "binary")
             await manager.run()
             
     except WebSocketDisconnect:
@@ -202,55 +344,125 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.error(f"WebSocket Error: {e}")
         if manager:
             manager.running = False
+    finally:
+        if engine:
+            engine.stop()
+        if session:
+            session_store.release(session)
+
+# Admin UI held in memory with gzip/brotli variants, revalidated through its ETag
+ADMIN_UI = http_cache.StaticAsset("admin_ui.html", "text/html")
 
 @app.get("/admin", response_class=HTMLResponse)
-async def get_admin_ui():
+async def get_admin_ui(request: Request):
     """Serves the Admin UI HTML file."""
     try:
         # Ensure admin_ui.html is in the same directory as server.py
-        with open("admin_ui.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
+        # (off the event loop: an edited file is re-read and recompressed)
+        return await run_in_threadpool(ADMIN_UI.response, request.headers)
     except FileNotFoundError:
         return HTMLResponse(content="<h1>Error: admin_ui.html not found on server.</h1>", status_code=404)
 
 
-@app.post("/api/get-patient-file")
-def get_patient_file(request: PatientFileRequest):
+TEXT_FILE_TYPES = {"json", "md", "txt"}     # Small profile files, served from the read-through cache
+
+
+def _media_type(file_ext, blob=None):
+    if file_ext in ['png', 'jpg', 'jpeg']:
+        return "image/png" if file_ext == 'png' else "image/jpeg"
+    return (blob.content_type if blob is not None else None) or "application/octet-stream"
+
+
+def _parse_range(header, size):
     """
-    Retrieves a file from gs://clinic_sim/patient_profile/{pid}/{file_name}
+    Single 'bytes=' range -> (start, end) inclusive; None to serve the whole file
+    (absent, malformed or multi-range); False when unsatisfiable (416).
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if first == "":
+            length = int(last)                       # Suffix range: last N bytes
+            if length <= 0 or size == 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def serve_patient_file(pid, file_name, request_headers):
     """
-    BUCKET_NAME = "clinic_sim"
-    blob_path = f"patient_profile/{request.pid}/{request.file_name}"
+    Text files come from the cache (compressed when large); anything else (or any Range request)
+    is streamed from GCS in GCS_STREAM_CHUNK_BYTES pieces with Range / Content-Length.
+    Both answer If-None-Match / If-Modified-Since with a 304 based on the object generation.
+    """
+    range_header = request_headers.get("range")
+    blob_path = gcs_manager.patient_path(pid, file_name)
     
-    logger.info(f"📥 Fetching GCS: gs://{BUCKET_NAME}/{blob_path}")
+    logger.info(f"📥 Fetching GCS: gs://{gcs_manager.BUCKET_NAME}/{blob_path}")
 
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(blob_path)
+        file_ext = file_name.lower().split('.')[-1]
+
+        if file_ext in TEXT_FILE_TYPES and not range_header:
+            # Read-through cache (revalidated by generation), a missing object comes back as None
+            cached = gcs_manager.read_cached(blob_path)
+            if cached is None:
+                logger.warning(f"File not found: {blob_path}")
+                return JSONResponse(
+                    status_code=404, 
+                    content={"error": "File not found", "path": blob_path}
+                )
+
+            if http_cache.not_modified(request_headers, cached.etag, cached.updated):
+                # Same validator as the (possibly compressed) 200 this request would get
+                encoding = http_cache.response_encoding(request_headers, len(cached.data))
+                return http_cache.not_modified_response(
+                    http_cache.variant_etag(cached.etag, encoding), cached.updated, {"Vary": "Accept-Encoding"}
+                )
+
+            media_type = "application/json" if file_ext == 'json' else "text/markdown"
+            return http_cache.negotiated_response(
+                request_headers, cached.data, media_type, headers=http_cache.validators(cached.etag, cached.updated)
+            )
 
-        if not blob.exists():
+        blob = gcs_manager.stat(blob_path)
+        if blob is None:
             logger.warning(f"File not found: {blob_path}")
             return JSONResponse(
                 status_code=404, 
                 content={"error": "File not found", "path": blob_path}
             )
 
-        file_ext = request.file_name.lower().split('.')[-1]
-
-        if file_ext == 'json':
-            content = blob.download_as_text()
-            return JSONResponse(content=json.loads(content))
-        elif file_ext in ['md', 'txt']:
-            content = blob.download_as_text()
-            return Response(content=content, media_type="text/markdown")
-        elif file_ext in ['png', 'jpg', 'jpeg']:
-            content = blob.download_as_bytes()
-            media_type = "image/png" if file_ext == 'png' else "image/jpeg"
-            return Response(content=content, media_type=media_type)
-        else:
-            content = blob.download_as_bytes()
-            return Response(content=content, media_type="application/octet-stream")
+        etag = gcs_manager.etag_for(blob.generation, blob.metageneration)
+        if http_cache.not_modified(request_headers, etag, blob.updated):
+            return http_cache.not_modified_response(etag, blob.updated)
+
+        size = blob.size or 0
+        headers = {"Accept-Ranges": "bytes", **http_cache.validators(etag, blob.updated)}
+
+        start, end, status_code = 0, size - 1, 200
+        byte_range = _parse_range(range_header, size)
+        if byte_range is False:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+
+        return StreamingResponse(
+            gcs_manager.iter_range(blob, start, end),
+            status_code=status_code,
+            media_type=_media_type(file_ext, blob),
+            headers=headers
+        )
 
     except Exception as e:
         logger.error(f"GCS API Error: {e}")
@@ -260,19 +472,31 @@ def get_patient_file(request: PatientFileRequest):
         )
 
 
+@app.post("/api/get-patient-file")
+def get_patient_file(request: PatientFileRequest, http_request: Request):
+    """
+    Retrieves a file from gs://clinic_sim/patient_profile/{pid}/{file_name}
+    """
+    return serve_patient_file(request.pid, request.file_name, http_request.headers)
+
+
+@app.get("/api/patient-file/{pid}/{file_name:path}")
+def get_patient_file_by_path(pid: str, file_name: str, http_request: Request):
+    """GET variant (usable as <img>/<audio> src, seekable through Range requests)."""
+    return serve_patient_file(pid, file_name, http_request.headers)
+
+
 # ==========================================
 # ADMIN ENDPOINTS
 # ==========================================
 
 @app.get("/api/admin/list-files/{pid}")
-def list_patient_files(pid: str):
+def list_patient_files(pid: str, request: Request):
     """Lists all files in GCS for a specific patient ID."""
-    BUCKET_NAME = "clinic_sim"
-    prefix = f"patient_profile/{pid}/"
+    prefix = gcs_manager.patient_path(pid)
     
     try:
-        storage_client = storage.Client()
-        blobs = storage_client.list_blobs(BUCKET_NAME, prefix=prefix)
+        blobs = gcs_manager.list_blobs(prefix)
         
         file_list = []
         for blob in blobs:
@@ -286,7 +510,7 @@ def list_patient_files(pid: str):
                     "updated": blob.updated.isoformat() if blob.updated else None
                 })
         
-        return JSONResponse(content={"files": file_list})
+        return http_cache.json_response(request.headers, {"files": file_list})
     except Exception as e:
         logger.error(f"List Files Error: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -294,16 +518,11 @@ def list_patient_files(pid: str):
 @app.post("/api/admin/save-file")
 def save_patient_file(request: AdminFileSaveRequest):
     """Creates or Updates a text-based file."""
-    BUCKET_NAME = "clinic_sim"
-    blob_path = f"patient_profile/{request.pid}/{request.file_name}"
+    blob_path = gcs_manager.patient_path(request.pid, request.file_name)
     
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(blob_path)
-        
         # Upload content (Text/Markdown/JSON)
-        blob.upload_from_string(request.content, content_type="text/plain")
+        gcs_manager.write(blob_path, request.content, content_type="text/plain")
         
         logger.info(f"💾 Saved file: {blob_path}")
         return JSONResponse(content={"message": "File saved successfully", "path": blob_path})
@@ -314,16 +533,10 @@ def save_patient_file(request: AdminFileSaveRequest):
 @app.delete("/api/admin/delete-file")
 def delete_patient_file(pid: str, file_name: str):
     """Deletes a file."""
-    BUCKET_NAME = "clinic_sim"
-    blob_path = f"patient_profile/{pid}/{file_name}"
+    blob_path = gcs_manager.patient_path(pid, file_name)
     
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(blob_path)
-        
-        if blob.exists():
-            blob.delete()
+        if gcs_manager.delete(blob_path):
             logger.info(f"🗑️ Deleted file: {blob_path}")
             return JSONResponse(content={"message": "File deleted successfully"})
         else:
@@ -334,15 +547,13 @@ def delete_patient_file(pid: str, file_name: str):
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.get("/api/admin/list-patients")
-def list_patients():
+def list_patients(request: Request):
     """Lists all 'folders' (prefixes) under patient_profile/"""
-    BUCKET_NAME = "clinic_sim"
-    prefix = "patient_profile/"
+    prefix = f"{gcs_manager.PATIENT_PREFIX}/"
     
     try:
-        storage_client = storage.Client()
         # Using delimiter='/' mimics directory listing
-        blobs = storage_client.list_blobs(BUCKET_NAME, prefix=prefix, delimiter="/")
+        blobs = gcs_manager.list_blobs(prefix, delimiter="/")
         
         # We must iterate over the iterator to populate .prefixes
         list(blobs) 
@@ -354,7 +565,7 @@ def list_patients():
             if parts:
                 patients.append(parts[-1])
                 
-        return JSONResponse(content={"patients": patients})
+        return http_cache.json_response(request.headers, {"patients": patients})
     except Exception as e:
         logger.error(f"List Patients Error: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
@@ -362,19 +573,13 @@ def list_patients():
 @app.post("/api/admin/create-patient")
 def create_patient(request: AdminPatientRequest):
     """Creates a new patient folder by creating an initial empty file."""
-    BUCKET_NAME = "clinic_sim"
     # GCS folders don't exist without files. We create a default info file.
-    blob_path = f"patient_profile/{request.pid}/patient_info.md"
+    blob_path = gcs_manager.patient_path(request.pid, "patient_info.md")
     
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob = bucket.blob(blob_path)
-        
-        if blob.exists():
+        # Conditional upload (generation 0): fails instead of overwriting an existing patient
+        if not gcs_manager.write(blob_path, "# Patient Profile\nName: \nAge: ", content_type="text/markdown", only_if_new=True):
              return JSONResponse(status_code=400, content={"error": "Patient already exists"})
-
-        blob.upload_from_string("# Patient Profile\nName: \nAge: ", content_type="text/markdown")
         
         return JSONResponse(content={"message": "Patient created", "pid": request.pid})
     except Exception as e:
@@ -383,20 +588,16 @@ def create_patient(request: AdminPatientRequest):
 @app.delete("/api/admin/delete-patient")
 def delete_patient(pid: str):
     """Deletes a patient folder and ALL files inside it."""
-    BUCKET_NAME = "clinic_sim"
-    prefix = f"patient_profile/{pid}/"
+    prefix = gcs_manager.patient_path(pid)
     
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blobs = list(bucket.list_blobs(prefix=prefix))
+        deleted = gcs_manager.delete_prefix(prefix)
         
-        if not blobs:
+        if not deleted:
             return JSONResponse(status_code=404, content={"error": "Patient not found"})
 
-        bucket.delete_blobs(blobs)
         logger.info(f"🗑️ Deleted patient folder: {prefix}")
-        return JSONResponse(content={"message": f"Deleted {len(blobs)} files for patient {pid}"})
+        return JSONResponse(content={"message": f"Deleted {deleted} files for patient {pid}"})
             
     except Exception as e:
         logger.error(f"Delete Patient Error: {e}")
@@ -0,0 +1,128 @@
+# --- session_store.py ---
+import os
+import re
+import copy
+import json
+import logging
+import secrets
+import threading
+
+import question_manager
+import education_manager
+import status_channel
+
+logger = logging.getLogger("medforce-backend")
+
+DEFAULT_SESSION_ID = "default"          # Standalone engines/simulations created without a session
+# Client-supplied ids become directory names under PERSIST_DIR, so only a safe charset is accepted
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+# Optional persistence: when set, each session writes its JSON artifacts to <dir>/<session_id>/
+PERSIST_DIR = os.getenv("SESSION_PERSIST_DIR") or None
+
+
+def validate_session_id(session_id):
+    if not isinstance(session_id, str) or not SESSION_ID_PATTERN.fullmatch(session_id):
+        raise ValueError(f"Invalid session_id {session_id!r}: use 1-64 letters, digits, '_' or '-'")
+    return session_id
+
+
+def new_session_id():
+    return secrets.token_hex(8)
+
+
+def _load_base_questions(path="questions.json"):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logger.warning(f"⚠️ [SessionStore] Could not load base questions from {path}: {e}")
+        return []
+
+# Parsed once at startup, deep-copied into every session
+BASE_QUESTIONS = _load_base_questions()
+
+
+class SessionState:
+    """
+    Everything one consultation mutates: question pool, education pool and the latest status
+    published by the logic thread. Shared by the /ws/transcriber and /ws/simulation sockets
+    that carry the same session_id.
+    """
+    def __init__(self, session_id, persist_dir=PERSIST_DIR):
+        self.session_id = validate_session_id(session_id)
+        self.storage_dir = os.path.join(persist_dir, session_id) if persist_dir else None
+        if self.storage_dir:
+            os.makedirs(self.storage_dir, exist_ok=True)
+
+        self.qm = question_manager.QuestionPoolManager(
+            copy.deepcopy(BASE_QUESTIONS), storage_path=self.path("question_pool.json")
+        )
+        self.em = education_manager.EducationPoolManager(storage_path=self.path("education_pool.json"))
+        # Clinical direction (next question / education / finished), published by the logic thread
+        self.channel = status_channel.StatusChannel()
+        self.refs = 0
+
+    @property
+    def status(self):
+        """Latest status update as a dict ({"is_finished", "question", "education"}), or None."""
+        latest = self.channel.latest
+        return latest.to_dict() if latest else None
+
+    def path(self, name):
+        """Namespaced file path, or None when the session is in-memory only."""
+        return os.path.join(self.storage_dir, name) if self.storage_dir else None
+
+    def write_json(self, name, data):
+        path = self.path(name)
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=4)
+
+    def write_text(self, name, text):
+        path = self.path(name)
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(text)
+
+    def set_status(self, update_object):
+        self.channel.publish(
+            question=update_object.get("question"),
+            education=update_object.get("education", ""),
+            is_finished=update_object.get("is_finished", False)
+        )
+        self.write_json("status_update.json", update_object)
+
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def acquire(session_id=None):
+    """
+    Returns the session for 'session_id' (created on first use) and takes a reference on it.
+    Without an id the caller gets a fresh, private session (send its session_id to other
+    sockets to share it). Raises ValueError for ids outside SESSION_ID_PATTERN.
+    """
+    session_id = validate_session_id(session_id) if session_id else new_session_id()
+    with _lock:
+        session = _sessions.get(session_id)
+        if session is None:
+            session = _sessions[session_id] = SessionState(session_id)
+            logger.info(f"🗂️ [SessionStore] Created session {session_id} ({len(_sessions)} active).")
+        session.refs += 1
+        return session
+
+
+def release(session):
+    """Drops a reference; the session is discarded once no socket uses it anymore."""
+    with _lock:
+        session.refs -= 1
+        if session.refs <= 0 and _sessions.get(session.session_id) is session:
+            del _sessions[session.session_id]
+            logger.info(f"🗂️ [SessionStore] Closed session {session.session_id} ({len(_sessions)} active).")
+
+
+def get(session_id):
+    with _lock:
+        return _sessions.get(session_id) if session_id else None
+
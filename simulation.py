@@ -2,17 +2,18 @@
 import asyncio
 import threading
 import copy
-import json
 import logging
 import datetime
 import contextlib
 import os
 import time
 from fastapi import WebSocket
-import question_manager
 # Local Imports
 import agents
-from utils import fetch_gcs_text_internal
+import audio_pacer
+import live_pool
+import session_store
+from utils import fetch_gcs_text_internal, fetch_gcs_texts_async
 
 logger = logging.getLogger("medforce-backend")
 
@@ -25,6 +26,11 @@ except Exception as e:
     logger.error(f"Failed to load nurse.md: {e}")
     NURSE_PROMPT_BASE = "You are a professional triage nurse. Be empathetic and concise."
 
+# Max wait for the next clinical update after an exchange
+STATUS_WAIT_TIMEOUT_SEC = float(os.getenv("STATUS_WAIT_TIMEOUT_SEC", "6.0"))
+# Patient whose nurse/patient personas get spare Live sessions at startup
+PREWARM_PATIENT_ID = os.getenv("LIVE_POOL_PREWARM_PATIENT", "P0001")
+
 class TranscriptManager:
     """Thread-safe manager for the simulation history."""
     def __init__(self):
@@ -45,201 +51,162 @@ class TranscriptManager:
         with self._lock:
             return copy.deepcopy(self.history)
 
+def build_voice_agents(patient_prompt, patient_info, gender="Male"):
+    """
+    Nurse and patient Live agents for one patient.
+    The chart is part of the nurse's system instruction: it is sent once per session and,
+    unlike a conversation turn, survives context-window compression.
+    """
+    nurse = agents.TextBridgeAgent("NURSE", f"{NURSE_PROMPT_BASE}\n\nPATIENT CHART (background for the whole interview):\n{patient_info}", "Aoede")
+    # Patient uses gender-appropriate voices
+    voice = "Puck" if gender.lower() == "male" else "Laomedeia"
+    return nurse, agents.TextBridgeAgent("PATIENT", patient_prompt, voice)
+
+
+async def prewarm_live_sessions(patient_id=PREWARM_PATIENT_ID, gender="Male"):
+    """Opens spare sessions for the default patient's personas ahead of the first simulation."""
+    patient_prompt, patient_info = await fetch_gcs_texts_async(patient_id, "patient_system.md", "patient_info.md")
+    pool = live_pool.get_pool()
+    for agent in build_voice_agents(patient_prompt, patient_info, gender):
+        pool.warm(agent)
+
+
 class SimulationManager:
-    def __init__(self, websocket: WebSocket, patient_id: str, gender: str = "Male"):
+    def __init__(self, websocket: WebSocket, patient_id: str, gender: str = "Male", session=None, audio_sink=None, binary_audio=False,
+                 patient_prompt=None, patient_info=None):
         self.websocket = websocket
         self.patient_id = patient_id
+        # Consultation state published by the transcriber of the same session_id
+        self.session = session if session is not None else session_store.SessionState(session_store.DEFAULT_SESSION_ID)
+        # Server-side loopback: generated speech is fed straight into a TranscriberEngine
+        self.audio_sink = audio_sink
+        # Negotiated framing: binary audio frames instead of base64 JSON
+        self.binary_audio = binary_audio
+        self.pacer = None
         
-        # 1. Fetch Patient Persona from GCS
-        self.PATIENT_PROMPT = fetch_gcs_text_internal(patient_id, "patient_system.md")
-        self.PATIENT_INFO = fetch_gcs_text_internal(patient_id, "patient_info.md")
+        # 1. Patient Persona from GCS (prefetched by create(), or fetched here synchronously)
+        self.PATIENT_PROMPT = patient_prompt if patient_prompt is not None else fetch_gcs_text_internal(patient_id, "patient_system.md")
+        self.PATIENT_INFO = patient_info if patient_info is not None else fetch_gcs_text_internal(patient_id, "patient_info.md")
 
         # 2. Initialize Voice Agents
-        # Nurse uses Aoede (Professional Female)
-        self.nurse = agents.TextBridgeAgent("NURSE", NURSE_PROMPT_BASE, "Aoede")
-        
-        # Patient uses gender-appropriate voices
-        if gender.lower() == "male":
-            self.patient = agents.TextBridgeAgent("PATIENT", self.PATIENT_PROMPT, "Puck")
-        else:
-            self.patient = agents.TextBridgeAgent("PATIENT", self.PATIENT_PROMPT, "Laomedeia")
+        # Nurse uses Aoede (Professional Female), the patient a gender-appropriate voice
+        self.nurse, self.patient = build_voice_agents(self.PATIENT_PROMPT, self.PATIENT_INFO, gender)
+        self._live_close = {}       # agent name -> closes that agent's current Live connection
         
         self.tm = TranscriptManager()
         self.cycle = 0
         self.running = False
         self.last_q = []
         self.last_question = ""
+        self.last_revision = 0      # Last status revision consumed from the session channel
         self.timeout_status = 0
 
+    @classmethod
+    async def create(cls, websocket: WebSocket, patient_id: str, gender: str = "Male", **kwargs):
+        """Async constructor: both persona files are downloaded concurrently, off the event loop."""
+        patient_prompt, patient_info = await fetch_gcs_texts_async(patient_id, "patient_system.md", "patient_info.md")
+        return cls(websocket, patient_id, gender, patient_prompt=patient_prompt, patient_info=patient_info, **kwargs)
+
     def fetch_clinical_instruction(self):
         """
-        Reads direction from status_update.json created by the ws_transcriber.
-        Includes a retry mechanism to avoid file-lock race conditions.
+        Picks the next question from the session pool, guided by the latest status
+        published by the transcriber (no file reads).
         """
-        qm = question_manager.QuestionPoolManager([])
+        qm = self.session.qm
         print("QM QUESTIONS:", len(qm.questions))
-        path = 'status_update.json'
-        if not os.path.exists(path):
+        data = self.session.status
+        if data is None:
             return "Continue the medical interview and explore the patient's symptoms.", False
 
-        for _ in range(3): # Try up to 3 times if file is being written to
-            try:
-                with open(path, 'r', encoding='utf-8') as file:
-                    data = json.load(file)
-                
-                is_finished = data.get("is_finished", False)
-                if is_finished:
-                    print("CLINICAL ASSESSMENT MARKED AS FINISHED.")
-                    return "The clinical assessment is complete. Thank the patient and end the session.", True
-                # next_q = data.get("question")
-                rank_target = 1
-                while True:
-                    next_q_obj = qm.get_high_rank_question(target_rank=rank_target)
-                    if next_q_obj:
-                        next_q = next_q_obj.get("content")
-                        if next_q not in self.last_q:
-                            self.last_q.append(next_q)
-                            print(f"NEXT Q FETCHED: {next_q}")
-                            return f"Clinical Goal: Ask about '{next_q}'. Make it sound natural.", False
-                        else:
-                            print("DUPLICATE Q SKIPPED", next_q)
-                            rank_target += 1
-                            if rank_target > len(qm.questions):
-                                print("NO NEW Q AVAILABLE")
-                                return "The clinical assessment is complete. Thank the patient and end the session.", True
-                            
-                    else:
-                        print("NO NEXT Q FETCHED")
+        is_finished = data.get("is_finished", False)
+        if is_finished:
+            print("CLINICAL ASSESSMENT MARKED AS FINISHED.")
+            return "The clinical assessment is complete. Thank the patient and end the session.", True
+        # next_q = data.get("question")
+        rank_target = 1
+        while True:
+            next_q_obj = qm.get_high_rank_question(target_rank=rank_target)
+            if next_q_obj:
+                next_q = next_q_obj.get("content")
+                if next_q not in self.last_q:
+                    self.last_q.append(next_q)
+                    print(f"NEXT Q FETCHED: {next_q}")
+                    return f"Clinical Goal: Ask about '{next_q}'. Make it sound natural.", False
+                else:
+                    print("DUPLICATE Q SKIPPED", next_q)
+                    rank_target += 1
+                    if rank_target > len(qm.questions):
+                        print("NO NEW Q AVAILABLE")
                         return "The clinical assessment is complete. Thank the patient and end the session.", True
-
-                
-
-            except (json.JSONDecodeError, IOError):
-                time.sleep(0.1) # Wait 100ms for transcriber to finish writing
-                continue
-        
-        return "Continue the interview.", False
+                    
+            else:
+                print("NO NEXT Q FETCHED")
+                return "The clinical assessment is complete. Thank the patient and end the session.", True
     
-    async def fetch_status_update(self):
+    async def fetch_status_update(self, timeout=STATUS_WAIT_TIMEOUT_SEC):
         """
-        Reads direction from status_update.json.
-        Async version: Uses non-blocking sleep.
+        Awaits the next clinical update published by the transcriber logic thread.
         Returns: (question, is_finished, education)
         """
-        path = 'status_update.json'
         closing_msg = "The clinical assessment is complete. Thank the patient and end the session."
-        
-        if not os.path.exists(path):
-            return "Continue the medical interview and explore the patient's symptoms.", False, None
-
-        for i in range(5): 
-            try:
-                # Note: Standard open() is blocking, but usually fast enough for small JSON files.
-                # If you need strict non-blocking file I/O, you would need the 'aiofiles' library.
-                with open(path, 'r', encoding='utf-8') as file:
-                    data = json.load(file)
-                
-                is_finished = data.get("c", False)
-                next_q = data.get("question")
-                education = data.get("education")
-
-                # 1. Check finished status
-                if is_finished:
-                    print("CLINICAL ASSESSMENT MARKED AS FINISHED.")
-                    return closing_msg, True, education
-
-                # 2. Check empty question
-                if not next_q:
-                    print("NO QUESTION FOUND - ENDING.")
-                    return closing_msg, True, education
-
-                # 3. Check for Duplicate (Wait 1 sec if same)
-                if next_q == self.last_question:
-                    # print(f"DUPLICATE QUESTION ({next_q}). Waiting for update... ({i+1}/5)")
-                    # CRITICAL CHANGE: Use await asyncio.sleep instead of time.sleep
-                    await asyncio.sleep(0.5) 
-                    continue
-                
-                # 4. Success - New Question
-                self.last_question = next_q
-                print(f"NEXT Q FETCHED: {next_q}")
-                
-                formatted_q = f"Clinical Goal: Ask about '{next_q}'. Make it sound natural. Do not repeat asked question."
-                return formatted_q, False, education
-
-            except (json.JSONDecodeError, IOError):
-                # Wait briefly for file write to complete
-                await asyncio.sleep(0.1) 
+        deadline = time.monotonic() + timeout
+
+        while True:
+            update = await self.session.channel.wait_for(self.last_revision, max(0.0, deadline - time.monotonic()))
+            if update is None:
+                return "Continue the medical interview and explore the patient's symptoms.", False, None
+            if update.revision <= self.last_revision:
+                break  # Timed out without a newer revision
+            self.last_revision = update.revision
+
+            # 1. Check finished status
+            if update.is_finished:
+                print("CLINICAL ASSESSMENT MARKED AS FINISHED.")
+                return closing_msg, True, update.education
+
+            # 2. Check empty question
+            if not update.question:
+                print("NO QUESTION FOUND - ENDING.")
+                return closing_msg, True, update.education
+
+            # 3. Duplicate: keep waiting for a newer revision
+            if update.question == self.last_question:
                 continue
-        
+
+            # 4. Success - New Question
+            self.last_question = update.question
+            print(f"NEXT Q FETCHED: {update.question}")
+            
+            formatted_q = f"Clinical Goal: Ask about '{update.question}'. Make it sound natural. Do not repeat asked question."
+            return formatted_q, False, update.education
+
         # Fallback if timed out
         print("TIMED OUT WAITING FOR NEW QUESTION.")
-        # self.timeout_status += 1
-        # if self.timeout_status >=5:
-        #     return closing_msg, True, None
         return "Continue the interview for other questions, improvise with your own question. Do not repeat asked question.", False, None
 
-    async def fetch_scenario(self):
+    async def renew_live_sessions(self):
         """
-        Reads direction from status_update.json.
-        Async version: Uses non-blocking sleep.
-        Returns: (question, is_finished, education)
+        Reconnects agents whose Live connection got a GoAway, resuming their context when a handle exists.
+        The replaced connection is closed once the new one is up.
         """
-        path = 'scenario.json'
-        closing_msg = "The clinical assessment is complete. Thank the patient and end the session."
-        
-        if not os.path.exists(path):
-            return "Continue the medical interview and explore the patient's symptoms.", False, None
-
-        for i in range(5): 
-            try:
-                # Note: Standard open() is blocking, but usually fast enough for small JSON files.
-                # If you need strict non-blocking file I/O, you would need the 'aiofiles' library.
-                with open(path, 'r', encoding='utf-8') as file:
-                    datas = json.load(file)
-                
-                for data in datas:
-                
-                    is_finished = data.get("is_finished", False)
-                    next_q = data.get("question")
-                    education = data.get("education")
-
-                    # 1. Check finished status
-                    if is_finished:
-                        print("CLINICAL ASSESSMENT MARKED AS FINISHED.")
-                        return closing_msg, True, education
-
-                    # 2. Check empty question
-                    if not next_q:
-                        print("NO QUESTION FOUND - ENDING.")
-                        return closing_msg, True, education
-
-                    # 3. Check for Duplicate (Wait 1 sec if same)
-                    if next_q in self.last_q:
-                        # print(f"DUPLICATE QUESTION ({next_q}). Waiting for update... ({i+1}/5)")
-                        # CRITICAL CHANGE: Use await asyncio.sleep instead of time.sleep
-                        await asyncio.sleep(0.5) 
-                        continue
-                    
-                    # 4. Success - New Question
-                    self.last_q.append(next_q)
-                    # self.last_question = next_q
-                    print(f"NEXT Q FETCHED: {next_q}")
-                    
-                    formatted_q = f"Clinical Goal: Ask about '{next_q}'. Make it sound natural. Do not repeat asked question."
-                    return formatted_q, False, education
-
-            except (json.JSONDecodeError, IOError):
-                # Wait briefly for file write to complete
-                await asyncio.sleep(0.1) 
+        for agent in (self.nurse, self.patient):
+            if not agent.go_away:
                 continue
-        
-        # Fallback if timed out
-        print("TIMED OUT WAITING FOR NEW QUESTION.")
-        # self.timeout_status += 1
-        # if self.timeout_status >=5:
-        #     return closing_msg, True, None
-        return "Continue the interview for other questions, improvise with your own question. Do not repeat asked question.", False, None
+            handle = agent.resume_handle
+            conn = contextlib.AsyncExitStack()
+            session = await conn.enter_async_context(agent.get_connection_context(handle=handle))
+            agent.set_session(session)
+            replaced, self._live_close[agent.name] = self._live_close.get(agent.name), conn.aclose
+            if replaced:
+                try:
+                    await replaced()
+                except Exception as e:
+                    logger.warning(f"⚠️ [{agent.name}] Closing the replaced Live session failed: {e}")
+            logger.info(f"🔄 [{agent.name}] Live session {'resumed' if handle else 'reopened'}.")
+
+    async def close_live_sessions(self):
+        closers, self._live_close = list(self._live_close.values()), {}
+        await asyncio.gather(*(close() for close in closers), return_exceptions=True)
 
     async def run(self):
         self.running = True
@@ -248,106 +215,20 @@ class SimulationManager:
         # --- ASYNC CONTEXT MANAGER FOR GEMINI LIVE CONNECTIONS ---
         async with contextlib.AsyncExitStack() as stack:
             # Establish Real-time Voice Connections
-            nurse_session = await stack.enter_async_context(self.nurse.get_connection_context())
-            patient_session = await stack.enter_async_context(self.patient.get_connection_context())
+            # Warm sessions from the pool (opened concurrently when none is spare)
+            nurse_live, patient_live = await live_pool.get_pool().acquire_all(self.nurse, self.patient)
+            self._live_close = {self.nurse.name: nurse_live.close, self.patient.name: patient_live.close}
+            stack.push_async_callback(self.close_live_sessions)
             
-            self.nurse.set_session(nurse_session)
-            self.patient.set_session(patient_session)
-            
-            await self.websocket.send_json({"type": "system", "message": "Voice sessions connected."})
-            await asyncio.sleep(2)
+            # The patient chart is in the nurse's system instruction; turns only carry what changed
+            self.nurse.set_session(nurse_live.session)
+            self.patient.set_session(patient_live.session)
 
-            # Initial State
-            next_instruction = "Introduce yourself and ask the patient about their primary concern today."
-            patient_last_words = "None (Beginning of interview)"
-            interview_completed_clinically = False
-            while self.running:
-                # logger.info(f"--- Simulation Cycle {self.cycle} ---")
-
-                # 1. NURSE TURN
-                # We combine the base prompt with specific clinical instructions
-                nurse_input = (
-                    f"CONTEXT: {self.PATIENT_INFO}\n"
-                    f"PATIENT LAST SAID: '{patient_last_words}'\n"
-                    f"SUPERVISOR INSTRUCTION: {next_instruction}\n\n"
-                    "TASK: Speak to the patient now. Be professional and brief."
-                )
-                
-                nurse_text, _ = await self.nurse.speak_and_stream(nurse_input, self.websocket)
-                if not nurse_text: 
-                    nurse_text = "I see. Can you tell me more about that?"
-                
-                self.tm.log("NURSE", nurse_text)
-                await asyncio.sleep(0.5)
-
-                # 2. PATIENT TURN
-                # The patient agent reacts to what the nurse just said
-                patient_text, _ = await self.patient.speak_and_stream(nurse_text, self.websocket)
-                
-                if patient_text:
-                    patient_last_words = patient_text
-                else:
-                    patient_last_words = "(The patient remains silent)"
-
-                self.tm.log("PATIENT", patient_last_words)
-                
-                # Signal UI that a full exchange happened
-                await self.websocket.send_json({"type": "turn", "data": "finish cycle"})
-
-                # 3. CLINICAL INTELLIGENCE SYNC
-                # We wait a moment for the ws_transcriber.py to process the audio and update the JSON
-                await asyncio.sleep(1.5)
-
-                # Fetch the next move from the JSON file
-                next_instruction_message, interview_completed_clinically, education_message = await self.fetch_status_update()
-                
-                # logger.info(f"📁 Supervisor Direction: {next_instruction}")
-                if education_message:
-                    next_instruction = f"Educate patient about this topic in short: {education_message}. Then continue the interview with this question: {next_instruction_message}" 
-                else:
-                    next_instruction = next_instruction_message
-
-                logger.info("SIMULATION : Next Instruction: " + next_instruction)
-
-
-                await self.websocket.send_json({
-                    "type": "system", 
-                    "message": f"Clinical Instruction: {next_instruction}"
-                })
-
-                # If the clinical agent says we are done, we do one last goodbye turn
-                if interview_completed_clinically:
-                    logger.info("🏁 Clinical Supervisor marked session as COMPLETE.")
-                    final_nurse_input = "The clinical supervisor says we have enough info. Thank the patient and say goodbye."
-                    await self.nurse.speak_and_stream(final_nurse_input, self.websocket)
-                    break
-                
-                self.cycle += 1
-
-                # Check if the user closed the browser tab
-                if self.websocket.client_state.name == "DISCONNECTED": 
-                    break
-
-            # Send final stop signals
-            await self.websocket.send_json({"type": "turn", "data": "end"})
-            self.running = False
-            logger.info("🛑 Simulation Loop Terminated.")
-
-    async def run2(self):
-        self.running = True
-        await self.websocket.send_json({"type": "system", "message": "Initializing Agents..."})
-
-        # --- ASYNC CONTEXT MANAGER FOR GEMINI LIVE CONNECTIONS ---
-        async with contextlib.AsyncExitStack() as stack:
-            # Establish Real-time Voice Connections
-            nurse_session = await stack.enter_async_context(self.nurse.get_connection_context())
-            patient_session = await stack.enter_async_context(self.patient.get_connection_context())
-            
-            self.nurse.set_session(nurse_session)
-            self.patient.set_session(patient_session)
+            # Paced outbound audio: agent turns return when the model finishes, playback catches up here
+            self.pacer = audio_pacer.AudioPacer(self.websocket).start()
+            stack.push_async_callback(self.pacer.close)
             
-            await self.websocket.send_json({"type": "system", "message": "Voice sessions connected."})
-            await asyncio.sleep(2)
+            self.pacer.put({"type": "system", "message": "Voice sessions connected."})
 
             # Initial State
             next_instruction = "Introduce yourself and ask the patient about their primary concern today."
@@ -356,25 +237,27 @@ class SimulationManager:
             while self.running:
                 # logger.info(f"--- Simulation Cycle {self.cycle} ---")
 
+                await self.renew_live_sessions()
+
                 # 1. NURSE TURN
                 # We combine the base prompt with specific clinical instructions
                 nurse_input = (
-                    f"CONTEXT: {self.PATIENT_INFO}\n"
                     f"PATIENT LAST SAID: '{patient_last_words}'\n"
                     f"SUPERVISOR INSTRUCTION: {next_instruction}\n\n"
                     "TASK: Speak to the patient now. Be professional and brief."
                 )
+                # Generation overlaps playback, but stays within a bounded distance of it
+                await self.pacer.wait_ahead()
                 
-                nurse_text, _ = await self.nurse.speak_and_stream(nurse_input, self.websocket)
+                nurse_text, _ = await self.nurse.speak_and_stream(nurse_input, self.websocket, audio_sink=self.audio_sink, binary_audio=self.binary_audio, pacer=self.pacer)
                 if not nurse_text: 
                     nurse_text = "I see. Can you tell me more about that?"
                 
                 self.tm.log("NURSE", nurse_text)
-                await asyncio.sleep(0.5)
 
                 # 2. PATIENT TURN
                 # The patient agent reacts to what the nurse just said
-                patient_text, _ = await self.patient.speak_and_stream(nurse_text, self.websocket)
+                patient_text, _ = await self.patient.speak_and_stream(nurse_text, self.websocket, audio_sink=self.audio_sink, binary_audio=self.binary_audio, pacer=self.pacer)
                 
                 if patient_text:
                     patient_last_words = patient_text
@@ -384,20 +267,11 @@ class SimulationManager:
                 self.tm.log("PATIENT", patient_last_words)
                 
                 # Signal UI that a full exchange happened
-                await self.websocket.send_json({"type": "turn", "data": "finish cycle"})
-
+                self.pacer.put({"type": "turn", "data": "finish cycle"})
 
-                await self.websocket.send_json({"type": "diagnosis", "diagnosis": None})
-                await self.websocket.send_json({"type": "questions", "questions": None})
-                await self.websocket.send_json({"type": "analytics", "data": None})
-                await self.websocket.send_json({"type": "status", "data": None})
-                await self.websocket.send_json({"type": "education", "data": None})
                 # 3. CLINICAL INTELLIGENCE SYNC
-                # We wait a moment for the ws_transcriber.py to process the audio and update the JSON
-                await asyncio.sleep(1.5)
-
-                # Fetch the next move from the JSON file
-                next_instruction_message, interview_completed_clinically, education_message = await self.fetch_scenario()
+                # Await the next revision published by the transcriber logic thread
+                next_instruction_message, interview_completed_clinically, education_message = await self.fetch_status_update()
                 
                 # logger.info(f"📁 Supervisor Direction: {next_instruction}")
                 if education_message:
@@ -408,7 +282,7 @@ class SimulationManager:
                 logger.info("SIMULATION : Next Instruction: " + next_instruction)
 
 
-                await self.websocket.send_json({
+                self.pacer.put({
                     "type": "system", 
                     "message": f"Clinical Instruction: {next_instruction}"
                 })
@@ -417,21 +291,20 @@ class SimulationManager:
                 if interview_completed_clinically:
                     logger.info("🏁 Clinical Supervisor marked session as COMPLETE.")
                     final_nurse_input = "The clinical supervisor says we have enough info. Thank the patient and say goodbye."
-                    await self.nurse.speak_and_stream(final_nurse_input, self.websocket)
+                    await self.nurse.speak_and_stream(final_nurse_input, self.websocket, audio_sink=self.audio_sink, binary_audio=self.binary_audio, pacer=self.pacer)
                     break
                 
                 self.cycle += 1
 
                 # Check if the user closed the browser tab
-                if self.websocket.client_state.name == "DISCONNECTED": 
+                if self.pacer.closed or self.websocket.client_state.name == "DISCONNECTED": 
                     break
 
             # Send final stop signals
-            await self.websocket.send_json({"type": "turn", "data": "end"})
+            self.pacer.put({"type": "turn", "data": "end"})
             self.running = False
             logger.info("🛑 Simulation Loop Terminated.")
 
-
     def stop(self):
         """External call to stop the loop."""
         self.running = False
@@ -7,7 +7,10 @@ import datetime
 import os
 import base64
 import time
+import wave
+import uuid
 from fastapi import WebSocket
+import audio_framing
 logger = logging.getLogger("medforce-backend-audio")
 
 # Try to import mutagen for accurate audio duration
@@ -36,9 +39,13 @@ class TranscriptManager:
         self.history.append(entry)
 
 class SimulationAudioManager:
-    def __init__(self, websocket: WebSocket, patient_id: str, script_file: str = "scenario_script.json"):
+    def __init__(self, websocket: WebSocket, patient_id: str, script_file: str = "scenario_script.json", audio_sink=None, binary_audio=False):
         self.websocket = websocket
         self.patient_id = patient_id
+        # Server-side loopback: callable(pcm, speaker=, sample_rate=, channels=), e.g. TranscriberEngine.add_audio
+        self.audio_sink = audio_sink
+        # Negotiated framing: binary audio frames instead of base64 JSON
+        self.binary_audio = binary_audio
         self.tm = TranscriptManager()
         self.running = False
         self.script_file = script_file
@@ -79,6 +86,18 @@ class SimulationAudioManager:
         except:
             return 2.0
 
+    def _open_pcm(self, audio_path: str):
+        """Opens a 16-bit PCM WAV for loopback, or returns None if it cannot be decoded."""
+        try:
+            reader = wave.open(audio_path, "rb")
+            if reader.getsampwidth() == 2:
+                return reader
+            reader.close()
+            logger.warning(f"Loopback skipped for {audio_path}: not 16-bit PCM")
+        except (wave.Error, EOFError, OSError) as e:
+            logger.warning(f"Loopback skipped for {audio_path}: {e}")
+        return None
+
     async def _stream_audio_file(self, speaker: str, audio_path: str, text_content: str):
         """Reads an audio file and streams it to the WS in chunks."""
         if not audio_path or not os.path.exists(audio_path):
@@ -93,26 +112,48 @@ class SimulationAudioManager:
             return
 
         chunk_size = 4096 * 4 
+        pcm_reader = self._open_pcm(audio_path) if self.audio_sink or self.binary_audio else None
+        sample_rate = pcm_reader.getframerate() if pcm_reader else audio_framing.OUTPUT_SAMPLE_RATE
+        if self.binary_audio and not pcm_reader:
+            logger.warning(f"Sample rate of {audio_path} unknown, framing it as {sample_rate} Hz")
+        turn_id = uuid.uuid4()
+        seq = 0
         try:
             with open(audio_path, "rb") as f:
-                while self.running:
-                    data = f.read(chunk_size)
-                    if not data:
-                        break
-                    
-                    encoded_data = base64.b64encode(data).decode('utf-8')
+                data = f.read(chunk_size)
+                while self.running and data:
+                    next_data = f.read(chunk_size)     # One chunk ahead, so the last frame can be flagged
+
+                    if pcm_reader and self.audio_sink:
+                        # Same amount of audio as the file chunk, decoded to PCM for the engine
+                        frames = pcm_reader.readframes(chunk_size // (pcm_reader.getsampwidth() * pcm_reader.getnchannels()))
+                        if frames:
+                            self.audio_sink(frames, speaker=speaker, sample_rate=pcm_reader.getframerate(), channels=pcm_reader.getnchannels())
                     
-                    await self.websocket.send_json({
-                        "type": "audio",
-                        "speaker": speaker,
-                        "data": encoded_data,
-                        "text": "" 
-                    })
+                    if self.binary_audio:
+                        await self.websocket.send_bytes(audio_framing.encode_frame(
+                            data, turn_id, speaker, seq, fmt=audio_framing.FORMAT_WAV, sample_rate=sample_rate,
+                            flags=(audio_framing.FLAG_FIRST if seq == 0 else 0) | (0 if next_data else audio_framing.FLAG_FINAL)
+                        ))
+                    else:
+                        encoded_data = base64.b64encode(data).decode('utf-8')
+                        
+                        await self.websocket.send_json({
+                            "type": "audio",
+                            "speaker": speaker,
+                            "data": encoded_data,
+                            "text": "" 
+                        })
+                    seq += 1
+                    data = next_data
                     
                     # Small delay to prevent flooding
                     await asyncio.sleep(0.02) 
         except Exception as e:
             logger.error(f"Error streaming audio: {e}")
+        finally:
+            if pcm_reader:
+                pcm_reader.close()
 
         # Send Final Text Packet
         await self.websocket.send_json({
@@ -0,0 +1,126 @@
+# --- state_sync.py ---
+import json
+import logging
+
+logger = logging.getLogger("medforce-backend")
+
+SYNC_PATCH = "patch"
+SYNC_FULL = "full"
+
+# message type -> (field holding the list, id key of its items)
+CHANNELS = {
+    "questions": ("questions", "qid"),
+    "diagnosis": ("diagnosis", "did"),
+    "education": ("data", "headline"),
+}
+
+
+def _canonical(item):
+    return json.dumps(item, sort_keys=True, default=str)
+
+
+class StateSync:
+    """
+    Turns full state snapshots into versioned patches against what this client last received.
+    Used as the OutboundQueue transform, so it diffs the newest (coalesced) snapshot at send time.
+
+    Patch:  {"type", "mode": "patch", "version", "base", "added": [items],
+             "changed": [{id, <changed fields>, "removed_fields": [names] (only when fields were dropped)}],
+             "removed": [ids], "order": [ids] (only when the order changed)}
+    Full:   the original message plus "mode": "full" and "version".
+    A client that sees base != its version asks for {"type": "resync"}; reset() makes the next message full.
+    SYNC_FULL (the default) sends every message as a full snapshot, which the bundled clients
+    render as before; clients that apply patches opt in with {"sync": "patch"}.
+    """
+    def __init__(self, mode=SYNC_FULL):
+        self.mode = mode if mode in (SYNC_PATCH, SYNC_FULL) else SYNC_FULL
+        self.versions = {kind: 0 for kind in CHANNELS}
+        self._sent = {}      # kind -> (ordered ids, {id: canonical json})
+        self.bytes_full = 0
+        self.bytes_sent = 0
+
+    def reset(self):
+        self._sent.clear()
+
+    def rebase(self, versions):
+        """
+        Reconnect: keep the baseline of channels whose version the client acknowledges,
+        the others get a full snapshot next. 'versions' is {type: last applied version}.
+        """
+        versions = versions or {}
+        for kind in CHANNELS:
+            if versions.get(kind) != self.versions[kind]:
+                self._sent.pop(kind, None)
+
+    def transform(self, payload):
+        kind = payload.get("type") if isinstance(payload, dict) else None
+        if kind not in CHANNELS:
+            return payload
+        field, id_key = CHANNELS[kind]
+        items = payload.get(field)
+        if not isinstance(items, list):
+            return payload
+
+        snapshot = {}
+        order = []
+        for item in items:
+            item_id = item.get(id_key) if isinstance(item, dict) else None
+            if item_id is None or item_id in snapshot:
+                return self._full(kind, payload, None)   # Not diffable by id: fall back to a snapshot
+            snapshot[item_id] = _canonical(item)
+            order.append(item_id)
+
+        previous = self._sent.get(kind)
+        if self.mode == SYNC_FULL or previous is None:
+            return self._full(kind, payload, (order, snapshot))
+
+        prev_order, prev_items = previous
+        added = [json.loads(snapshot[i]) for i in order if i not in prev_items]
+        removed = [i for i in prev_order if i not in snapshot]
+        changed = []
+        for i in order:
+            if i in prev_items and prev_items[i] != snapshot[i]:
+                old, new = json.loads(prev_items[i]), json.loads(snapshot[i])
+                delta = {k: v for k, v in new.items() if k not in old or old[k] != v}
+                dropped = [k for k in old if k not in new]
+                if dropped:
+                    delta["removed_fields"] = dropped
+                delta[id_key] = i
+                changed.append(delta)
+
+        if not (added or removed or changed) and order == prev_order:
+            return None     # Client is already up to date
+
+        self.bytes_full += sum(len(s) for s in snapshot.values())
+
+        self.versions[kind] += 1
+        self._sent[kind] = (order, snapshot)
+        patch = {
+            "type": kind,
+            "mode": SYNC_PATCH,
+            "version": self.versions[kind],
+            "base": self.versions[kind] - 1,
+            "added": added,
+            "changed": changed,
+            "removed": removed,
+        }
+        if order != prev_order:
+            patch["order"] = order
+        self.bytes_sent += len(_canonical(patch))
+        return patch
+
+    def _full(self, kind, payload, state):
+        self.versions[kind] += 1
+        if state is None:
+            self._sent.pop(kind, None)
+        else:
+            self._sent[kind] = state
+        message = dict(payload, mode=SYNC_FULL, version=self.versions[kind])
+        size = len(_canonical(message))
+        self.bytes_full += size
+        self.bytes_sent += size
+        return message
+
+    def stats(self):
+        return {"mode": self.mode, "versions": dict(self.versions),
+                "bytes_full": self.bytes_full, "bytes_sent": self.bytes_sent}
@@ -0,0 +1,77 @@
+# --- status_channel.py ---
+import time
+import asyncio
+import threading
+
+
+class ClinicalUpdate:
+    """One revision of the clinical direction published by the logic thread."""
+    __slots__ = ("revision", "question", "education", "is_finished", "created")
+
+    def __init__(self, revision, question=None, education="", is_finished=False):
+        self.revision = revision
+        self.question = question
+        self.education = education
+        self.is_finished = is_finished
+        self.created = time.time()
+
+    def to_dict(self):
+        return {
+            "is_finished": self.is_finished,
+            "question": self.question,
+            "education": self.education,
+        }
+
+
+class StatusChannel:
+    """
+    Latest-value pub/sub between a publisher on any thread (the logic thread) and
+    async consumers on any event loop (the simulation). Consumers remember the last
+    revision they handled and await the next one, intermediate revisions are coalesced.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = None
+        self._waiters = []     # (loop, future)
+
+    @property
+    def latest(self):
+        with self._lock:
+            return self._latest
+
+    def publish(self, question=None, education="", is_finished=False):
+        with self._lock:
+            revision = self._latest.revision + 1 if self._latest else 1
+            update = self._latest = ClinicalUpdate(revision, question, education, is_finished)
+            waiters, self._waiters = self._waiters, []
+
+        for loop, future in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self._resolve, future, update)
+        return update
+
+    @staticmethod
+    def _resolve(future, update):
+        if not future.done():
+            future.set_result(update)
+
+    async def wait_for(self, after_revision=0, timeout=None):
+        """
+        Returns the first update newer than 'after_revision'.
+        On timeout returns the latest update (possibly None, or not newer).
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._latest and self._latest.revision > after_revision:
+                return self._latest
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return self.latest
+        finally:
+            with self._lock:
+                if (loop, future) in self._waiters:
+                    self._waiters.remove((loop, future))
@@ -0,0 +1,39 @@
+# --- test_transcript_stitching.py ---
+from transcriber_engine_new import stitch_turns, _overlap_length
+
+
+def _turn(role, message):
+    return {"role": role, "message": message}
+
+
+def test_exact_overlap_is_not_repeated():
+    frozen = [_turn("Patient", "I have had this headache for about three days now")]
+    new = [_turn("Patient", "three days now and it gets worse at night")]
+    merged = stitch_turns(frozen, new)
+    assert merged == [_turn("Patient", "I have had this headache for about three days now and it gets worse at night")]
+
+
+def test_differently_transcribed_overlap_is_not_repeated():
+    # Same audio window, transcribed with other spelling, a number and a dropped word
+    frozen = [_turn("Patient", "it started on Monday after I went running in the park")]
+    new = [_turn("Patient", "started Monday after I went runnin' in the park. Then it got worse.")]
+    merged = stitch_turns(frozen, new)
+    assert len(merged) == 1
+    assert merged[0]["message"] == "it started on Monday after I went running in the park Then it got worse."
+    assert merged[0]["message"].count("park") == 1
+
+
+def test_overlap_with_cut_off_leading_fragment():
+    assert _overlap_length("for about three days now", "ee days now and then") == 3
+
+
+def test_no_overlap_keeps_everything():
+    frozen = [_turn("Nurse", "How long have you had the pain?")]
+    new = [_turn("Patient", "About a week I think.")]
+    assert stitch_turns(frozen, new) == frozen + new
+
+
+def test_echo_attributed_to_other_speaker_is_dropped():
+    frozen = [_turn("Nurse", "Are you taking any medication for it?")]
+    new = [_turn("Patient", "taking any medications for it"), _turn("Patient", "Just paracetamol.")]
+    assert stitch_turns(frozen, new) == frozen + [_turn("Patient", "Just paracetamol.")]
@@ -1,7 +1,6 @@
 import asyncio
 import threading
 import json
-import audioop
 import queue
 import logging
 import os
@@ -11,6 +10,7 @@ import wave
 from google.cloud import speech
 from datetime import datetime
 from utils import fetch_gcs_text_internal
+from resampler import StreamResampler, to_int16
 import pyaudio
 
 # Local Imports (Ensure these exist in your local path)
@@ -61,7 +61,8 @@ class FileAudioSource(BaseAudioSource):
             # Calculate sleep time to simulate real-time playback
             sleep_duration = (self.chunk_size / (channels * sampwidth)) / source_rate
             
-            resample_state = None
+            # Stateful down-mix + resample (keeps filter history across chunks)
+            rs = StreamResampler(source_rate, self.target_rate, in_channels=channels)
             print(f"🔊 [Audio] Starting playback and stream: {self.file_path}")
 
             try:
@@ -76,13 +77,9 @@ class FileAudioSource(BaseAudioSource):
                         stream.write(original_data)
                     
                     # 2. PREPARE FOR STT (Downsample/Mono)
-                    data_to_process = original_data
-                    if channels > 1:
-                        data_to_process = audioop.tomono(data_to_process, sampwidth, 1, 1)
-                    
-                    converted, resample_state = audioop.ratecv(
-                        data_to_process, sampwidth, 1, source_rate, self.target_rate, resample_state
-                    )
+                    converted = rs.process(to_int16(original_data, sampwidth))
+                    if not converted:
+                        continue
                     
                     # Yield to Google STT
                     yield speech.StreamingRecognizeRequest(audio_content=converted)
@@ -126,7 +123,7 @@ class TranscriberLogicThread(threading.Thread):
         self.websocket = websocket
         self.running = True
         self.daemon = True 
-        self.qc = agents.QuestionCheck()
+        self.qc = agents.get_agent(agents.QuestionCheck)
         self.last_line_count = 0 
         self.ready_event = threading.Event()
 
@@ -134,15 +131,15 @@ class TranscriberLogicThread(threading.Thread):
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
         
-        self.hepa_agent = agents.DiagnosisHepato()
-        self.gen_agent = agents.DiagnosisGeneral()
-        self.consolidate_agent = agents.DiagnosisConsolidate()
-        self.merger_agent = agents.QuestionMerger()
-        self.supervisor = agents.InterviewSupervisor()
-        self.transcript_parser = agents.TranscribeStructureAgent()
-        self.q_enrich = agents.QuestionEnrichmentAgent()
-        self.analytics_agent = agents.ConsultationAnalyticAgent()
-        self.education_agent = agents.PatientEducationAgent()
+        self.hepa_agent = agents.get_agent(agents.DiagnosisHepato)
+        self.gen_agent = agents.get_agent(agents.DiagnosisGeneral)
+        self.consolidate_agent = agents.get_agent(agents.DiagnosisConsolidate)
+        self.merger_agent = agents.get_agent(agents.QuestionMerger)
+        self.supervisor = agents.get_agent(agents.InterviewSupervisor)
+        self.transcript_parser = agents.get_agent(agents.TranscribeStructureAgent)
+        self.q_enrich = agents.get_agent(agents.QuestionEnrichmentAgent)
+        self.analytics_agent = agents.get_agent(agents.ConsultationAnalyticAgent)
+        self.education_agent = agents.get_agent(agents.PatientEducationAgent)
         self.em = education_manager.EducationPoolManager()
 
 
@@ -1,13 +1,10 @@
 import asyncio
 import threading
-import json
-import audioop
+import copy
 import queue
 import logging
-import os
 import time
-import wave
-import tempfile
+import difflib
 from google.cloud import speech
 from google import genai
 from google.genai import types
@@ -16,24 +13,131 @@ import traceback
 
 # Local Imports
 import agents
+import audio_buffer
+import model_backend
+import pipeline
+import resampler
+import response_cache
 import diagnosis_manager
-import question_manager
-import education_manager
+import session_store
+import outbound
+import state_sync
 
 logger = logging.getLogger("medforce-backend")
 TRANSCRIPT_FILE = "simulation_transcript.txt"
 
-# --- NEW AGENT CLASS ---
+# --- INCREMENTAL TRANSCRIPTION CONFIG ---
+AUDIO_BYTES_PER_SEC = 16000 * 2          # 16 kHz, 16-bit mono
+TRANSCRIBE_OVERLAP_SEC = 2.0             # Re-sent audio before the committed boundary (for stitching)
+MIN_NEW_AUDIO_BYTES = AUDIO_BYTES_PER_SEC // 2
+CONTEXT_TURNS = 4                        # Frozen turns sent to the transcriber for speaker continuity
+
+# --- LOGIC TRIGGER CONFIG ---
+TRIGGER_DEBOUNCE_SEC = 0.2               # Finals arriving within this window are coalesced into one cycle
+COOLDOWN_FACTOR = 0.25                   # Cooldown after a cycle = last cycle duration * factor ...
+MIN_COOLDOWN_SEC = 0.0
+MAX_COOLDOWN_SEC = 5.0                   # ... clamped to [MIN, MAX]
+IDLE_CHECK_SEC = 1.0                     # Wake-up interval to re-check running/status while idle
+SUPERSEDE_STALE_CYCLES = True            # New finals mid-cycle cancel the stale cycle's non-essential stages
+
+# --- TRANSCRIPT STITCHING ---
+OVERLAP_TAIL_WORDS = 12                  # Words of the previous turn the overlap window is aligned against
+OVERLAP_MIN_MATCHES = 2
+OVERLAP_MIN_MATCH_RATIO = 0.6            # Matched words / new words consumed by the alignment
+WORD_SIMILARITY = 0.75                   # Character similarity at which two words count as the same
+
+def _normalize_words(text):
+    return [w.strip(".,!?;:\"'").lower() for w in text.split()]
+
+def _words_match(a, b):
+    if a == b:
+        return True
+    # Re-transcribed audio often differs in spelling / inflection ("colour" vs "color")
+    return min(len(a), len(b)) > 3 and difflib.SequenceMatcher(None, a, b).ratio() >= WORD_SIMILARITY
+
+def _overlap_length(prev_message, new_message, tail_words=OVERLAP_TAIL_WORDS):
+    """
+    Number of leading words of 'new_message' that repeat the tail of 'prev_message'
+    (the audio overlap window). The last 'tail_words' of the previous turn are aligned
+    against the start of the new segment with a fuzzy, gap-tolerant token alignment,
+    since the same audio is rarely transcribed word for word twice (cut-off fragments,
+    dropped fillers, spelling). Returns 0 if no overlap is found.
+    """
+    prev_words = _normalize_words(prev_message)[-tail_words:]
+    new_words = _normalize_words(new_message)[:tail_words + 4]
+    if not prev_words or not new_words:
+        return 0
+
+    # Overlap alignment: free start inside the previous tail, must run to its end;
+    # the new segment is aligned from its first word and may continue past the overlap.
+    # Cells hold (score, matches); match +2, mismatch / gap -1.
+    n, m = len(prev_words), len(new_words)
+    prev_row = [(-j, 0) for j in range(m + 1)]
+    for i in range(1, n + 1):
+        row = [(0, 0)]
+        for j in range(1, m + 1):
+            hit = _words_match(prev_words[i - 1], new_words[j - 1])
+            diag = prev_row[j - 1]
+            row.append(max(
+                (diag[0] + (2 if hit else -1), diag[1] + hit),
+                (prev_row[j][0] - 1, prev_row[j][1]),
+                (row[j - 1][0] - 1, row[j - 1][1]),
+            ))
+        prev_row = row
+
+    best_j, best = 0, (0, 0)
+    for j in range(1, m + 1):
+        score, matches = prev_row[j]
+        if matches >= OVERLAP_MIN_MATCHES and matches >= OVERLAP_MIN_MATCH_RATIO * j and score > best[0]:
+            best_j, best = j, prev_row[j]
+    return best_j
+
+def stitch_turns(frozen_turns, new_turns):
+    """
+    Merges the turns of a freshly transcribed segment onto the frozen transcript.
+    Frozen turns are never rewritten; the last one may only be extended when the
+    segment starts mid-turn with the same speaker.
+    """
+    merged = list(frozen_turns)
+    turns = [dict(t) for t in new_turns if t.get("message", "").strip()]
+    if not merged or not turns:
+        return merged + turns
+
+    last, first = merged[-1], turns[0]
+    words = first["message"].split()
+    overlap = _overlap_length(last.get("message", ""), first["message"])
+    remainder = " ".join(words[overlap:])
+
+    if first.get("role") == last.get("role"):
+        # Same speaker across the boundary -> continuation of the frozen turn
+        if remainder:
+            merged[-1] = {**last, "message": f"{last['message'].rstrip()} {remainder}"}
+        turns = turns[1:]
+    elif overlap:
+        # Echo of the overlap window attributed to the other speaker -> drop the repeat
+        if remainder:
+            turns[0] = {**first, "message": remainder}
+        else:
+            turns = turns[1:]
+
+    return merged + turns
 
 # --- LOGIC THREAD ---
 class TranscriberLogicThread(threading.Thread):
-    def __init__(self, patient_info, dm, qm, main_loop, websocket, transcript_memory, run_status, audio_provider_callback):
+    def __init__(self, patient_info, dm, qm, main_loop, websocket, transcript_memory, run_status, audio_provider_callback, audio_length_callback=None, incremental_transcription=True,
+                 debounce_sec=TRIGGER_DEBOUNCE_SEC, cooldown_factor=COOLDOWN_FACTOR, min_cooldown_sec=MIN_COOLDOWN_SEC, max_cooldown_sec=MAX_COOLDOWN_SEC,
+                 supersede_stale_cycles=SUPERSEDE_STALE_CYCLES, session=None, speaker_callback=None, outbound_queue=None):
         super().__init__()
         self.patient_info = patient_info
         self.dm = dm
         self.qm = qm
         self.main_loop = main_loop 
         self.websocket = websocket
+        # Bounded, coalescing send queue for UI pushes (created here when the engine does not share one)
+        if outbound_queue is None and websocket and main_loop:
+            outbound_queue = outbound.OutboundQueue(websocket, main_loop)
+        self.outbound = outbound_queue
+        self.last_pushed = {}
         self.running = run_status
         self.daemon = True 
         self.status = False
@@ -41,47 +145,81 @@ class TranscriberLogicThread(threading.Thread):
         
         # Callback to get full audio from Engine
         self.get_full_audio = audio_provider_callback 
+        self.get_audio_length = audio_length_callback
+        # Known speaker spans of the buffered audio (server-side loopback only)
+        self.get_speakers = speaker_callback
+
+        # Incremental Transcription State
+        # Audio before 'committed_audio_bytes' is already diarized into 'transcript_structure'
+        # and those turns are frozen. Only audio after the boundary (+ overlap) is re-sent.
+        self.incremental_transcription = incremental_transcription and audio_length_callback is not None
+        self.committed_audio_bytes = 0
+
+        # Event-driven Trigger State
+        # stt_loop signals finalized sentences through notify_final_transcript();
+        # the event lives on this thread's own loop (created in run()).
+        self.loop = None
+        self.transcript_event = None
+        self.pending_finals = 0
+        self.last_cycle_duration = 0.0
+        self.debounce_sec = debounce_sec
+        self.cooldown_factor = cooldown_factor
+        self.min_cooldown_sec = min_cooldown_sec
+        self.max_cooldown_sec = max_cooldown_sec
+
+        # Latest-wins: graph of the cycle in flight, superseded when newer finals arrive
+        self.supersede_stale_cycles = supersede_stale_cycles
+        self.active_graph = None
+
+        # Session-scoped state (pools, status, optional namespaced persistence)
+        self.session = session if session is not None else session_store.SessionState(session_store.DEFAULT_SESSION_ID)
 
         # Logic Components
-        self.qc = agents.QuestionCheck()
-        self.em = education_manager.EducationPoolManager()
+        self.qc = agents.get_agent(agents.QuestionCheck)
+        self.em = self.session.em
         self.last_line_count = 0 
         self.ready_event = threading.Event()
         
         # Chat State
         self.transcript_structure = []
         self.analytics_pool = {}
-        self.check_count = 0
+        self.check_count = 0                # Cycles started (superseded ones included)
+        self.last_supervisor_status = {}
         self.consultation_start = time.perf_counter()
 
 
     def run(self):
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        self.transcript_event = asyncio.Event()
+        self.loop = loop
         
         # Initialize Agents
-        self.transcriber_agent = agents.ConsultationTranscriber() # <--- NEW AGENT
-        self.hepa_agent = agents.DiagnosisHepato()
-        self.gen_agent = agents.DiagnosisGeneral()
-        self.consolidate_agent = agents.DiagnosisConsolidate()
-        self.merger_agent = agents.QuestionMerger()
-        self.supervisor = agents.InterviewSupervisor()
-        # self.transcript_parser = agents.TranscribeStructureAgent()
-        self.q_enrich = agents.QuestionEnrichmentAgent()
-        self.analytics_agent = agents.ConsultationAnalyticAgent()
-        self.education_agent = agents.PatientEducationAgent()
-        self.ranker = agents.QuestionRanker()
-
-        self.checklist_agent = agents.ClinicalChecklistAgent()
-        self.report_agent = agents.ComprehensiveReportAgent()
-        self.q_dedup = agents.QuestionIntegrationGatekeeper()
+        self.transcriber_agent = agents.get_agent(agents.ConsultationTranscriber) # <--- NEW AGENT
+        self.hepa_agent = agents.get_agent(agents.DiagnosisHepato)
+        self.gen_agent = agents.get_agent(agents.DiagnosisGeneral)
+        self.consolidate_agent = agents.get_agent(agents.DiagnosisConsolidate)
+        self.merger_agent = agents.get_agent(agents.QuestionMerger)
+        self.supervisor = agents.get_agent(agents.InterviewSupervisor)
+        # self.transcript_parser = agents.get_agent(agents.TranscribeStructureAgent)
+        self.q_enrich = agents.get_agent(agents.QuestionEnrichmentAgent)
+        self.analytics_agent = agents.get_agent(agents.ConsultationAnalyticAgent)
+        self.education_agent = agents.get_agent(agents.PatientEducationAgent)
+        self.ranker = agents.get_agent(agents.QuestionRanker)
+
+        self.checklist_agent = agents.get_agent(agents.ClinicalChecklistAgent)
+        self.report_agent = agents.get_agent(agents.ComprehensiveReportAgent)
+        self.q_dedup = agents.get_agent(agents.QuestionIntegrationGatekeeper)
 
         # Clear transcript file
-        with open(TRANSCRIPT_FILE, "w", encoding="utf-8") as f:
-            f.write("")
+        self.session.write_text(TRANSCRIPT_FILE, "")
 
         logger.info(f"🩺 [Logic Thread] Monitoring {TRANSCRIPT_FILE}...")
-        loop.run_until_complete(self.start_logic())
+        try:
+            loop.run_until_complete(self.start_logic())
+        finally:
+            # The shared client of this loop holds its connection pool
+            loop.run_until_complete(agents.release_client())
 
     async def start_logic(self):
         """Pre-analysis before allowing STT to process audio."""
@@ -115,78 +253,84 @@ class TranscriberLogicThread(threading.Thread):
         self.qm.update_enriched_questions(enriched_q)
         
         await self._push_to_ui({"type": "questions", "questions": self.qm.questions, "source": "initial_analysis"})
-        with open('status_update.json', 'w', encoding='utf-8') as f:
-            json.dump({
-                "is_finished": False,
-                "question": self.qm.get_high_rank_question().get("content") if self.qm.get_high_rank_question() else None,
-                "education":  ""
-            }, f, indent=4)
+        self.session.set_status({
+            "is_finished": False,
+            "question": self.qm.get_high_rank_question().get("content") if self.qm.get_high_rank_question() else None,
+            "education":  ""
+        })
 
     async def _push_to_ui(self, payload):
-        if self.websocket and self.main_loop:
-            try:
-                asyncio.run_coroutine_threadsafe(self.websocket.send_json(payload), self.main_loop)
-            except Exception as e:
-                logger.error(f"UI Push Error: {e}")
+        # Latest snapshot per type, replayed to a client that resumes the session
+        if payload.get("type") in outbound.COALESCE_TYPES:
+            self.last_pushed[payload["type"]] = copy.deepcopy(payload)
+        if self.outbound:
+            self.outbound.put(payload)
+
+    async def _transcribe_pcm(self, raw_audio_data, context=None, speaker_hints=None):
+        """Sends a 16 kHz mono PCM AudioSnapshot to the ConsultationTranscriber (encoded in memory)."""
+        try:
+            return await self.transcriber_agent.transcribe_pcm(raw_audio_data, sample_rate=16000, context=context, speaker_hints=speaker_hints)
+        except Exception as e:
+            logger.error(f"Audio Processing Error: {e}")
+            return []
 
     async def _process_full_audio(self):
         """
         Retrieves FULL piled-up audio from engine, converts to WAV, and sends to Gemini.
         Returns the structured transcript of the WHOLE conversation.
         """
-        # 1. Get Raw Bytes (Full History)
+        # 1. Get Raw Audio Snapshot (Full History, zero-copy)
         raw_audio_data = self.get_full_audio()
         if not raw_audio_data or len(raw_audio_data) < 1000: # Ignore tiny chunks
             return []
 
-        temp_wav_name = None
-
-        try:
-            # 2. Create the file and WRITE to it, then CLOSE it immediately.
-            # We use delete=False so it persists after closing, allowing us to read it again for upload.
-            with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as temp_wav:
-                temp_wav_name = temp_wav.name
-                
-                # Use the wave library to write the frames to the file object
-                with wave.open(temp_wav, "wb") as wf:
-                    wf.setnchannels(1)
-                    wf.setsampwidth(2) # 2 bytes = 16 bit
-                    wf.setframerate(16000)
-                    wf.writeframes(raw_audio_data)
-            
-            # AT THIS POINT: The 'with' block is done. 
-            # Both 'wave' and 'tempfile' have closed their handles. 
-            # The file exists on disk and is not locked.
-
-            # 3. Send to Gemini Agent
-            logger.info(f"🎧 [ConsultationTranscriber] Processing full audio: {len(raw_audio_data)} bytes...")
-            
-            # The upload function will open/read/close the file internally
-            full_transcript = await self.transcriber_agent.transcribe_audio(temp_wav_name)
-            
-            logger.info(f"📝 [ConsultationTranscriber] Full Transcript Items: {len(full_transcript)}")
-            return full_transcript
-
-        except Exception as e:
-            logger.error(f"Audio Processing Error: {e}")
-            return []
-            
-        finally:
-            # 4. Cleanup
-            # Now safe to remove because we are outside the 'with' block 
-            # and we are sure the file is closed.
-            if temp_wav_name and os.path.exists(temp_wav_name):
-                try:
-                    os.remove(temp_wav_name)
-                except Exception as cleanup_error:
-                    logger.warning(f"⚠️ Could not remove temp file {temp_wav_name}: {cleanup_error}")
+        logger.info(f"🎧 [ConsultationTranscriber] Processing full audio: {len(raw_audio_data)} bytes...")
+        speaker_hints = self.get_speakers(0, len(raw_audio_data)) if self.get_speakers else None
+        full_transcript = await self._transcribe_pcm(raw_audio_data, speaker_hints=speaker_hints)
+        logger.info(f"📝 [ConsultationTranscriber] Full Transcript Items: {len(full_transcript)}")
+        return full_transcript
 
-    async def _check_logic(self, raw_stt_text):
-        """Main AI Reasoning Branch."""
-        try:
-            total_start = time.perf_counter()
-            
-            # --- NEW STEP: Process FULL Audio with Gemini ---
+    async def _process_new_audio(self):
+        """
+        Incremental mode: transcribes only the audio recorded since the last committed
+        boundary (plus TRANSCRIBE_OVERLAP_SEC of overlap) and stitches the new turns onto
+        the frozen 'transcript_structure'. Upload size stays flat over the consultation.
+        Returns True if the transcript changed.
+        """
+        end = self.get_audio_length()
+        if end - self.committed_audio_bytes < MIN_NEW_AUDIO_BYTES:
+            return False
+
+        overlap_bytes = int(TRANSCRIBE_OVERLAP_SEC * AUDIO_BYTES_PER_SEC)
+        start = max(0, self.committed_audio_bytes - overlap_bytes)
+        start -= start % 2 # Keep 16-bit sample alignment
+
+        segment = self.get_full_audio(start, end)
+        if not segment:
+            return False
+
+        logger.info(f"🎧 [ConsultationTranscriber] Processing new audio: {len(segment)} bytes (from {start / AUDIO_BYTES_PER_SEC:.1f}s)...")
+        context = self.transcript_structure[-CONTEXT_TURNS:]
+        speaker_hints = self.get_speakers(start, end) if self.get_speakers else None
+        new_turns = await self._transcribe_pcm(segment, context=context, speaker_hints=speaker_hints)
+
+        # An empty result is either silence or a failed call - keep the boundary
+        # so the audio is retried on the next cycle instead of being lost.
+        if not new_turns:
+            return False
+
+        self.transcript_structure = stitch_turns(self.transcript_structure, new_turns)
+        self.committed_audio_bytes = end
+        logger.info(f"📝 [ConsultationTranscriber] +{len(new_turns)} segment items, total turns: {len(self.transcript_structure)}")
+        return True
+
+    async def _update_transcript(self):
+        if self.incremental_transcription:
+            # --- Process only NEW Audio with Gemini ---
+            # Already diarized turns stay frozen, the new segment is stitched onto them.
+            await self._process_new_audio()
+        else:
+            # --- Process FULL Audio with Gemini ---
             # We fetch the high-quality diarized transcript for the ENTIRE audio history
             full_structured_transcript = await self._process_full_audio()
             
@@ -195,140 +339,197 @@ class TranscriberLogicThread(threading.Thread):
             if full_structured_transcript:
                 self.transcript_structure = full_structured_transcript
 
-            # Convert structured transcript to text string for other agents
-            full_clean_transcript_text = "\n".join([f"{item['role']}: {item['message']}" for item in self.transcript_structure])
-            
-            # Use Gemini text if available, else fallback to Google STT (Trigger) text
-            text_for_analysis = raw_stt_text
-
-            # 1. Parallel Tasks Execution
-            parallel_start = time.perf_counter()
-            q_list = [i.get('content','') for i in self.qm.questions]
-
-            # Use text_for_analysis for agents
-            edu_task = self.education_agent.generate_education(self.transcript_structure, self.em.pool)
-            analytics_task = self.analytics_agent.analyze_consultation(self.transcript_structure)
-            
-            h_task = self.hepa_agent.get_hepa_diagnosis(text_for_analysis, self.patient_info, q_list)
-            g_task = self.gen_agent.get_gen_diagnosis(text_for_analysis, self.patient_info, q_list)
-            q_check_task = self.qc.check_question(text_for_analysis, self.qm.get_unanswered_questions())
-            status_task = self.supervisor.check_completion(text_for_analysis, self.dm.diagnoses)
-
-            (edu_res, analytics_res, h_res, g_res, answered_qs, status_res) = await asyncio.gather(
-                edu_task, analytics_task, h_task, g_task, q_check_task, status_task
-            )
-            
-            parallel_duration = time.perf_counter() - parallel_start
-            logger.info(f"⏱️ [Parallel Tasks] Completed in {parallel_duration:.2f}s")
+        # Update Chat (Full Replacement)
+        await self._push_to_ui({"type": "chat", "data": self.transcript_structure})
+        return self.transcript_structure
 
+    def _build_cycle_graph(self, text_for_analysis):
+        """
+        Declares the agent pipeline of one analysis cycle. Each stage starts as soon as
+        its own inputs are ready and pushes its UI update when it finishes:
+
+            transcript -> education, analytics
+            hepa + gen -> consolidate (diagnosis)
+            hepa + gen -> gatekeeper --+
+            answers ------------------+-> rank -> enrich (questions) --+
+            education, supervisor ----------------------------------+-> publish
+
+        Only education and analytics are non-essential: when a newer transcript supersedes
+        the cycle they are cancelled (and publish, which needs education, is skipped). The essential stages (diagnoses, answers,
+        question ranking, supervisor) always finish, so ranking and is_finished keep up under
+        continuous speech.
+        """
+        q_list = [i.get('content','') for i in self.qm.questions]
+        graph = pipeline.StageGraph(f"Cycle {self.check_count}")
 
-            with open('diagnosis_result.json', 'w', encoding='utf-8') as f:
-                json.dump({
-                    "general_diagnosis": g_res,
-                    "hepato_diagnosis": h_res
-                }, f, indent=4)
-
-            # 2. Sequential Processing Start
-            processing_start = time.perf_counter()
-
-            # Update Chat (Full Replacement)
-            await self._push_to_ui({"type": "chat", "data": self.transcript_structure})
+        # --- Independent Agents (start immediately) ---
+        graph.add("transcript", self._update_transcript)
+        graph.add("hepa", lambda: self.hepa_agent.get_hepa_diagnosis(text_for_analysis, self.patient_info, q_list))
+        graph.add("gen", lambda: self.gen_agent.get_gen_diagnosis(text_for_analysis, self.patient_info, q_list))
 
+        async def answers():
+            answered_qs = await self.qc.check_question(text_for_analysis, self.qm.get_unanswered_questions())
             # Update Questions State
             for aq in answered_qs:
                 self.qm.update_status(aq['qid'], "asked")
                 self.qm.update_answer(aq['qid'], aq['answer'])
-            
+            return answered_qs
+        graph.add("answers", answers)
+
+        async def supervisor():
+            status_res = await self.supervisor.check_completion(text_for_analysis, self.dm.diagnoses)
+            self.last_supervisor_status = status_res
+            await self._push_to_ui({"type": "status", "data": status_res})
+            return status_res
+        graph.add("supervisor", supervisor)
 
-            consolidated_task = self.consolidate_agent.consolidate_diagnosis(self.dm.get_diagnoses_basic(), h_res + g_res)
+        # --- Transcript-based Agents ---
+        async def education(transcript):
+            edu_res = await self.education_agent.generate_education(transcript, self.em.pool)
+            # Handle Education (the next point is picked in 'publish' only, so a superseded cycle marks nothing as asked)
+            self.em.add_new_points(edu_res)
+            await self._push_to_ui({"type": "education", "data": self.em.pool})
+            return edu_res
+        graph.add("education", education, deps=("transcript",), essential=False)
 
-            generated_questions = [i.get('followup_question') for i in h_res] + [i.get('followup_question') for i in g_res]
-            filtered_q_task = self.q_dedup.filter_new_questions(generated_questions,[i.get('content','') for i in self.qm.questions])
-            (consolidated, filtered_q) = await asyncio.gather(
-                consolidated_task, filtered_q_task
-            )
-            # Consolidate Diagnosis
-            with open('diagnosis_consolidate.json', 'w', encoding='utf-8') as f:
-                json.dump(consolidated, f, indent=4)
+        async def analytics(transcript):
+            analytics_res = await self.analytics_agent.analyze_consultation(transcript)
+            self.analytics_pool = analytics_res
+            await self._push_to_ui({"type": "analytics", "data": analytics_res})
+            return analytics_res
+        graph.add("analytics", analytics, deps=("transcript",), essential=False)
+
+        # --- Diagnosis Branch ---
+        async def consolidate(hepa, gen):
+            self.session.write_json('diagnosis_result.json', {
+                "general_diagnosis": gen,
+                "hepato_diagnosis": hepa
+            })
 
+            consolidated = await self.consolidate_agent.consolidate_diagnosis(self.dm.get_diagnoses_basic(), hepa + gen)
+            # Consolidate Diagnosis
+            self.session.write_json('diagnosis_consolidate.json', consolidated)
             self.dm.diagnoses = consolidated
+
+            diag_list = self.dm.get_diagnoses()
+            await self._push_to_ui({"type": "diagnosis", "diagnosis": diag_list})
+            return consolidated
+        graph.add("consolidate", consolidate, deps=("hepa", "gen"))
+
+        # --- Question Branch ---
+        async def gatekeeper(hepa, gen):
+            generated_questions = [i.get('followup_question') for i in hepa] + [i.get('followup_question') for i in gen]
+            filtered_q = await self.q_dedup.filter_new_questions(generated_questions, [i.get('content','') for i in self.qm.questions])
             self.qm.add_from_strings(filtered_q)
+            return filtered_q
+        graph.add("gatekeeper", gatekeeper, deps=("hepa", "gen"))
 
+        async def rank(gatekeeper, answers):
             ranked_questions = await self.ranker.rank_questions(text_for_analysis, self.qm.get_questions_basic())
-            with open('ranked_questions.json', 'w', encoding='utf-8') as f:
-                json.dump(ranked_questions, f, indent=4)
-            
+            self.session.write_json('ranked_questions.json', ranked_questions)
             self.qm.add_questions(ranked_questions.get('ranked',[]))
-            
+            return ranked_questions
+        graph.add("rank", rank, deps=("gatekeeper", "answers"))
+
+        async def enrich(rank):
             enriched_q = await self.q_enrich.enrich_questions(self.qm.get_questions_basic())
             self.qm.update_enriched_questions(enriched_q)
-
-            # Handle Education
-            self.em.add_new_points(edu_res)
-            next_ed = self.em.pick_and_mark_asked()
-
-            self.analytics_pool = analytics_res
-
-            # Final UI Push
-            check_diagnosis = []
-            diag_list = self.dm.get_diagnoses()
-            for d in diag_list:
-                check_diagnosis.append({
-                    "headline" : d.get("headline"),
-                    "rank" : d.get("rank"),
-                    "severity" : d.get("severity")
-                })
-            print("Diagnosis rank :", check_diagnosis)
-            await self._push_to_ui({"type": "diagnosis", "diagnosis": diag_list})
             await self._push_to_ui({"type": "questions", "questions": self.qm.questions})
-            await self._push_to_ui({"type": "analytics", "data": analytics_res})
-            await self._push_to_ui({"type": "status", "data": status_res})
-            await self._push_to_ui({"type": "education", "data": self.em.pool})
+            self.session.write_json('master_question.json', self.qm.questions)
+            return enriched_q
+        graph.add("enrich", enrich, deps=("rank",))
 
+        # --- Status Update ---
+        # (skipped when education was cancelled, _check_logic then publishes the status without education)
+        async def publish(enrich, education, supervisor):
+            await self._publish_cycle_status(supervisor)
+        graph.add("publish", publish, deps=("enrich", "education", "supervisor"))
 
-            with open('master_question.json', 'w', encoding='utf-8') as f:
-                json.dump(self.qm.questions, f, indent=4)
-            
-            # Status Update
-            hr_q = self.qm.get_high_rank_question()
+        return graph
 
-            if not self.status:
-                self.status = status_res.get("end", False)
+    async def _publish_cycle_status(self, status_res):
+        next_ed = self.em.pick_and_mark_asked()
+        if next_ed:
+            await self._push_to_ui({"type": "education", "data": self.em.pool})
+        self._publish_status(status_res, next_ed)
 
-            if self.status:
-                self.running = False
-            
-            if not hr_q:
-                self.status = True
+    def _publish_status(self, status_res, next_ed):
+        hr_q = self.qm.get_high_rank_question()
 
-            logger.info(f"🤖 [AI Agent] Check status - count: {self.check_count}")
+        if not self.status:
+            self.status = status_res.get("end", False)
 
-            if self.check_count < 15:
-                update_object = {
-                        "is_finished": self.status,
-                        "question": hr_q.get("content") if hr_q else None,
-                        "education": next_ed.get("content", "") if next_ed else ""
-                    }
-            else:
-                self.status = True
-                update_object = {
-                        "is_finished": True,
-                        "question": "",
-                        "education": ""
-                    }
-            logger.info(f"Status Update : {self.status}")
-            
-            with open('status_update.json', 'w', encoding='utf-8') as f:
-                json.dump(update_object, f, indent=4)
+        if self.status:
+            self.running = False
+        
+        if not hr_q:
+            self.status = True
+
+        logger.info(f"🤖 [AI Agent] Check status - count: {self.check_count}")
+
+        if self.check_count <= 15:
+            update_object = {
+                    "is_finished": self.status,
+                    "question": hr_q.get("content") if hr_q else None,
+                    "education": next_ed.get("content", "") if next_ed else ""
+                }
+        else:
+            self.status = True
+            update_object = {
+                    "is_finished": True,
+                    "question": "",
+                    "education": ""
+                }
+        logger.info(f"Status Update : {self.status}")
+        
+        self.session.set_status(update_object)
 
-            processing_duration = time.perf_counter() - processing_start
-            total_duration = time.perf_counter() - total_start
+    async def _check_logic(self, raw_stt_text):
+        """Main AI Reasoning Branch (runs the cycle stage graph)."""
+        try:
+            # Use Gemini text if available, else fallback to Google STT (Trigger) text
+            text_for_analysis = raw_stt_text
 
-            logger.info(f"⏱️ [Processing] UI & Logic updates took {processing_duration:.2f}s")
+            # Counted on start: under continuous speech every cycle may be superseded,
+            # and the cycle cap still has to be reached.
             self.check_count += 1
+            graph = self._build_cycle_graph(text_for_analysis)
+            self.active_graph = graph
+            await graph.run()
+            graph.log_timings()
+
+            # Superseded before 'publish': still publish a status (supervisor result, questions as
+            # ranked by the essential stages) so the simulation is not left waiting. No education
+            # point is picked, so none is marked as asked by a cycle whose education was cancelled.
+            if "publish" not in graph.results:
+                self._publish_status(graph.results.get("supervisor", self.last_supervisor_status), None)
         except Exception as e:
             logger.error(f"Check logic error: {e}")
             traceback.print_exc()
+        finally:
+            self.active_graph = None
+
+    async def _supersede_on_new_finals(self, cycle):
+        """Waits alongside a running cycle; newer finals supersede it (latest-wins)."""
+        while not cycle.done():
+            waiter = asyncio.create_task(self.transcript_event.wait())
+            try:
+                await asyncio.wait({cycle, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+
+            if cycle.done():
+                return
+            if self.active_graph is None:
+                # Cycle task has not built its graph yet
+                await asyncio.sleep(0)
+                continue
+
+            self.transcript_event.clear()
+            if self.pending_finals:
+                cancelled = self.active_graph.supersede()
+                logger.info(f"⏭️ [Logic Thread] {self.pending_finals} new final sentence(s), superseding {self.active_graph.name} (cancelled: {', '.join(cancelled) or 'none'}).")
+                return
 
     async def _final_wrap(self):
         logger.info("🛑 [Finalization] Consultation complete. Generating final outputs...")
@@ -352,36 +553,53 @@ class TranscriberLogicThread(threading.Thread):
         )
 
         await self._push_to_ui({"type": "report", "data": report_result})
+
+        cache = response_cache.get_cache()
+        if cache is not None:
+            logger.info(f"🗃️ [ResponseCache] {cache.stats()}")
         logger.info("🛑 [Finalization] Finished")
 
     async def _logic_loop(self):
-        last_processed_text = ""
         while self.running:
             try:
-                # Trigger logic based on Google STT activity (Voice Activity Detection)
-                lines = self.transcript_memory
-                full_text = " ".join(lines).strip()
+                # Sleep until STT finalizes a sentence (or a manual finish wakes us up).
+                # Finals that superseded the previous cycle are already pending.
+                if not self.pending_finals:
+                    try:
+                        await asyncio.wait_for(self.transcript_event.wait(), timeout=IDLE_CHECK_SEC)
+                    except asyncio.TimeoutError:
+                        pass
+
+                if self.pending_finals:
+                    # Debounce: finals arriving close together are coalesced into one cycle
+                    await asyncio.sleep(self.debounce_sec)
+                    self.transcript_event.clear()
+                    new_finals, self.pending_finals = self.pending_finals, 0
+
+                    lines = self.transcript_memory
+                    full_text = " ".join(lines).strip()
+                    logger.info(f"🤖 [AI Agent] Analyzing updated transcript ({new_finals} new final sentence(s), {len(full_text)} chars)...")
 
-                text_has_grown = len(full_text) > len(last_processed_text) + 20
-                sentence_was_finalized = self.last_line_count < len(lines)
-                
-                logger.info(f"🤖 LOGIC LOOP] transcript lines: {len(full_text)},  last_line_count: {len(lines)}")
-                
-                
-
-                if text_has_grown:
-                    logger.info(f"🤖 [AI Agent] Analyzing updated transcript...")
-                    
                     # Pass the rough Google STT text for logging/triggering
-                    # _check_logic will pull the Full Audio from the Engine
-                    await self._check_logic(full_text)
-                    
+                    # _check_logic will pull the new Audio from the Engine
+                    cycle_start = time.perf_counter()
+                    cycle = asyncio.create_task(self._check_logic(full_text))
+                    try:
+                        if self.supersede_stale_cycles:
+                            await self._supersede_on_new_finals(cycle)
+                        await cycle
+                    finally:
+                        cycle.cancel()
+                    self.last_cycle_duration = time.perf_counter() - cycle_start
                     self.last_line_count = len(lines)
-                    last_processed_text = full_text
-                    await asyncio.sleep(5) # Cooldown
+
+                    # Adaptive cooldown: proportional to how long the last cycle took.
+                    # Skipped when newer finals are already waiting for the next cycle.
+                    cooldown = min(self.max_cooldown_sec, max(self.min_cooldown_sec, self.last_cycle_duration * self.cooldown_factor))
+                    if cooldown > 0 and not self.status and not self.pending_finals:
+                        await asyncio.sleep(cooldown)
                 else:
-                    await asyncio.sleep(1)
-                    print("Waiting for new transcript lines...")
+                    self.transcript_event.clear()
 
                 if self.status:
                     logger.info(f"✅ [Logic Thread] Start Wrap Up.")
@@ -396,80 +614,160 @@ class TranscriberLogicThread(threading.Thread):
                 traceback.print_exc()
                 await asyncio.sleep(2)
 
+    def _wake(self, new_final=False):
+        """Runs on the logic loop."""
+        if new_final:
+            self.pending_finals += 1
+        self.transcript_event.set()
+
+    def notify_final_transcript(self):
+        """Called from the STT thread when a sentence is finalized. Thread-safe."""
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wake, True)
+
     def trigger_manual_finish(self):
         """Called externally to force the consultation to end."""
         logger.info("🛑 [Logic Thread] Received MANUAL END signal from Frontend.")
         self.status = True
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def call_on_loop(self, callback, *args):
+        """
+        Thread-safe. Runs 'callback' on the logic loop, between stages, so the pools it reads
+        are not being updated at the same time; directly once the loop is gone.
+        """
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(callback, *args)
+                return
+            except RuntimeError:
+                pass    # Closed in the meantime
+        callback(*args)
 
     def stop(self):
         self.running = False
 
 class TranscriberEngine:
-    def __init__(self, patient_id, patient_info, websocket, loop):
+    def __init__(self, patient_id, patient_info, websocket, loop, incremental_transcription=True,
+                 max_audio_ram_bytes=audio_buffer.DEFAULT_MAX_RAM_BYTES, session=None, sync_mode=state_sync.SYNC_FULL):
         self.websocket = websocket
         self.patient_id = patient_id
         self.patient_info = patient_info
         self.main_loop = loop
         self.running = True
+        # Websocket gone, kept alive for a resume (see engine_registry); STT is paused meanwhile
+        self.detached = False
+        # Consultation state shared with the simulation socket of the same session_id
+        self.session = session if session is not None else session_store.SessionState(session_store.DEFAULT_SESSION_ID)
         
         # Audio Config
         self.AUDIO_DELAY_SEC = 0.2
         self.SIMULATION_RATE = 24000
         self.TRANSCRIBER_RATE = 16000
-        self.resample_state = None
+        # One stateful resampler per input format ((rate, channels) -> StreamResampler)
+        self.resamplers = {}
         self.audio_queue = queue.Queue()       
         self.transcript_memory = []
         self.is_sentence_final = True
 
         # NEW: Audio Accumulation Buffer (Piled Up)
-        self.raw_audio_buffer = bytearray()
-        self.buffer_lock = threading.Lock()
+        # Chunked + bounded in RAM, older audio is spilled to a memory-mapped file.
+        self.raw_audio_buffer = audio_buffer.AudioBuffer(max_ram_bytes=max_audio_ram_bytes)
+
+        # Speaker labels of buffered audio, [role, start_byte, end_byte] (set by server-side loopback)
+        self.speaker_spans = []
+        self.span_lock = threading.Lock()
+
+        # Per-connection UI send queue (bounded, latest-wins for snapshots);
+        # questions/diagnosis/education snapshots leave it as versioned patches
+        self.state_sync = state_sync.StateSync(sync_mode)
+        self.outbound = outbound.OutboundQueue(websocket, loop, transform=self.state_sync.transform) if websocket and loop else None
 
         # Initialize Logic Thread
         self.logic_thread = TranscriberLogicThread(
             self.patient_info, 
             diagnosis_manager.DiagnosisManager(), 
-            question_manager.QuestionPoolManager([]), 
+            self.session.qm, 
             self.main_loop, 
             self.websocket, 
             self.transcript_memory, 
             self.running,
-            self.get_audio_buffer_copy # <--- Pass the callback
+            self.get_audio_snapshot, # <--- Pass the callback
+            self.get_audio_buffer_length,
+            incremental_transcription=incremental_transcription,
+            session=self.session,
+            speaker_callback=self.get_speaker_spans,
+            outbound_queue=self.outbound
         )
         self.logic_thread.start()
 
-    def add_audio(self, audio_bytes):
-        """Receives raw bytes from server.py WebSocket."""
+    def add_audio(self, audio_bytes, speaker=None, sample_rate=None, channels=1):
+        """
+        Receives 16-bit PCM, from the server.py WebSocket or directly from a simulation (loopback).
+        :param speaker: Optional speaker label ("NURSE"/"PATIENT"), recorded as a transcription hint.
+        :param sample_rate: Input rate, 24 kHz simulation audio by default.
+        """
         try:
-            # Resample from 24k (Simulation) to 16k (Google STT / Agent)
-            converted, self.resample_state = audioop.ratecv(
-                audio_bytes, 2, 1, self.SIMULATION_RATE, self.TRANSCRIBER_RATE, self.resample_state
-            )
+            # Resample to 16k mono (Google STT / Agent)
+            fmt = (sample_rate or self.SIMULATION_RATE, channels)
+            rs = self.resamplers.get(fmt)
+            if rs is None:
+                rs = self.resamplers[fmt] = resampler.StreamResampler(fmt[0], self.TRANSCRIBER_RATE, in_channels=channels)
+            converted = rs.process(audio_bytes)
+            if not converted:
+                return
             
             # 1. Put into STT Queue (for Google Streaming Trigger)
             release_time = time.time() + self.AUDIO_DELAY_SEC
             self.audio_queue.put((release_time, converted))
 
             # 2. Accumulate in Buffer (Piled Up)
-            with self.buffer_lock:
-                self.raw_audio_buffer.extend(converted)
+            start = len(self.raw_audio_buffer)
+            self.raw_audio_buffer.append(converted)
+            if speaker:
+                self._record_speaker(speaker.capitalize(), start, start + len(converted))
 
         except Exception as e:
             logger.error(f"Resampling Error: {e}")
 
-    def get_audio_buffer_copy(self):
+    def get_audio_snapshot(self, start=0, end=None):
         """
-        Callback used by Logic Thread to retrieve the FULL piled-up audio.
-        Does NOT clear the buffer.
+        Callback used by Logic Thread to retrieve the piled-up audio
+        (the FULL history by default, or the [start:end] byte range).
+        Returns a read-only AudioSnapshot (no copy) or None. Does NOT clear the buffer.
         """
-        with self.buffer_lock:
-            if len(self.raw_audio_buffer) == 0:
-                return None
-            # Return a COPY of the bytes
-            return bytes(self.raw_audio_buffer)
+        return self.raw_audio_buffer.snapshot(start, end)
+
+    def get_audio_buffer_length(self):
+        """Callback used by Logic Thread to find the current end of the audio buffer."""
+        return len(self.raw_audio_buffer)
+
+    def _record_speaker(self, role, start, end):
+        with self.span_lock:
+            last = self.speaker_spans[-1] if self.speaker_spans else None
+            if last and last[0] == role and start - last[2] <= AUDIO_BYTES_PER_SEC:
+                last[2] = end   # Same speaker continuing (small gaps are merged)
+            else:
+                self.speaker_spans.append([role, start, end])
+
+    def get_speaker_spans(self, start=0, end=None):
+        """
+        Callback used by Logic Thread: speaker timeline of the buffer range [start:end],
+        as [(role, start_sec, end_sec)] relative to 'start'. Empty without loopback.
+        """
+        end = len(self.raw_audio_buffer) if end is None else end
+        with self.span_lock:
+            spans = [(r, max(s, start), min(e, end)) for r, s, e in self.speaker_spans if e > start and s < end]
+        return [(r, (s - start) / AUDIO_BYTES_PER_SEC, (e - start) / AUDIO_BYTES_PER_SEC) for r, s, e in spans]
 
     def stt_loop(self):
         """Google STT Streaming (Used as VAD/Trigger)."""
+        if model_backend.STT_BACKEND == "replay":
+            # Offline: scripted final sentences instead of Google STT
+            return model_backend.ReplayTranscriptSource().run(self)
+
         logger.info("⏳ [Engine] Waiting for initial analysis...")
         self.logic_thread.ready_event.wait()
 
@@ -484,7 +782,7 @@ class TranscriberEngine:
         streaming_config = speech.StreamingRecognitionConfig(config=config, interim_results=True)
 
         def request_generator():
-            while self.running:
+            while self.running and not self.detached:
                 try:
                     item = self.audio_queue.get(timeout=1.0)
                     if item is None: return
@@ -501,6 +799,9 @@ class TranscriberEngine:
         logger.info(f"🎙️ [STT Loop] Google Stream started...")
         retries_count = 0
         while self.running:
+            if self.detached:
+                time.sleep(0.5)     # No client audio until a resume, avoid STT audio timeouts
+                continue
             try:
                 responses = client.streaming_recognize(streaming_config, request_generator())
                 
@@ -526,6 +827,7 @@ class TranscriberEngine:
                         
                         self.is_sentence_final = True
                         print(f"\n✅ [FINAL SENTENCE]: {transcript}")
+                        self.logic_thread.notify_final_transcript()
 
             except Exception as e:
                 if self.running:
@@ -542,7 +844,51 @@ class TranscriberEngine:
             self.logic_thread.trigger_manual_finish()
             self.running = False
 
+    def detach(self):
+        """Client disconnected: stop sending, keep pools, transcript and audio for a resume."""
+        self.detached = True
+        if self.outbound:
+            self.outbound.close()
+
+    def attach(self, websocket, versions=None):
+        """
+        Rebinds a detached engine to a new websocket. Channels whose acknowledged version
+        ('versions', {type: version}) matches continue with patches, the others get snapshots.
+        """
+        self.websocket = self.logic_thread.websocket = websocket
+        self.outbound = outbound.OutboundQueue(websocket, self.main_loop, transform=self.state_sync.transform)
+        self.logic_thread.outbound = self.outbound
+        self.state_sync.rebase(versions)
+        self.detached = False
+        # last_pushed is written by the logic loop: replay it from there
+        self.logic_thread.call_on_loop(self._replay_last_pushed)
+
+    def _replay_last_pushed(self):
+        if not self.outbound:
+            return
+        for payload in list(self.logic_thread.last_pushed.values()):
+            self.outbound.put(payload)
+
+    def resync(self):
+        """Client lost track of a state version: next questions/diagnosis/education messages are full snapshots."""
+        if not self.outbound:
+            return
+        self.state_sync.reset()
+        # Snapshotted on the logic loop, which is the only writer of these pools
+        self.logic_thread.call_on_loop(self._put_snapshots)
+
+    def _put_snapshots(self):
+        if not self.outbound:
+            return
+        self.outbound.put({"type": "questions", "questions": self.session.qm.questions})
+        self.outbound.put({"type": "diagnosis", "diagnosis": self.logic_thread.dm.get_diagnoses()})
+        self.outbound.put({"type": "education", "data": self.session.em.pool})
+
     def stop(self):
         self.running = False
         self.logic_thread.stop()
-        self.audio_queue.put(None)
\ No newline at end of file
+        if self.outbound:
+            self.outbound.close()
+            logger.info(f"🔀 [StateSync] {self.state_sync.stats()}")
+        self.audio_queue.put(None)
+        self.raw_audio_buffer.close()
\ No newline at end of file
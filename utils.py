@@ -1,23 +1,55 @@
 # --- utils.py ---
+import os
+import asyncio
 import logging
-from google.cloud import storage
+import gcs_manager
+import model_backend
 
 logger = logging.getLogger("medforce-backend")
 
+# Local patient data (<dir>/<pid>/<file>), read before GCS. Replay runs default to the
+# sample patient in scenario_dumps so they need no network.
+PATIENT_DATA_DIR = os.getenv("PATIENT_DATA_DIR") or (
+    os.path.join(model_backend.SCENARIO_DIR, "patients") if model_backend.BACKEND_MODE == "replay" else ""
+)
+
+def read_local_patient_file(pid: str, filename: str):
+    """Text of a local patient file, or None when there is no local copy."""
+    if not PATIENT_DATA_DIR:
+        return None
+    root = os.path.abspath(PATIENT_DATA_DIR)
+    path = os.path.abspath(os.path.join(root, pid, filename))
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
 def fetch_gcs_text_internal(pid: str, filename: str) -> str:
     """Fetches text content from GCS for internal logic use."""
-    BUCKET_NAME = "clinic_sim"
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(BUCKET_NAME)
-        blob_path = f"patient_profile/{pid}/{filename}"
-        blob = bucket.blob(blob_path)
-        
-        if not blob.exists():
+        local = read_local_patient_file(pid, filename)
+        if local is not None:
+            return local
+
+        blob_path = gcs_manager.patient_path(pid, filename)
+        # Profiles rarely change: served from the process cache, revalidated by generation
+        cached = gcs_manager.read_cached(blob_path)
+
+        if cached is None:
             logger.warning(f"File not found in GCS: {blob_path}")
             return f"System: Error - File {filename} not found."
             
-        return blob.download_as_text()
+        return cached.data.decode("utf-8")
     except Exception as e:
         logger.error(f"GCS Internal Error: {e}")
-        return "System: Error loading profile."
\ No newline at end of file
+        return "System: Error loading profile."
+
+
+async def fetch_gcs_text_async(pid: str, filename: str) -> str:
+    """Coroutine version of fetch_gcs_text_internal (runs off the event loop)."""
+    return await gcs_manager.run_async(fetch_gcs_text_internal, pid, filename)
+
+
+async def fetch_gcs_texts_async(pid: str, *filenames: str) -> list:
+    """Fetches several profile files of one patient concurrently, in argument order."""
+    return await asyncio.gather(*(fetch_gcs_text_async(pid, f) for f in filenames))
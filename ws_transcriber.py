@@ -2,7 +2,6 @@ import asyncio
 import websockets
 import json
 import base64
-import audioop
 import os
 import sys
 import queue
@@ -20,6 +19,7 @@ import diagnosis_manager
 import question_manager
 import agents
 import gcs_manager
+from resampler import StreamResampler
 
 load_dotenv()
 
@@ -40,7 +40,7 @@ class STTBridge:
         self.patient_id = patient_id
         self.session_id = generate_session_id()
         self.running = True
-        self.resample_state = None
+        self.resampler = StreamResampler(SIMULATION_RATE, TRANSCRIBER_RATE)
         
         print(f"🚀 Starting LOCAL Session: {self.session_id} for Patient: {self.patient_id}")
 
@@ -50,11 +50,11 @@ class STTBridge:
         self.file_handle.write(f"--- SESSION {self.session_id} START ---\n\n")
         
         # --- Pre-initialize Agents ---
-        self.hepa_agent = agents.DiagnosisHepato()
-        self.gen_agent = agents.DiagnosisGeneral()
-        self.consolidate_agent = agents.DiagnosisConsolidate()
-        self.merger_agent = agents.QuestionMerger()
-        self.supervisor = agents.InterviewSupervisor()
+        self.hepa_agent = agents.get_agent(agents.DiagnosisHepato)
+        self.gen_agent = agents.get_agent(agents.DiagnosisGeneral)
+        self.consolidate_agent = agents.get_agent(agents.DiagnosisConsolidate)
+        self.merger_agent = agents.get_agent(agents.QuestionMerger)
+        self.supervisor = agents.get_agent(agents.InterviewSupervisor)
 
         self.audio_queue = queue.Queue()       
         self.transcript_queue = asyncio.Queue() 
@@ -244,10 +244,9 @@ class STTBridge:
         if self.output_stream:
             try: self.output_stream.write(audio_bytes)
             except: pass
-        converted, self.resample_state = audioop.ratecv(
-            audio_bytes, 2, 1, SIMULATION_RATE, TRANSCRIBER_RATE, self.resample_state
-        )
-        self.audio_queue.put(converted)
+        converted = self.resampler.process(audio_bytes)
+        if converted:
+            self.audio_queue.put(converted)
 
     def cleanup(self):
         self.running = False